@@ -0,0 +1,468 @@
+# -*- coding: utf-8 -*-
+#Copyright (C) 2009 Gael Pasgrimaud
+__doc__ = """Non blocking operations on top of python-ldap's message ids.
+
+:class:`AsyncConnection` mirrors :class:`~afpy.ldap.connection.Connection`
+but each method send a request and return an :class:`Operation` at once.
+All requests share one socket so dozens of lookups can be pending without a
+thread per request:
+
+.. sourcecode:: py
+
+    conn = AsyncConnection(section='afpy')
+    ops = [conn.get_dn(conn.user_class.build_dn(uid)) for uid in uids]
+    conn.wait(ops)
+    entries = [op.result() for op in ops]
+
+Operations are completed by :meth:`AsyncConnection.poll`. An event loop can
+watch the sockets returned by :meth:`AsyncConnection.filenos` and call
+:meth:`~AsyncConnection.poll` when they are readable. Use
+:meth:`Operation.add_done_callback` to wrap an operation in your framework's
+future (a twisted ``Deferred``, a tornado ``Future``, ...).
+
+A callback can return another pending :class:`Operation`. The operation is
+then complete when the new request is complete. ``save`` use it to rename
+an entry before modifying it.
+"""
+from connection import Connection
+from connection import convert_entry
+from connection import encode_modlist
+from connection import replace_modlist
+from connection import add_attributes
+from connection import escape_dn
+import utils
+import select
+import time
+import ldap
+
+# max time spent in select(). libldap may have buffered data (TLS)
+POLL_INTERVAL = .1
+
+
+class Operation(object):
+    """A pending request. ``callback`` is called with the list of results
+    and return the operation's value. ``errback`` is called with a
+    ``ldap.LDAPError`` and can return a value or raise"""
+
+    def __init__(self, conn, ldap_conn, msgid, callback=None, errback=None):
+        self.conn = conn
+        self.ldap_conn = ldap_conn
+        self.msgid = msgid
+        self.callback = callback
+        self.errback = errback
+        self.done = False
+        self._results = []
+        self._value = None
+        self._exception = None
+        self._callbacks = []
+
+    def poll(self):
+        """read available responses. Return True when the operation is
+        complete"""
+        while not self.done:
+            try:
+                rtype, rdata, rmsgid, rctrls = self.ldap_conn.result3(
+                                                self.msgid, all=0, timeout=0)
+            except ldap.LDAPError, e:
+                self._fail(e)
+                break
+            if rtype is None:
+                return False
+            if rdata:
+                self._results.extend(rdata)
+            if rtype not in (ldap.RES_SEARCH_ENTRY, ldap.RES_SEARCH_REFERENCE):
+                self._finish()
+        return True
+
+    def _finish(self):
+        try:
+            if self.callback is not None:
+                value = self.callback(self._results)
+            else:
+                value = self._results
+        except Exception, e:
+            self._exception = e
+        else:
+            if isinstance(value, Operation):
+                if not value.done:
+                    self._follow(value)
+                    return
+                self._value = value._value
+                self._exception = value._exception
+            else:
+                self._value = value
+        self._done()
+
+    def _follow(self, op):
+        """continue with the request of op"""
+        self.conn._pending.discard(op)
+        self.ldap_conn = op.ldap_conn
+        self.msgid = op.msgid
+        self.callback = op.callback
+        self.errback = op.errback
+        self._results = []
+
+    def _fail(self, error):
+        if isinstance(error, ldap.SERVER_DOWN):
+            self.conn._reset(self.ldap_conn)
+        try:
+            if self.errback is None:
+                raise error
+            self._value = self.errback(error)
+        except Exception, e:
+            self._exception = e
+        self._done()
+
+    def _done(self):
+        self.done = True
+        self._results = None
+        for func in self._callbacks:
+            func(self)
+        self._callbacks = []
+
+    def add_done_callback(self, func):
+        """call func with the operation when it's complete"""
+        if self.done:
+            func(self)
+        else:
+            self._callbacks.append(func)
+
+    def exception(self):
+        """return the exception raised by the operation if any"""
+        if not self.done:
+            self.conn.wait([self])
+        return self._exception
+
+    def result(self, timeout=None):
+        """return the value of the operation. Block until it's complete"""
+        if not self.done:
+            self.conn.wait([self], timeout=timeout)
+            if not self.done:
+                raise ldap.TIMEOUT('%r is not complete' % self)
+        if self._exception is not None:
+            raise self._exception
+        return self._value
+
+    def cancel(self):
+        """abandon the request"""
+        if not self.done:
+            try:
+                self.ldap_conn.abandon(self.msgid)
+            except ldap.LDAPError:
+                pass
+            self.conn._pending.discard(self)
+            self._exception = ldap.USER_CANCELLED({'desc': 'Operation abandoned'})
+            self._done()
+
+    def __repr__(self):
+        return '<%s %s%s>' % (self.__class__.__name__, self.msgid,
+                              self.done and ' done' or '')
+
+
+class AsyncConnection(Connection):
+    """A :class:`~afpy.ldap.connection.Connection` which send requests
+    without waiting for the responses. Methods return :class:`Operation`
+    objects. The object is not thread safe: use it from your event loop's
+    thread"""
+
+    def __init__(self, *args, **kwargs):
+        Connection.__init__(self, *args, **kwargs)
+        self._lconn = None
+        self._binders = []
+        self._pending = set()
+
+    def _connect(self):
+        """return the LDAPConnection and the python-ldap object shared by
+        all operations"""
+        if self._lconn is None:
+            self._lconn = self.connection_factory()
+        return self._lconn, self._lconn.connect(bind_dn=self.bind_dn,
+                                                bind_pwd=self.bind_pw)
+
+    def _reset(self, ldap_conn):
+        """forget a dead connection"""
+        if self._lconn is not None and \
+           self._lconn._getConnection() is ldap_conn:
+            self._lconn = None
+        if ldap_conn in self._binders:
+            self._binders.remove(ldap_conn)
+
+    def _operation(self, ldap_conn, msgid, callback=None, errback=None):
+        op = Operation(self, ldap_conn, msgid, callback=callback, errback=errback)
+        self._pending.add(op)
+        return op
+
+    def filenos(self):
+        """return the sockets used by pending operations"""
+        fds = set()
+        for op in self._pending:
+            try:
+                fds.add(op.ldap_conn.fileno())
+            except ldap.LDAPError:
+                pass
+        return list(fds)
+
+    def poll(self):
+        """read available responses. Return the operations completed"""
+        completed = [op for op in list(self._pending) if op.poll()]
+        for op in completed:
+            self._pending.discard(op)
+        return completed
+
+    def wait(self, operations=None, timeout=None):
+        """block until all operations (default to all pending operations)
+        are complete or timeout expire. Return the completed operations"""
+        if operations is None:
+            operations = list(self._pending)
+        deadline = timeout is not None and time.time() + timeout or None
+        self.poll()
+        while [op for op in operations if not op.done]:
+            interval = POLL_INTERVAL
+            if deadline is not None:
+                interval = min(interval, deadline - time.time())
+                if interval <= 0:
+                    break
+            fds = self.filenos()
+            if fds:
+                select.select(fds, [], [], interval)
+            else:
+                time.sleep(interval)
+            self.poll()
+        return [op for op in operations if op.done]
+
+    def _search(self, base_dn=None, scope=ldap.SCOPE_SUBTREE,
+                filter='(objectClass=*)', attrs=None, callback=None,
+                errback=None):
+        lconn, ldap_conn = self._connect()
+        base = escape_dn(lconn._encode_incoming(base_dn or self.base_dn))
+        fltr = lconn._encode_incoming(filter)
+        msgid = ldap_conn.search_ext(base, scope, fltr, attrs)
+        def entries(results):
+            entries = [convert_entry(lconn, dn, entry) for dn, entry in results]
+            entries = [e for e in entries if e is not None]
+            if callback is not None:
+                return callback(entries)
+            return entries
+        return self._operation(ldap_conn, msgid, callback=entries, errback=errback)
+
+    def search(self, **kwargs):
+        """search. The operation's value is a list of entries"""
+        options = self._search_options(kwargs)
+        return self._search(options['base_dn'], options['scope'],
+                            options.get('fltr', '(objectClass=*)'),
+                            options.get('attrs'))
+
+    def search_nodes(self, node_class=None, frozen=False, **kwargs):
+        """like search but the value is a list of nodes"""
+        node_class = node_class or self.node_class
+        attrs = self._projection(node_class, kwargs)
+        options = self._search_options(kwargs)
+        def nodes(entries):
+            return [self._node(node_class, e, attrs, frozen) for e in entries]
+        return self._search(options['base_dn'], options['scope'],
+                            options.get('fltr', '(objectClass=*)'),
+                            attrs, callback=nodes)
+
+    def get_groups(self, dn, base_dn=None, node_class=None):
+        """the operation's value is the list of groups for dn"""
+        node_class = node_class or self.group_class
+        return self.search_nodes(node_class=node_class,
+                                 **self._groups_options(dn, base_dn, node_class))
+
+    def get_dn(self, dn, attrs=None):
+        """the operation's value is the search result for dn. A ValueError
+        is raised if dn does not exist"""
+        result = self._cache_get(dn, attrs)
+        if result is not None:
+            op = Operation(self, None, None)
+            op._value = result
+            op._done()
+            return op
+        def found(entries):
+            result = dict(size=len(entries), results=entries, exception='')
+            self._cache_set(dn, attrs, result)
+            return result
+        def not_found(error):
+            raise ValueError(dn)
+        return self._search(dn, ldap.SCOPE_BASE, attrs=attrs,
+                            callback=found, errback=not_found)
+
+    def load(self, node):
+        """async counterpart of :meth:`~afpy.ldap.node.Node.normalized_data`.
+        The operation's value is the node's data"""
+        node.bind(self)
+        if node._data:
+            op = Operation(self, None, None)
+            op._value = node._data
+            op._done()
+            return op
+        attrs = node.attributes()
+        op = self.get_dn(node.dn, attrs=attrs)
+        def load(op):
+            if node._data is None:
+                node._data = {}
+            if op._exception is None:
+                op._value = node._load(op._value, attrs)
+            elif isinstance(op._exception, ValueError):
+                # new node
+                op._exception = None
+                op._value = node._data
+        # run before user callbacks
+        op._callbacks.insert(0, load)
+        if op.done:
+            load(op)
+        return op
+
+    def check(self, dn, password):
+        """check a password for dn. The operation's value is a boolean"""
+        if not password:
+            op = Operation(self, None, None)
+            op._value = False
+            op._done()
+            return op
+        if self._binders:
+            ldap_conn = self._binders.pop()
+        else:
+            ldap_conn = self.connection_factory().connect()
+        msgid = ldap_conn.simple_bind(dn, password)
+        def release(op):
+            # avoid to reuse a dead connection
+            if not isinstance(op._exception, ldap.SERVER_DOWN):
+                self._binders.append(ldap_conn)
+        def bound(results):
+            return True
+        def failed(error):
+            if isinstance(error, ldap.INVALID_CREDENTIALS):
+                return False
+            raise error
+        op = self._operation(ldap_conn, msgid, callback=bound, errback=failed)
+        op.add_done_callback(release)
+        return op
+
+    def save(self, node):
+        """save a node. The operation's value is True. The entry is renamed
+        first if the rdn value changed"""
+        if not (node._data and node.dn):
+            raise ValueError('Nothing to save for %r' % node)
+        node._conn = self
+        attrs = node._data.copy()
+        if 'dn' in attrs:
+            dn = attrs.pop('dn')
+            if '=' not in dn or dn.lower() != node.dn.lower():
+                raise ValueError('Inconsistent dn for %r: %s %s' % (node, node.dn, dn))
+        modlist = node._modlist()
+        if modlist is None and node._renamed():
+            return self._rename(node, attrs)
+        if modlist is None:
+            # no snapshot. can't compute a diff without a round trip
+            modlist = replace_modlist(attrs)
+        return self._modify(node, modlist)
+
+    def _rename(self, node, attrs):
+        """rename the entry then send the other modifications"""
+        rdn = node._rdn
+        dn = node.dn
+        newrdn = '%s=%s' % (rdn, utils.to_list(attrs.pop(rdn))[0])
+        new_dn = '%s,%s' % (newrdn, dn.split(',', 1)[1])
+        if node._snapshot is not None:
+            dirty = node._dirty
+            node._dirty = set([a for a in dirty if a != rdn])
+            try:
+                modlist = node._modlist()
+            finally:
+                node._dirty = dirty
+        else:
+            modlist = replace_modlist(attrs)
+        lconn, ldap_conn = self._connect()
+        lconn._complainIfReadOnly()
+        self.invalidate(dn)
+        msgid = ldap_conn.rename(escape_dn(lconn._encode_incoming(dn)),
+                                 escape_dn(lconn._encode_incoming(newrdn)),
+                                 None, 1)
+        def renamed(results):
+            self.invalidate(dn)
+            node._update_dn(uid=None, dn=new_dn)
+            return self._modify(node, modlist)
+        def failed(error):
+            self.invalidate(dn)
+            raise error.__class__('Error while renaming %r: %s' % (node, error))
+        return self._operation(ldap_conn, msgid, callback=renamed, errback=failed)
+
+    def _modify(self, node, modlist):
+        lconn, ldap_conn = self._connect()
+        lconn._complainIfReadOnly()
+        self.invalidate(node.dn)
+        dn = node.dn
+        if modlist:
+            msgid = ldap_conn.modify_ext(escape_dn(lconn._encode_incoming(dn)),
+                                         encode_modlist(lconn, modlist))
+        else:
+            op = Operation(self, None, None)
+            op._value = True
+            op._done()
+            node._clear()
+            return op
+        def saved(results):
+            self.invalidate(dn)
+            node._clear()
+            return True
+        def failed(error):
+            self.invalidate(dn)
+            raise error.__class__('Error while saving %r: %s' % (node, error))
+        return self._operation(ldap_conn, msgid, callback=saved, errback=failed)
+
+    def add(self, node):
+        """add a new node. The operation's value is True"""
+        node._conn = self
+        attrs = node._defaults.copy()
+        for k, v in node._data.items():
+            if v not in ('', [], None):
+                attrs[k] = v
+        if 'dn' in attrs:
+            dn = attrs.pop('dn')
+            if '=' not in dn or dn.lower() != node.dn.lower():
+                raise ValueError('Inconsistent dn for %r: %s %s' % (node, node.dn, dn))
+        lconn, ldap_conn = self._connect()
+        lconn._complainIfReadOnly()
+        dn = node.dn
+        self.invalidate(dn)
+        msgid = ldap_conn.add_ext(escape_dn(lconn._encode_incoming(dn)),
+                                  add_attributes(lconn, attrs))
+        def added(results):
+            self.invalidate(dn)
+            node._clear()
+            return True
+        def failed(error):
+            self.invalidate(dn)
+            raise error.__class__('%s %s %s' % (error, dn, attrs))
+        return self._operation(ldap_conn, msgid, callback=added, errback=failed)
+
+    def delete(self, node):
+        """delete a node. The operation's value is True"""
+        node._clear()
+        dn = node.dn
+        self.invalidate(dn)
+        lconn, ldap_conn = self._connect()
+        lconn._complainIfReadOnly()
+        msgid = ldap_conn.delete_ext(escape_dn(lconn._encode_incoming(dn)))
+        def deleted(results):
+            self.invalidate(dn)
+            return True
+        def failed(error):
+            self.invalidate(dn)
+            raise error
+        return self._operation(ldap_conn, msgid, callback=deleted, errback=failed)
+
+    def close(self):
+        """abandon pending operations and close connections"""
+        for op in list(self._pending):
+            op.cancel()
+        if self._lconn is not None:
+            self._lconn.disconnect()
+            self._lconn = None
+        for ldap_conn in self._binders:
+            try:
+                ldap_conn.unbind_s()
+            except ldap.LDAPError:
+                pass
+        self._binders = []
@@ -7,8 +7,14 @@ except ImportError:
 from repoze.who.interfaces import IMetadataProvider
 from repoze.who.interfaces import IAuthenticator
 from afpy.ldap.connection import Connection
+from afpy.ldap.cache import LRUCache
+from afpy.ldap.utils import normalize_dn
+from afpy.ldap.utils import pbkdf2_sha256
+from afpy.ldap.utils import compare_digest
+from afpy.ldap import passwords
 from zope.interface import implements
 import logging
+import time
 import os
 
 __doc__ = """This is a set of plugins for repoze.what"""
@@ -17,6 +23,11 @@ log = logging.getLogger(__name__)
 
 CONNECTION_KEY = 'afpy.ldap.connection'
 
+# group tokens stored in auth tickets. The marker contains the time of the
+# lookup
+GROUP_TOKEN = 'group:'
+GROUP_TOKENS_MARKER = 'groups@'
+
 def as_bool(value):
     if value in (True, False, 0, 1):
         return bool(value)
@@ -25,6 +36,96 @@ def as_bool(value):
             return True
     return False
 
+def as_int(value, default=0):
+    if value in (None, ''):
+        return default
+    return int(value)
+
+def groups_to_tokens(groups, now=None):
+    """return ticket tokens for groups. Return () if a group name can't be
+    stored in a ticket"""
+    if now is None:
+        now = time.time()
+    tokens = ['%s%d' % (GROUP_TOKENS_MARKER, now)]
+    for group in groups:
+        group = str(group)
+        if not group or ',' in group or '!' in group:
+            log.warn('Group %r can not be stored in a ticket', group)
+            return ()
+        tokens.append(GROUP_TOKEN + group)
+    return tuple(tokens)
+
+def groups_from_tokens(tokens, max_age=0, now=None):
+    """return the groups stored in tokens. Return None if there is no groups
+    or if they are older than max_age seconds"""
+    lookup = None
+    groups = []
+    for token in tokens or ():
+        if token.startswith(GROUP_TOKEN):
+            groups.append(token[len(GROUP_TOKEN):])
+        elif token.startswith(GROUP_TOKENS_MARKER):
+            try:
+                lookup = int(token[len(GROUP_TOKENS_MARKER):])
+            except ValueError:
+                return None
+    if lookup is None:
+        return None
+    if max_age:
+        if now is None:
+            now = time.time()
+        if lookup + max_age < now:
+            return None
+    return groups
+
+def is_group_token(token):
+    return token.startswith(GROUP_TOKEN) or token.startswith(GROUP_TOKENS_MARKER)
+
+class CacheMixin(object):
+    """Cache results of ``_find_sections``. Cache is enabled when ``ttl`` is
+    set. The :meth:`invalidate` method is registered as an invalidation hook
+    of the connection unless ``invalidate`` is false"""
+
+    cache = None
+    # name of the cache in Connection.caches
+    cache_name = None
+
+    def setup_cache(self, size=1000, ttl=0, invalidate=True):
+        size = as_int(size, 1000)
+        ttl = as_int(ttl, 0)
+        if size > 0 and ttl > 0:
+            self.cache = LRUCache(size, ttl)
+            if self.cache_name:
+                self.conn.caches[self.cache_name] = self.cache
+            if as_bool(invalidate):
+                self.conn.invalidation_hooks.append(self.invalidate)
+
+    def invalidate(self, dn=None):
+        """remove dn from the cache. The whole cache is cleared if dn is
+        None or a group/permission"""
+        if self.cache is None:
+            return
+        if dn is None:
+            self.cache.invalidate()
+            return
+        dn = normalize_dn(dn)
+        self.cache.invalidate(dn)
+        for klass in (self.conn.group_class, self.conn.perm_class):
+            base_dn = klass and klass.base_dn
+            if base_dn and dn.endswith(normalize_dn(base_dn)):
+                self.cache.invalidate()
+                break
+
+    def cached_sections(self, key, func, *args):
+        """return func(*args) or the cached value for key"""
+        if self.cache is None or not key:
+            return func(*args)
+        key = normalize_dn(key)
+        value = self.cache.get(key)
+        if value is None:
+            value = list(func(*args))
+            self.cache.set(key, value)
+        return list(value)
+
 class BaseAdapter(object):
 
     use_search = False
@@ -49,61 +150,200 @@ class BaseAdapter(object):
                     else:
                         return user.data and user or None
 
-class GroupAdapter(BaseSourceAdapter, BaseAdapter):
-    """Group adapter.
+class GroupAdapter(BaseSourceAdapter, BaseAdapter, CacheMixin):
+    """Group adapter. Groups of a user are cached during
+    ``groups_cache_ttl`` seconds if set.
+
+    If ``group_tokens`` is set, groups stored in the ticket tokens of the
+    identity (see :func:`groups_to_tokens`) are used if they are not older
+    than ``group_tokens_max_age`` seconds (0 means no limit).
+
+    The cache is keyed by the dn of the user. With ``use_search`` the dn
+    found for a uid is kept as long as the groups.
     """
+    cache_name = 'groups'
+    # uid -> dn when users are searched
+    user_dns = None
 
-    def __init__(self, conn, use_groups=True, **kwargs):
+    def __init__(self, conn, use_groups=True, groups_cache_size=1000,
+                 groups_cache_ttl=0, cache_invalidation=True,
+                 group_tokens=False, group_tokens_max_age=600, **kwargs):
         self.conn = conn
         self.use_groups = as_bool(use_groups)
+        self.group_tokens = as_bool(group_tokens)
+        self.group_tokens_max_age = as_int(group_tokens_max_age, 600)
+        self.setup_cache(groups_cache_size, groups_cache_ttl, cache_invalidation)
+        if self.cache is not None:
+            self.user_dns = LRUCache(self.cache.size, self.cache.ttl)
         log.warn('GroupAdapter(%r, use_groups=%r, **%r)',
                     self.conn, self.use_groups, kwargs)
 
     def _find_sections(self, hint):
         if self.use_groups:
-            user = None
+            if self.group_tokens and 'tokens' in hint:
+                groups = groups_from_tokens(hint['tokens'],
+                                            self.group_tokens_max_age)
+                if groups is not None:
+                    return groups
             if 'user' in hint:
                 user = hint['user']
-            else:
-                uid = hint.get('repoze.what.userid', None)
-                if uid and isinstance(uid, basestring):
-                    user = self.get_user(uid)
-            if user:
-                return user.groups
+                return self.cached_sections(user.dn, self._get_groups, user)
+            uid = hint.get('repoze.what.userid', None)
+            if uid and isinstance(uid, basestring):
+                if self.use_search:
+                    return self._search_sections(uid)
+                key = self.conn.user_class.build_dn(uid)
+                return self.cached_sections(key, self._get_groups, None, uid)
         return []
 
+    def _search_sections(self, uid):
+        if self.cache is None:
+            return self._get_groups(None, uid)
+        dn = self.user_dns.get(uid)
+        if dn is not None:
+            return self.cached_sections(dn, self._get_groups, None, uid)
+        user = self.get_user(uid)
+        if not user:
+            return []
+        self.user_dns.set(uid, user.dn)
+        return self.cached_sections(user.dn, self._get_groups, user)
 
-class PermissionAdapter(BaseSourceAdapter):
-    """Permission adapter.
+    def _get_groups(self, user, uid=None):
+        if user is None:
+            user = self.get_user(uid)
+        if user:
+            return user.groups
+        return []
+
+
+class PermissionAdapter(BaseSourceAdapter, CacheMixin):
+    """Permission adapter. Permissions of a group are cached during
+    ``perms_cache_ttl`` seconds if set.
     """
+    cache_name = 'perms'
 
-    def __init__(self, conn, use_permissions=True, **kwargs):
+    def __init__(self, conn, use_permissions=True, perms_cache_size=1000,
+                 perms_cache_ttl=0, cache_invalidation=True, **kwargs):
         self.conn = conn
         self.use_permissions = as_bool(use_permissions)
+        self.setup_cache(perms_cache_size, perms_cache_ttl, cache_invalidation)
         log.warn('PermissionAdapter(%r, use_permissions=%r, **%r)',
                     self.conn, self.use_permissions, kwargs)
 
     def _find_sections(self, hint):
         if self.use_permissions:
-            klass = self.conn.perm_class or self.conn.group_class
             group = self.conn.get_group(hint, node_class=self.conn.group_class)
             if group:
-                rdn = klass.rdn
-                groups = self.conn.get_groups(group.dn, node_class=klass)
-                return [getattr(v, rdn) for v in  groups if getattr(v, rdn, '')]
+                return self.cached_sections(group.dn, self._get_permissions, group)
         return []
 
+    def _get_permissions(self, group):
+        klass = self.conn.perm_class or self.conn.group_class
+        rdn = klass.rdn
+        groups = self.conn.get_groups(group.dn, node_class=klass)
+        return [getattr(v, rdn) for v in  groups if getattr(v, rdn, '')]
+
 
 class Authenticator(BaseAdapter):
     """Authenticator plugin.
+
+    Successful binds are cached during ``auth_cache_ttl`` seconds if set. The
+    cache only store a salted PBKDF2 hash of the credentials.
+
+    If ``auth_failures_ttl`` is set, a user who failed to authenticate
+    ``auth_max_failures`` times is rejected without binding until no failure
+    occurs during ``auth_failures_ttl`` seconds.
+
+    If ``rehash_scheme`` is set (eg: ``ssha512`` or ``pbkdf2-sha256``), the
+    password of a user is hashed again with this scheme after a successful
+    bind if its current value use another one. See
+    :mod:`~afpy.ldap.passwords`. The value is read from the user node if
+    loaded. The last ``auth_cache_size`` checked users are not checked
+    again until they are modified.
     """
     implements(IAuthenticator)
 
-    def __init__(self, conn, use_search=False, **kwargs):
+    def __init__(self, conn, use_search=False, auth_cache_ttl=0,
+                 auth_cache_size=1000, auth_cache_rounds=1000,
+                 auth_failures_ttl=0, auth_max_failures=5,
+                 rehash_scheme=None, rehash_rounds=passwords.PBKDF2_ROUNDS,
+                 **kwargs):
         self.conn = conn
         self.use_search = use_search
+        self.rehash_scheme = rehash_scheme or None
+        self.rehash_rounds = as_int(rehash_rounds, passwords.PBKDF2_ROUNDS)
+        self.credentials = None
+        self.failures = None
+        self.rehashed = None
+        size = as_int(auth_cache_size, 1000)
+        ttl = as_int(auth_cache_ttl, 0)
+        if ttl > 0:
+            self.credentials = self.conn.caches['credentials'] = LRUCache(size, ttl)
+            self.rounds = as_int(auth_cache_rounds, 1000)
+            self.salt = os.urandom(16)
+        if self.rehash_scheme:
+            # dn whose password don't need to be hashed again
+            self.rehashed = LRUCache(size, 0)
+        if self.credentials is not None or self.rehashed is not None:
+            self.conn.invalidation_hooks.append(self.invalidate)
+        ttl = as_int(auth_failures_ttl, 0)
+        if ttl > 0:
+            self.failures = LRUCache(size, ttl)
+            self.max_failures = as_int(auth_max_failures, 5)
         log.warn('Authenticator(%r)', self.conn)
 
+    def invalidate(self, dn=None):
+        """forget cached credentials of dn"""
+        key = dn and normalize_dn(dn) or None
+        if self.credentials is not None:
+            self.credentials.invalidate(key)
+        if self.rehashed is not None:
+            self.rehashed.invalidate(key)
+
+    def check(self, user, password):
+        """check password for user. Use the caches if enabled"""
+        dn = normalize_dn(user.dn)
+        failures = self.failures
+        if failures is not None and failures.peek(dn, 0) >= self.max_failures:
+            log.warn('Too many authentication failures for %s', user.dn)
+            return False
+        credentials = self.credentials
+        if credentials is not None:
+            digest = pbkdf2_sha256(password, self.salt + dn, self.rounds)
+            cached = credentials.get(dn)
+            if cached is not None and compare_digest(cached, digest):
+                return True
+        if user.check(password):
+            if self.rehash_scheme:
+                self.rehash(user, password)
+            if credentials is not None:
+                credentials.set(dn, digest)
+            if failures is not None:
+                failures.invalidate(dn)
+            return True
+        if credentials is not None:
+            credentials.invalidate(dn)
+        if failures is not None:
+            failures.set(dn, failures.peek(dn, 0) + 1)
+        return False
+
+    def rehash(self, user, password):
+        """store password with ``rehash_scheme`` if needed"""
+        dn = normalize_dn(user.dn)
+        if self.rehashed is not None and self.rehashed.get(dn):
+            return False
+        values = passwords.get_values(user._data or {}) or None
+        try:
+            result = passwords.rehash(self.conn, user.dn, password,
+                                      self.rehash_scheme, self.rehash_rounds,
+                                      values=values)
+        except Exception, e:
+            log.error('Error while hashing the password of %s: %s', user.dn, e)
+            return False
+        if self.rehashed is not None:
+            self.rehashed.set(dn, True)
+        return result
+
     def authenticate(self, environ, identity):
         if CONNECTION_KEY not in environ:
             environ[CONNECTION_KEY] = self.conn
@@ -111,7 +351,7 @@ class Authenticator(BaseAdapter):
         password = identity.get('password', '')
         user = self.get_user(login)
         if user is not None and password:
-            if user.check(password):
+            if self.check(user, password):
                 rdn = self.conn.user_class._rdn
                 uid = str(getattr(user, rdn))
                 identity['login'] = login
@@ -15,12 +15,15 @@ import os
 
 log = logging.getLogger(__name__)
 
+# environ key of the (data, key) tuple returned by TicketValidator.lookup()
+TICKET_KEY = 'afpy.ldap.authtkt'
+
 
 class AuthTktCookiePlugin(object):
 
     implements(IIdentifier)
 
-    def __init__(self, cookie_name):
+    def __init__(self, cookie_name, group_tokens=False, group_tokens_max_age=600):
         from ConfigObject import ConfigObject
 
         cfg = ConfigObject(filename=os.path.expanduser('~/.afpy.cfg'))
@@ -28,6 +31,24 @@ class AuthTktCookiePlugin(object):
         self.secret = '%s' % cfg.authtkt.shared_secret
         self.timeout = int(cfg.authtkt.timeout)
         self.cookie_name = '%s' % cfg.authtkt.cookie_name
+        # secrets still accepted after a rotation, one per line. Tickets are
+        # issued again with shared_secret:
+        #   previous_secrets =
+        #       old secret
+        #       older secret
+        previous_secrets = ('%s' % cfg.authtkt.get('previous_secrets', '')).splitlines()
+        previous_secrets = [s.strip() for s in previous_secrets if s.strip()]
+        self.validator = tktauth.TicketValidator(
+                            self.secret, timeout=self.timeout,
+                            mod_auth_tkt=True,
+                            cache_size=int(cfg.authtkt.get('cache_size', 1000)),
+                            previous_secrets=previous_secrets)
+        # sliding expiration: issue a new ticket when it expire in less than
+        # reissue_window seconds
+        self.reissue_window = auth.as_int(cfg.authtkt.get('reissue_window', ''), None)
+        # store groups of the identity in tickets. See auth.GroupAdapter
+        self.group_tokens = auth.as_bool(group_tokens)
+        self.group_tokens_max_age = auth.as_int(group_tokens_max_age, 600)
 
     # IIdentifier
     def identify(self, environ):
@@ -37,15 +58,10 @@ class AuthTktCookiePlugin(object):
         if cookie is None or not cookie.value:
             return None
 
-        try:
-            token = binascii.a2b_base64(cookie.value)
-        except binascii.Error:
-            data = None
-        else:
-            data = tktauth.validateTicket(self.secret, token,
-                                          timeout=self.timeout,
-                                          now=time.time(),
-                                          mod_auth_tkt=True)
+        # remember() use the result
+        result = environ[TICKET_KEY] = \
+                self.validator.lookup(cookie.value, decode=True)
+        data = result[0]
         if not data:
             return None
 
@@ -85,38 +101,49 @@ class AuthTktCookiePlugin(object):
         existing = cookies.get(self.cookie_name)
         old_cookie_value = getattr(existing, 'value', None)
 
-        timestamp, userid, tokens, userdata = None, '', '', ''
+        timestamp, userid, tokens, user_data = None, '', (), ''
+        key = None
 
         if old_cookie_value:
-            try:
-                old_cookie_value = binascii.a2b_base64(old_cookie_value)
-            except binascii.Error:
-                pass
+            if TICKET_KEY in environ:
+                # already validated by identify()
+                data, key = environ[TICKET_KEY]
             else:
-                data = tktauth.validateTicket(self.secret, old_cookie_value,
-                                              timeout=self.timeout,
-                                              now=time.time(),
-                                              mod_auth_tkt=True)
-                if data:
-                    (digest, userid, tokens, user_data, timestamp) = data
+                data, key = self.validator.lookup(old_cookie_value, decode=True)
+            if data:
+                (digest, userid, tokens, user_data, timestamp) = data
 
         who_userid = identity['repoze.who.userid']
-        who_tokens = identity.get('tokens', '')
+        who_tokens = identity.get('tokens', ())
         who_userdata = identity.get('userdata', '')
 
-        if not isinstance(tokens, basestring):
-            tokens = ','.join(tokens)
-        if not isinstance(who_tokens, basestring):
-            who_tokens = ','.join(who_tokens)
-        old_data = (userid, tokens, userdata)
+        if isinstance(who_tokens, basestring):
+            who_tokens = [t for t in who_tokens.split(',') if t]
+        who_tokens = tuple(who_tokens)
+        if self.group_tokens and 'groups' in identity:
+            if auth.groups_from_tokens(who_tokens,
+                                       self.group_tokens_max_age) is None:
+                # groups were retrieved from the directory
+                who_tokens = tuple([t for t in who_tokens
+                                      if not auth.is_group_token(t)]) + \
+                             auth.groups_to_tokens(identity['groups'])
+        if userid != who_userid:
+            timestamp = None
+        old_data = (userid, tuple(tokens), user_data)
         new_data = (who_userid, who_tokens, who_userdata)
-        if old_data != new_data:
-            ticket = tktauth.createTicket(self.secret, who_userid,
-                                          timestamp=timestamp,
-                                          mod_auth_tkt=True)
-            if old_cookie_value != ticket:
+        # key is not 0 when the ticket was signed with a previous secret
+        reissue = old_data != new_data or key
+        if timestamp and self.reissue_window is not None:
+            if timestamp + self.timeout - time.time() < self.reissue_window:
+                reissue = True
+                timestamp = None
+        if reissue:
+            ticket = self.validator.createTicket(who_userid, who_tokens,
+                                                 who_userdata,
+                                                 timestamp=timestamp)
+            cookie = binascii.b2a_base64(ticket).rstrip()
+            if old_cookie_value != cookie:
                 # return a set of Set-Cookie headers
-                cookie = binascii.b2a_base64(ticket).rstrip()
                 return self._get_cookies(environ, cookie)
 
     def __repr__(self):
@@ -133,11 +160,14 @@ class Authenticator(auth.Authenticator):
             return cn
 
 
-def make_auth(app, global_config, **local_config):
+def make_auth(app, global_config, conn=None, **local_config):
 
-    conn = ldap.get_conn()
+    if not conn:
+        conn = ldap.get_conn()
 
-    cookie = AuthTktCookiePlugin('__ac')
+    cookie = AuthTktCookiePlugin('__ac',
+                    group_tokens=local_config.get('group_tokens', False),
+                    group_tokens_max_age=local_config.get('group_tokens_max_age', 600))
 
     loginform = FriendlyFormPlugin(login_form_url="/membres/login",
                                    login_handler_path="/do_login",
@@ -160,9 +190,9 @@ def make_auth(app, global_config, **local_config):
         challengers = [("loginform", loginform)]
 
     authenticators = [("accounts", Authenticator(conn))]
-    groups = {'all_groups': auth.GroupAdapter(conn)}
-    permissions = {'all_perms': auth.PermissionAdapter(conn,
-                                                       use_permissions=False)}
+    groups = {'all_groups': auth.GroupAdapter(conn, **local_config)}
+    perms_config = dict(local_config, use_permissions=False)
+    permissions = {'all_perms': auth.PermissionAdapter(conn, **perms_config)}
     mdproviders = [("accounts", auth.MDPlugin(conn))]
 
     return setup_auth(app,
@@ -27,6 +27,17 @@ in your paste config file:
     #use_groups = false
     #use_permissions = false
 
+    # cache groups of users and permissions of groups (in seconds)
+    #groups_cache_ttl = 60
+    #groups_cache_size = 1000
+    #perms_cache_ttl = 60
+    #perms_cache_size = 1000
+
+    # cache successful binds and reject users after 5 failures (in seconds)
+    #auth_cache_ttl = 300
+    #auth_failures_ttl = 60
+    #auth_max_failures = 5
+
     # and if you dont want to use ~/.ldap.cfg
     #config = %%(here)s/ldap.cfg
 
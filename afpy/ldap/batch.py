@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+#Copyright (C) 2009 Gael Pasgrimaud
+__doc__ = """Pipelined write operations.
+
+In a :meth:`~afpy.ldap.connection.Connection.batch` block ``add``, ``save``
+and ``delete`` are sent without waiting for the server's response. Up to
+``ldap.batch_window`` requests are kept in flight. Errors are collected and
+available when the block exit:
+
+.. sourcecode:: py
+
+    with conn.batch() as batch:
+        for user in users:
+            user.membershipExpirationDate = expire
+            user.save()
+    for action, dn, error in batch.errors:
+        print action, dn, error
+
+Operations on a dn wait for pending operations on its parents and children
+so an entry can be added and then modified in the same batch.
+
+Errors are only known at the end of the batch. ``Node.save()`` can't fall
+back to ``add`` when the entry does not exist. Saving a node whose rdn
+changed wait for the pending operations and rename the entry without
+pipelining.
+"""
+from collections import deque
+import connection
+import logging
+import ldap
+
+log = logging.getLogger(__name__)
+
+
+class BatchError(ldap.LDAPError):
+    """raised by :meth:`Batch.check` with the list of failed operations"""
+
+    def __init__(self, errors):
+        ldap.LDAPError.__init__(self, '%s operations failed' % len(errors))
+        self.errors = errors
+
+
+class Batch(object):
+    """queue of write operations sent with the async python-ldap API"""
+
+    def __init__(self, conn, lconn, window=32):
+        self.conn = conn
+        self.lconn = lconn
+        self.window = max(int(window), 1)
+        self.results = []
+        self._pending = deque()
+
+    @property
+    def errors(self):
+        """list of ``(action, dn, error)`` for failed operations"""
+        return [r for r in self.results if r[2] is not None]
+
+    def add(self, node):
+        node._conn = self.conn
+        attrs = connection.node_attributes(node)
+        lconn = self.lconn
+        lconn._complainIfReadOnly()
+        self.conn.invalidate(node.dn)
+        return self._send('add', node.dn, lambda ldap_conn, dn:
+            ldap_conn.add_ext(dn, connection.add_attributes(lconn, attrs)),
+            node=node)
+
+    def add_entry(self, dn, entry):
+        """add an entry as is. dn and values must use the server's
+        encoding (utf-8)"""
+        self.lconn._complainIfReadOnly()
+        self.conn.invalidate(self.lconn._encode_outgoing(dn))
+        return self._send('add', dn, lambda ldap_conn, dn:
+            ldap_conn.add_ext(dn, entry.items()), encode=False)
+
+    def save(self, node):
+        if not (node._data and node.dn):
+            return False
+        node._conn = self.conn
+        modlist = node._modlist()
+        if modlist is None and node._renamed():
+            # the entry must be renamed. let Connection.save() do it
+            return self._serial('save', node, self.conn._save)
+        if modlist is None:
+            # no snapshot. don't spend a round trip to compute a diff
+            attrs = node._data.copy()
+            attrs.pop('dn', None)
+            modlist = connection.replace_modlist(attrs)
+        if not modlist:
+            node._clear()
+            return True
+        lconn = self.lconn
+        lconn._complainIfReadOnly()
+        self.conn.invalidate(node.dn)
+        return self._send('save', node.dn, lambda ldap_conn, dn:
+            ldap_conn.modify_ext(dn, connection.encode_modlist(lconn, modlist)),
+            node=node)
+
+    def delete(self, node):
+        self.lconn._complainIfReadOnly()
+        node._clear()
+        self.conn.invalidate(node.dn)
+        return self._send('delete', node.dn, lambda ldap_conn, dn:
+            ldap_conn.delete_ext(dn), node=node)
+
+    def _serial(self, action, node, func):
+        """wait for pending operations and call func(node)"""
+        self.wait()
+        dn = node.dn
+        try:
+            func(node)
+        except ldap.LDAPError, e:
+            log.error('Error while %s %s: %s', action, dn, e)
+            self.results.append((action, dn, e))
+        else:
+            self.results.append((action, dn, None))
+        return True
+
+    def _send(self, action, dn, request, node=None, encode=True):
+        key = connection.normalize_dn(dn)
+        while self._pending and (len(self._pending) >= self.window or
+                                 self._conflicts(key)):
+            self._complete()
+        ldap_conn = self.lconn.connect(bind_dn=self.conn.bind_dn,
+                                       bind_pwd=self.conn.bind_pw)
+        if encode:
+            msgid = request(ldap_conn,
+                            connection.escape_dn(self.lconn._encode_incoming(dn)))
+        else:
+            msgid = request(ldap_conn, dn)
+        # dn to invalidate when the operation is complete
+        api_dn = encode and dn or self.lconn._encode_outgoing(dn)
+        self._pending.append((msgid, action, dn, node, key, api_dn))
+        return True
+
+    def _conflicts(self, key):
+        """True if a pending operation is on key, a parent or a child"""
+        for msgid, action, dn, node, pending, api_dn in self._pending:
+            if pending == key or key.endswith(',' + pending) or \
+               pending.endswith(',' + key):
+                return True
+        return False
+
+    def _complete(self):
+        """wait for the oldest pending operation"""
+        msgid, action, dn, node, key, api_dn = self._pending.popleft()
+        ldap_conn = self.lconn.connect(bind_dn=self.conn.bind_dn,
+                                       bind_pwd=self.conn.bind_pw)
+        try:
+            try:
+                ldap_conn.result3(msgid, all=1)
+            finally:
+                # a get_dn() may have cached the entry during the write
+                self.conn.invalidate(api_dn)
+        except ldap.LDAPError, e:
+            log.error('Error while %s %s: %s', action, dn, e)
+            self.results.append((action, dn, e))
+            if isinstance(e, ldap.SERVER_DOWN):
+                # the other responses are lost
+                self._abort(e)
+        else:
+            if node is not None:
+                node._clear()
+            self.results.append((action, dn, None))
+
+    def _abort(self, error):
+        while self._pending:
+            msgid, action, dn, node, key, api_dn = self._pending.popleft()
+            self.conn.invalidate(api_dn)
+            self.results.append((action, dn, error))
+
+    def wait(self):
+        """wait for all pending operations"""
+        while self._pending:
+            self._complete()
+
+    def check(self):
+        """raise a :class:`BatchError` if some operations failed"""
+        errors = self.errors
+        if errors:
+            raise BatchError(errors)
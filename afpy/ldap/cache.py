@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+#Copyright (C) 2009 Gael Pasgrimaud
+__doc__ = """A small thread safe LRU cache with a time to live:
+
+.. sourcecode:: py
+
+    >>> cache = LRUCache(size=2, ttl=60)
+    >>> cache.set('a', 1)
+    >>> cache.set('b', 2)
+    >>> cache.get('a')
+    1
+    >>> cache.set('c', 3)
+    >>> cache.get('b') is None
+    True
+    >>> sorted(cache.stats().items())
+    [('hits', 1), ('misses', 1), ('ratio', 0.5), ('size', 2)]
+
+"""
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache(object):
+    """A mapping which keep at most ``size`` items during ``ttl`` seconds"""
+
+    def __init__(self, size=1000, ttl=300):
+        self.size = int(size)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """return the value for key or default. Expired items are removed"""
+        self._lock.acquire()
+        try:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if self.ttl and expires < time.time():
+                self.misses += 1
+                return default
+            self._data[key] = (expires, value)
+            self.hits += 1
+            return value
+        finally:
+            self._lock.release()
+
+    def peek(self, key, default=None):
+        """like get but don't update statistics and lru order"""
+        item = self._data.get(key)
+        if item is None or (self.ttl and item[0] < time.time()):
+            return default
+        return item[1]
+
+    def set(self, key, value):
+        """store a value. The least recently used item is removed when the
+        cache is full"""
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+            while len(self._data) >= self.size:
+                self._data.popitem(last=False)
+            self._data[key] = (time.time() + (self.ttl or 0), value)
+        finally:
+            self._lock.release()
+
+    def invalidate(self, key=None):
+        """remove key from the cache. Clear the cache if key is None"""
+        self._lock.acquire()
+        try:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """return cache statistics as a dict"""
+        total = self.hits + self.misses
+        return dict(size=len(self._data), hits=self.hits, misses=self.misses,
+                    ratio=total and float(self.hits) / total or 0.)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return '<%s %s/%s items>' % (self.__class__.__name__,
+                                     len(self._data), self.size)
+
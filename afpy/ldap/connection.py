@@ -10,13 +10,25 @@ __doc__ = """This module provide a ldap connection configurable via a .ini file
 """
 import ldap
 import ldap.ldapobject
+import ldap.dn
 import _ldap
+from ldap.controls import SimplePagedResultsControl
+from ldap.filter import escape_filter_chars
 from ConfigObject import ConfigObject
 from ConfigParser import NoOptionError
 from node import Node, User, GroupOfNames, GroupOfUniqueNames
+from pool import ConnectionPool
+from cache import LRUCache
 from ldap.ldapobject import ReconnectLDAPObject
 from afpy.ldap.utils import resolve_class
+from afpy.ldap.utils import normalize_dn
+from afpy.ldap import utils
+from afpy.ldap import stats
+from afpy.ldap import identity
+from contextlib import contextmanager
+import threading
 import logging
+import time
 import os
 
 log = logging.getLogger(__name__)
@@ -108,12 +120,14 @@ class Connection(object):
     user_class = User
     group_class = GroupOfNames
     perm_class = None
-    def __init__(self, section='ldap', prefix='ldap.', filename=os.path.expanduser('~/.ldap.cfg')):
-        self.config = ConfigObject()
-        self.config.read([filename])
+    def __init__(self, section='ldap', prefix='ldap.', filename=os.path.expanduser('~/.ldap.cfg'),
+                 config=None):
+        if config is None:
+            config = ConfigObject()
+            config.read([filename])
+        self.config = config
         self.prefix = prefix
         self.section = self.config[section]
-        self._conn = self.connection_factory()
         try:
             self.bind_dn = self.get('bind_dn')
             self.bind_pw = self.get('bind_pwd')
@@ -121,6 +135,38 @@ class Connection(object):
         except Exception, e:
             raise e.__class__('Invalid configuration %s - %s' % (section, self.section))
 
+        pool_size = self.get_int('pool_size', 5)
+        options = dict(max_overflow=self.get_int('pool_max_overflow', 10),
+                       timeout=self.get_int('pool_timeout', 30),
+                       recycle=self.get_int('pool_recycle', 3600),
+                       ping=self.get_int('pool_ping', 60))
+        self.pool = ConnectionPool(self.connection_factory,
+                                   size=pool_size, **options)
+        self.bind_pool = ConnectionPool(self.connection_factory,
+                                        size=self.get_int('bind_pool_size', pool_size),
+                                        reset_bind=True, **options)
+        self.page_size = self.get_int('page_size', 0)
+        self.batch_size = self.get_int('batch_size', 100)
+        self.batch_window = self.get_int('batch_window', 32)
+        self._local = threading.local()
+
+        self.cache = None
+        self.invalidation_hooks = []
+        # name -> LRUCache. Used by stats
+        self.caches = {}
+        cache_size = self.get_int('cache_size', 0)
+        if cache_size:
+            self.cache = self.caches['dn'] = LRUCache(cache_size,
+                                                      self.get_int('cache_ttl', 60))
+
+        self.stats = None
+        self.operation_hooks = []
+        if self.get('stats', 'false').lower() in ('true', '1', 'on'):
+            self.stats = stats.Stats(slow_threshold=self.get_float('slow_threshold', 0),
+                                     slow_log_size=self.get_int('slow_log_size', 100),
+                                     caches=self.caches)
+            self.operation_hooks.append(self.stats)
+
         for name in ('user', 'group', 'perm', 'node'):
             attr = '%s_class' % name
             klass = self.get('%s_class' % name, None)
@@ -133,12 +179,44 @@ class Connection(object):
         if self.group_class.member_nodes.item_class is not self.user_class:
             self.group_class.member_nodes.item_class = self.user_class
 
+        self.replica = None
+        mode = self.get('replica', None)
+        if mode:
+            bases = self.get('replica_bases', None)
+            if bases:
+                bases = [b.strip() for b in bases.split(';') if b.strip()]
+            self.replica = Replica(self, bases=bases or None, mode=mode,
+                                   interval=self.get_int('replica_interval', 60),
+                                   max_staleness=self.get_int('replica_max_staleness', 300),
+                                   page_size=self.page_size or 500,
+                                   full_scan_interval=self.get_int('replica_full_scan_interval', 600))
+            self.invalidation_hooks.append(self.replica.invalidate)
+            self.replica.start()
+
     def get(self, key, default=None):
         try:
             return self.section[self.prefix+key]
         except (NoOptionError, KeyError):
             return default
 
+    def get_int(self, key, default=0):
+        value = self.get(key, None)
+        if value in (None, ''):
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError('%s%s must be an integer. Got %s' % (self.prefix, key, value))
+
+    def get_float(self, key, default=0.):
+        value = self.get(key, None)
+        if value in (None, ''):
+            return default
+        try:
+            return float(value)
+        except ValueError:
+            raise ValueError('%s%s must be a number. Got %s' % (self.prefix, key, value))
+
     def connection_factory(self, *args, **kwargs):
         config = dict(self.section.items())
         conn = ldapconnection_from_config(config, prefix=self.prefix)
@@ -163,16 +241,32 @@ class Connection(object):
             if not klass.rdn:
                 klass._rdn = self.get('%s_rdn' % lname, None)
 
+    def _notify(self, op, start, options=None, **kwargs):
+        """call ``operation_hooks`` with a :class:`~afpy.ldap.stats.Event`.
+        options are search options"""
+        if not self.operation_hooks:
+            return
+        if options:
+            kwargs.setdefault('base_dn', options.get('base_dn'))
+            kwargs.setdefault('scope', options.get('scope'))
+            kwargs.setdefault('filter', options.get('fltr', options.get('filter')))
+        event = stats.Event(op, time.time() - start, caller=stats.caller(), **kwargs)
+        for hook in self.operation_hooks:
+            hook(event)
+
     def check(self, dn, password):
         """check a password for a dn"""
+        start = time.time()
         try:
-            self.connection_factory().connect(dn, password)
+            with self.bind_pool.connection() as conn:
+                conn.connect(dn, password)
         except ldap.INVALID_CREDENTIALS, e:
+            self._notify('bind', start, base_dn=dn, error=e)
             return False
+        self._notify('bind', start, base_dn=dn)
         return True
 
-    def search(self, **kwargs):
-        """search"""
+    def _search_options(self, kwargs):
         if 'filter' in kwargs:
             kwargs['fltr'] = kwargs['filter']
             del kwargs['filter']
@@ -181,44 +275,322 @@ class Connection(object):
                        bind_dn=self.bind_dn,
                        bind_pwd=self.bind_pw)
         options.update(kwargs)
-        return self._conn.search(options.pop('base_dn'), options.pop('scope'), **options)['results']
-
-    def search_nodes(self, node_class=None, **kwargs):
-        """like search nut return :class:`~afpy.ldap.node.Node` objects"""
+        return options
+
+    def _replica_search(self, kwargs):
+        """return results from the replica or None"""
+        options = self._search_options(dict(kwargs))
+        if options['bind_dn'] != self.bind_dn:
+            return None
+        return self.replica.search(options['base_dn'], options['scope'],
+                                   options.get('fltr', '(objectClass=*)'),
+                                   options.get('attrs'))
+
+    def search(self, page_size=None, use_replica=True, **kwargs):
+        """search. If ``page_size`` is set, results are retrieved with the
+        Simple Paged Results control (RFC 2696) so the server's size limit
+        doesn't apply. Results come from the :mod:`~afpy.ldap.replica` if
+        any and ``use_replica`` is true"""
+        start = time.time()
+        if use_replica and self.replica is not None:
+            results = self._replica_search(kwargs)
+            if results is not None:
+                self._notify('search', start, self._search_options(dict(kwargs)),
+                             size=len(results), source='replica')
+                return results
+        if page_size:
+            return list(self.iter_search(page_size=page_size, use_replica=False, **kwargs))
+        options = self._search_options(kwargs)
+        info = dict(base_dn=options['base_dn'], scope=options['scope'],
+                    filter=options.get('fltr'))
+        try:
+            with self.pool.connection() as conn:
+                results = conn.search(options.pop('base_dn'), options.pop('scope'),
+                                      **options)['results']
+        except ldap.LDAPError, e:
+            self._notify('search', start, error=e, **info)
+            raise
+        self._notify('search', start, size=len(results), **info)
+        return results
+
+    def iter_search(self, page_size=None, raw=False, use_replica=True, **kwargs):
+        """like :meth:`search` but return a generator which yield entries as
+        they arrive from the server. Only one page of results is requested
+        at a time when ``page_size`` is set. Values are not converted to the
+        api encoding if ``raw`` is true"""
+        start = time.time()
+        info = dict(source='server', size=0)
+        error = None
+        try:
+            for entry in self._iter_search(page_size, raw, use_replica, kwargs, info):
+                info['size'] += 1
+                yield entry
+        except ldap.LDAPError, error:
+            raise
+        finally:
+            self._notify('search', start, self._search_options(dict(kwargs)),
+                         error=error, **info)
+
+    def _iter_search(self, page_size, raw, use_replica, kwargs, info):
+        if use_replica and not raw and self.replica is not None:
+            results = self._replica_search(kwargs)
+            if results is not None:
+                info['source'] = 'replica'
+                for entry in results:
+                    yield entry
+                return
+        options = self._search_options(kwargs)
+        with self.pool.connection() as lconn:
+            conn = lconn.connect(bind_dn=options['bind_dn'], bind_pwd=options['bind_pwd'])
+            base = escape_dn(lconn._encode_incoming(options['base_dn']))
+            fltr = lconn._encode_incoming(options.get('fltr', '(objectClass=*)'))
+            serverctrls = []
+            if page_size:
+                control = SimplePagedResultsControl(True, size=page_size, cookie='')
+                serverctrls.append(control)
+            while True:
+                msgid = conn.search_ext(base, options['scope'], fltr,
+                                        options.get('attrs'), serverctrls=serverctrls)
+                controls = []
+                for entry in self._iter_results(lconn, conn, msgid, controls, raw):
+                    yield entry
+                if not page_size:
+                    break
+                cookies = [c.cookie for c in controls
+                            if c.controlType == SimplePagedResultsControl.controlType]
+                if not cookies or not cookies[0]:
+                    break
+                control.cookie = cookies[0]
+
+    def _iter_results(self, lconn, conn, msgid, controls, raw=False):
+        """yield entries of a pending search one by one. Response controls
+        are appended to ``controls``. The search is abandoned if the
+        generator is not consumed"""
+        done = False
+        try:
+            while not done:
+                rtype, rdata, rmsgid, rctrls = conn.result3(msgid, all=0)
+                if rtype == ldap.RES_SEARCH_RESULT:
+                    controls.extend(rctrls)
+                    done = True
+                for dn, entry in rdata:
+                    if raw:
+                        if dn is not None:
+                            entry['dn'] = dn
+                            yield entry
+                        continue
+                    entry = convert_entry(lconn, dn, entry)
+                    if entry is not None:
+                        yield entry
+        finally:
+            if not done:
+                try:
+                    conn.abandon(msgid)
+                except ldap.LDAPError:
+                    pass
+
+    def _projection(self, node_class, kwargs):
+        """retrieve only node_class attributes if attrs is not specified"""
+        if 'attrs' not in kwargs:
+            attrs = node_class.attributes()
+            if attrs is not None:
+                kwargs['attrs'] = attrs
+        return kwargs.get('attrs')
+
+    def _node(self, node_class, entry, attrs, frozen=False):
+        if frozen:
+            return node_class.frozen_class().from_entry(entry['dn'], entry,
+                                                        conn=self, attrs=attrs)
+        node = node_class(dn=entry['dn'], attrs=entry, conn=self)
+        if attrs is not None:
+            node._set_partial(attrs)
+        node._set_snapshot(entry)
+        return node
+
+    def search_nodes(self, node_class=None, frozen=False, **kwargs):
+        """like search nut return :class:`~afpy.ldap.node.Node` objects. Only
+        the attributes of the node class are retrieved if ``attrs`` is not
+        specified. Return read only :class:`~afpy.ldap.node.FrozenNode`
+        objects if ``frozen`` is true"""
         node_class = node_class or self.node_class
-        return [node_class(dn=r['dn'], attrs=r, conn=self) for r in self.search(**kwargs)]
+        attrs = self._projection(node_class, kwargs)
+        return [self._node(node_class, r, attrs, frozen) for r in self.search(**kwargs)]
 
-    def get_dn(self, dn):
-        """return search result for dn"""
+    def iter_search_nodes(self, node_class=None, frozen=False, **kwargs):
+        """like :meth:`iter_search` but yield :class:`~afpy.ldap.node.Node` objects"""
+        node_class = node_class or self.node_class
+        attrs = self._projection(node_class, kwargs)
+        for r in self.iter_search(**kwargs):
+            yield self._node(node_class, r, attrs, frozen)
+
+    def get_dn(self, dn, attrs=None):
+        """return search result for dn. Only retrieve attrs if not None.
+        Results are cached if ``ldap.cache_size`` is set"""
+        start = time.time()
+        if self.replica is not None:
+            result = self.replica.lookup(dn, attrs)
+            if result is not None:
+                self._notify('get', start, base_dn=dn, size=1, source='replica')
+                return result
+        result = self._cache_get(dn, attrs)
+        if result is not None:
+            self._notify('get', start, base_dn=dn, size=1, source='cache')
+            return result
         try:
-            return self._conn.search(dn,
-                                 ldap.SCOPE_BASE,
-                                 bind_dn=self.bind_dn,
-                                 bind_pwd=self.bind_pw)
-        except:
+            with self.pool.connection() as conn:
+                result = conn.search(dn,
+                                     ldap.SCOPE_BASE,
+                                     attrs=attrs,
+                                     bind_dn=self.bind_dn,
+                                     bind_pwd=self.bind_pw)
+        except Exception, e:
+            self._notify('get', start, base_dn=dn, error=e)
             raise ValueError(dn)
-
+        self._notify('get', start, base_dn=dn, size=len(result['results']))
+        self._cache_set(dn, attrs, result)
+        return result
+
+    def _cache_get(self, dn, attrs=None):
+        """return a cached result for dn if it contains attrs"""
+        if self.cache is not None:
+            cached = self.cache.get(normalize_dn(dn))
+            if cached is not None:
+                cached_attrs, result = cached
+                if cached_attrs is None or (attrs is not None and
+                        cached_attrs.issuperset([a.lower() for a in attrs])):
+                    return copy_result(result)
+        return None
+
+    def _cache_set(self, dn, attrs, result):
+        """cache a result. Partial results are merged with the cached one"""
+        if self.cache is None or not result['results']:
+            return
+        key = normalize_dn(dn)
+        result = copy_result(result)
+        if attrs is not None and '*' not in attrs:
+            attrs = set([a.lower() for a in attrs])
+            cached = self.cache.peek(key)
+            if cached is not None:
+                cached_attrs, cached_result = cached
+                entry = cached_result['results'][0].copy()
+                entry.update(result['results'][0])
+                result['results'] = [entry]
+                if cached_attrs is None:
+                    attrs = None
+                else:
+                    attrs = attrs | cached_attrs
+        else:
+            attrs = None
+        self.cache.set(key, (attrs, result))
+
+    def get_nodes(self, dns, node_class=None):
+        """return :class:`~afpy.ldap.node.Node` objects for a list of dn.
+        Entries are retrieved with one OR-filtered search per parent dn and
+        ``ldap.batch_size`` dns instead of one search per node. Nodes are
+        returned in the same order as dns"""
+        node_class = node_class or self.node_class
+        attrs = node_class.attributes()
+        dns = list(dns)
+        entries = {}
+        batches = {}
+        identity_map = self._identity_map()
+        for dn in dns:
+            key = normalize_dn(dn)
+            if key in entries:
+                continue
+            if identity_map is not None and \
+               (key, node_class) in identity_map.nodes:
+                continue
+            result = self._cache_get(dn, attrs)
+            if result is not None:
+                entries[key] = result['results'][0]
+                continue
+            try:
+                parts = ldap.dn.str2dn(dn)
+            except ldap.DECODING_ERROR:
+                continue
+            if len(parts) < 2 or len(parts[0]) != 1:
+                # multi-valued rdn. Let the node be loaded lazily
+                continue
+            attr, value, flags = parts[0][0]
+            base = ldap.dn.dn2str(parts[1:])
+            batches.setdefault((normalize_dn(base), attr), (base, []))[1].append(value)
+
+        for (base_key, attr), (base, values) in batches.items():
+            for i in range(0, len(values), self.batch_size):
+                filter = '(|%s)' % ''.join(['(%s=%s)' % (attr, escape_filter_chars(v))
+                                            for v in values[i:i+self.batch_size]])
+                try:
+                    results = self.search(base_dn=base, scope=ldap.SCOPE_ONELEVEL,
+                                          filter=filter, attrs=attrs)
+                except ldap.NO_SUCH_OBJECT:
+                    continue
+                for r in results:
+                    entries[normalize_dn(r['dn'])] = r
+                    self._cache_set(r['dn'], attrs, dict(size=1, results=[r], exception=''))
+
+        nodes = []
+        for dn in dns:
+            entry = entries.get(normalize_dn(dn))
+            if entry:
+                node = node_class(dn=dn, attrs=entry, conn=self)
+                node._set_partial(attrs)
+                node._set_snapshot(entry)
+            else:
+                node = node_class(dn=dn, conn=self)
+            if identity_map is not None:
+                node = identity_map.register(node)
+            nodes.append(node)
+        return nodes
+
+    def invalidate(self, dn=None):
+        """remove dn from the cache. Clear the cache if dn is None. Callables
+        in ``invalidation_hooks`` are called with dn. This is done each time
+        a node is saved, added or deleted, before and after the write"""
+        if self.cache is not None:
+            self.cache.invalidate(dn and normalize_dn(dn) or None)
+        for hook in self.invalidation_hooks:
+            hook(dn)
+
+
+    def _identity_map(self):
+        """return the :class:`~afpy.ldap.identity.IdentityMap` of the
+        current thread if it use this connection"""
+        identity_map = identity.current()
+        if identity_map is not None and identity_map.conn is self:
+            return identity_map
+        return None
+
+    def _get_node(self, node_class, dn):
+        identity_map = self._identity_map()
+        if identity_map is not None:
+            return identity_map.get_node(node_class, dn)
+        return node_class(dn=dn, conn=self)
 
     def get_user(self, uid_or_dn, node_class=None):
         """return user as :class:`~afpy.ldap.node.User` object"""
         node_class = node_class or self.user_class
         dn = node_class.build_dn(uid_or_dn)
-        return node_class(dn=dn, conn=self)
+        return self._get_node(node_class, dn)
 
     def get_group(self, uid_or_dn, node_class=None):
         """return group as :class:`~afpy.ldap.node.GroupOfNames` object"""
         node_class = node_class or self.group_class
         dn = node_class.build_dn(uid_or_dn)
-        return node_class(dn=dn, conn=self)
+        return self._get_node(node_class, dn)
 
     def get_node(self, dn, node_class=None):
         """return :class:`~afpy.ldap.node.Node` for dn"""
         node_class = node_class or self.node_class
-        return node_class(dn=dn, conn=self)
+        return self._get_node(node_class, dn)
 
     def get_groups(self, dn, base_dn=None, node_class=None):
         """return groups for dn as :class:`~afpy.ldap.node.GroupOfNames`"""
         node_class = node_class or self.group_class
+        return self.search_nodes(node_class=node_class,
+                                 **self._groups_options(dn, base_dn, node_class))
+
+    def _groups_options(self, dn, base_dn, node_class):
         if base_dn is None:
             base_dn = node_class.base_dn
         objectClass = node_class._defaults.get('objectClass', ['groupOfNames'])
@@ -229,16 +601,50 @@ class Connection(object):
             else:
                 objectClass = 'groupOfNames'
         filter = '(&(objectClass=%s)(%s=%s))' % (objectClass, node_class._memberAttr, dn)
-        return self.search_nodes(node_class=node_class,
-                                 base_dn=base_dn,
-                                 scope=ldap.SCOPE_SUBTREE,
-                                 filter=filter,
-                                 bind_dn=self.bind_dn,
-                                 bind_pwd=self.bind_pw)
-
+        return dict(base_dn=base_dn,
+                    scope=ldap.SCOPE_SUBTREE,
+                    filter=filter,
+                    bind_dn=self.bind_dn,
+                    bind_pwd=self.bind_pw)
+
+
+    @contextmanager
+    def batch(self, window=None, raise_errors=False):
+        """context manager which pipeline the ``add``, ``save`` and
+        ``delete`` called in the current thread. Yield a
+        :class:`~afpy.ldap.batch.Batch`. At most ``window`` (default to
+        ``ldap.batch_window``) requests are in flight. A
+        :class:`~afpy.ldap.batch.BatchError` is raised at the end if
+        ``raise_errors`` is true and some operations failed"""
+        batch = getattr(self._local, 'batch', None)
+        if batch is not None:
+            # nested
+            yield batch
+            return
+        with self.pool.connection() as lconn:
+            batch = Batch(self, lconn, window or self.batch_window)
+            self._local.batch = batch
+            try:
+                yield batch
+            except:
+                self._local.batch = None
+                batch.wait()
+                raise
+            self._local.batch = None
+            batch.wait()
+        if raise_errors:
+            batch.check()
 
     def save(self, node):
-        """save a node"""
+        """save a node. If the node was loaded from the directory only the
+        modified attributes are sent"""
+        batch = getattr(self._local, 'batch', None)
+        if batch is not None:
+            return batch.save(node)
+        return self._save(node)
+
+    def _save(self, node):
+        """save a node without using the current batch"""
         if node._data and node.dn:
             node._conn = self
             attrs = node._data.copy()
@@ -246,42 +652,144 @@ class Connection(object):
                 dn = attrs.pop('dn')
                 if '=' not in dn or dn.lower() != node.dn.lower():
                     raise ValueError('Inconsistent dn for %r: %s %s' % (node, node.dn, dn))
+            modlist = node._modlist()
+            self.invalidate(node.dn)
+            start = time.time()
             try:
-                self._conn.modify(node.dn, attrs=attrs)
+                with self.pool.connection() as conn:
+                    if modlist is None:
+                        conn.modify(node.dn, attrs=attrs)
+                    elif modlist:
+                        conn._complainIfReadOnly()
+                        ldap_conn = conn.connect(bind_dn=self.bind_dn, bind_pwd=self.bind_pw)
+                        ldap_conn.modify_s(escape_dn(conn._encode_incoming(node.dn)),
+                                           encode_modlist(conn, modlist))
             except Exception, e:
+                self._notify('modify', start, base_dn=node.dn, error=e)
                 raise e.__class__('Error while saving %r: %s' % (node, e))
             else:
-                node._data = None
+                if modlist is None or modlist:
+                    self._notify('modify', start, base_dn=node.dn)
+                node._clear()
                 return True
+            finally:
+                # a get_dn() may have cached the entry during the write
+                self.invalidate(node.dn)
 
     def add(self, node):
         """add a new node"""
+        batch = getattr(self._local, 'batch', None)
+        if batch is not None:
+            return batch.add(node)
         node._conn = self
-        attrs = node._defaults.copy()
-        for k, v in node._data.items():
-            if v not in ('', [], None):
-                attrs[k] = v
-        if 'dn' in attrs:
-            dn = attrs.pop('dn')
-            if '=' not in dn or dn.lower() != node.dn.lower():
-                raise ValueError('Inconsistent dn for %r: %s %s' % (node, node.dn, dn))
+        attrs = node_attributes(node)
         rdn, base = node.dn.split(',', 1)
+        self.invalidate(node.dn)
+        start = time.time()
         try:
-            self._conn.insert(base, rdn, attrs=attrs)
+            with self.pool.connection() as conn:
+                conn.insert(base, rdn, attrs=attrs)
         except Exception, e:
+            self._notify('add', start, base_dn=node.dn, error=e)
             raise e.__class__('%s %s %s' % (e, node.dn, attrs))
         else:
-            node._data = None
+            self._notify('add', start, base_dn=node.dn)
+            node._clear()
+        finally:
+            self.invalidate(node.dn)
 
     def delete(self, node):
         """delete a node"""
-        node._data = None
-        self._conn.delete(node.dn)
+        identity_map = self._identity_map()
+        if identity_map is not None:
+            identity_map.forget(node)
+        batch = getattr(self._local, 'batch', None)
+        if batch is not None:
+            return batch.delete(node)
+        node._clear()
+        self.invalidate(node.dn)
+        start = time.time()
+        try:
+            with self.pool.connection() as conn:
+                conn.delete(node.dn)
+        except ldap.LDAPError, e:
+            self._notify('delete', start, base_dn=node.dn, error=e)
+            raise
+        finally:
+            self.invalidate(node.dn)
+        self._notify('delete', start, base_dn=node.dn)
 
 if not getattr(ldap.ldapobject, 'SmartLDAPObject', None):
     # LDAPConnection need this in 1.0b1
     ldap.ldapobject.SmartLDAPObject = SmartLDAPObject
 from dataflake.ldapconnection.connection import LDAPConnection
+from dataflake.ldapconnection.utils import BINARY_ATTRIBUTES
+from dataflake.ldapconnection.utils import escape_dn
+from batch import Batch
+from replica import Replica
+
+def copy_result(result):
+    """copy a search result so cached values can't be modified"""
+    result = result.copy()
+    result['results'] = [dict([(k, isinstance(v, list) and list(v) or v)
+                               for k, v in r.items()])
+                         for r in result['results']]
+    return result
+
+def replace_modlist(attrs):
+    """return a modlist replacing all attrs. Used for nodes which were not
+    loaded from the directory"""
+    modlist = []
+    for attr, value in sorted(attrs.items()):
+        values = [v for v in utils.to_values(value, attr) if v not in ('', None)]
+        modlist.append((ldap.MOD_REPLACE, attr, values or None))
+    return modlist
+
+def node_attributes(node):
+    """return the attributes used to add node. Raise a ValueError if the
+    dn of the values is not the node's dn"""
+    attrs = node._defaults.copy()
+    for k, v in node._data.items():
+        if v not in ('', [], None):
+            attrs[k] = v
+    if 'dn' in attrs:
+        dn = attrs.pop('dn')
+        if '=' not in dn or dn.lower() != node.dn.lower():
+            raise ValueError('Inconsistent dn for %r: %s %s' % (node, node.dn, dn))
+    return attrs
+
+def add_attributes(conn, attrs):
+    """encode attrs like ``LDAPConnection.insert`` do"""
+    attribute_list = []
+    for k, v in attrs.items():
+        if k.lower() not in BINARY_ATTRIBUTES:
+            if isinstance(v, basestring):
+                v = [x.strip() for x in v.split(';')]
+            v = [conn._encode_incoming(x) for x in utils.to_list(v)]
+        attribute_list.append((k, utils.to_list(v)))
+    return attribute_list
+
+def encode_modlist(conn, modlist):
+    """encode modlist values like ``LDAPConnection.modify`` do"""
+    encoded = []
+    for op, attr, values in modlist:
+        if values and attr.lower() not in BINARY_ATTRIBUTES:
+            values = [conn._encode_incoming(v) for v in values]
+        encoded.append((op, attr, values))
+    return encoded
+
+def convert_entry(conn, dn, entry):
+    """Encode a raw python-ldap entry like ``LDAPConnection.search`` do.
+    Return None for search references"""
+    try:
+        items = entry.items()
+    except AttributeError:
+        return None
+    for key, value in items:
+        if key.lower() not in BINARY_ATTRIBUTES:
+            entry[key] = [conn._encode_outgoing(v) for v in value]
+    entry['dn'] = conn._encode_outgoing(dn)
+    return entry
 
 def ldapconnection_from_config(config, prefix='ldap.', **kwargs):
     """This is useful to get an LDAPConnection from a ConfigParser section
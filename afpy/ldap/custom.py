@@ -19,6 +19,7 @@ from node import Node
 from node import GroupOfNames
 from node import User as BaseUser
 from utils import to_string, to_python
+from cache import LRUCache
 import schema
 
 DONATION = 'donation'
@@ -37,6 +38,12 @@ PAYMENTS_OPTIONS = {
 
 SUBSCRIBER_FILTER = '(&(objectClass=payment)(!(paymentObject=donation)))'
 
+PAGE_SIZE = 500
+
+# membership reports are cached during REPORT_TTL seconds
+REPORT_TTL = 60
+_reports = LRUCache(size=16, ttl=REPORT_TTL)
+
 class Payment(Node):
     """
     Initialize connection and user::
@@ -176,6 +183,7 @@ class User(BaseUser):
     def append(self, node, save=True):
         super(User, self).append(node, save=save)
         updateExpirationDate(self)
+        invalidateReports()
 
 class Group(GroupOfNames):
     _rdn = 'cn'
@@ -208,42 +216,116 @@ def getUserByTitle(title):
     res = conn.search_nodes(filter='(title=%s)' % title, node_class=User)
     return res[0]
 
+class MembershipReport(object):
+    """Compute the membership reports in a single paged pass over payments.
+    Only the attributes needed are retrieved:
+
+    .. sourcecode:: py
+
+        >>> report = MembershipReport(now=datetime.datetime(2010, 6, 1))
+        >>> report.add({'dn': 'paymentDate=20100101000000Z,uid=gawel,ou=members,dc=afpy,dc=org',
+        ...             'paymentDate': ['20100101000000Z'], 'paymentAmount': ['20'],
+        ...             'paymentObject': [PERSONNAL_MEMBERSHIP]})
+        >>> report.add({'dn': 'paymentDate=20080101000000Z,uid=bob,ou=members,dc=afpy,dc=org',
+        ...             'paymentDate': ['20080101000000Z'], 'paymentAmount': ['20'],
+        ...             'paymentObject': [PERSONNAL_MEMBERSHIP],
+        ...             'invoiceReference': ['awaiting check']})
+        >>> sorted(report.adherents), sorted(report.expired), sorted(report.awaiting)
+        (['gawel'], ['bob'], ['bob'])
+
+    """
+    attrs = ['paymentDate', 'paymentObject', 'paymentAmount', 'invoiceReference']
+
+    def __init__(self, min=365, max=None, now=None):
+        now = now or datetime.datetime.now()
+        self.start = now - datetime.timedelta(min)
+        self.end = max and now - datetime.timedelta(max) or None
+        # users with a membership payment between start and end
+        self.adherents = set()
+        # users with at least one payment
+        self.all_time = set()
+        # users with an awaiting payment
+        self.awaiting = set()
+
+    @property
+    def expired(self):
+        """users with a payment but no recent membership payment"""
+        return self.all_time - self.adherents
+
+    def add(self, entry):
+        """add a payment entry to the reports"""
+        uid = entry['dn'].split(',')[1].split('=')[1]
+        values = dict([(k.lower(), v and v[0] or '') for k, v in entry.items()
+                                                      if k != 'dn'])
+        self.all_time.add(uid)
+        if values.get('invoicereference', '').lower().startswith('awaiting'):
+            self.awaiting.add(uid)
+        if values.get('paymentobject', '').lower() == DONATION:
+            return
+        if not values.get('paymentamount'):
+            return
+        date = to_python(values.get('paymentdate'), datetime.datetime)
+        if date and date >= self.start and (self.end is None or date <= self.end):
+            self.adherents.add(uid)
+
+    def compute(self, conn):
+        for entry in conn.iter_search(filter='(objectClass=payment)',
+                                      attrs=self.attrs, page_size=PAGE_SIZE):
+            self.add(entry)
+        return self
+
+def invalidateReports():
+    """clear the cached membership reports. Called when payments change"""
+    _reports.invalidate()
+
+def getMembershipReport(min=365, max=None):
+    """return a :class:`MembershipReport`. Reports are cached during
+    ``REPORT_TTL`` seconds"""
+    key = (min, max)
+    report = _reports.get(key)
+    if report is None:
+        report = MembershipReport(min=min, max=max).compute(get_conn())
+        _reports.set(key, report)
+    return report
+
 def getAdherents(min=365, max=None):
     """ return users with a payment > now - min and < now - max
     """
-    min = to_string(datetime.datetime.now()-datetime.timedelta(min))
-    f = '(&%s(paymentAmount=*))' % SUBSCRIBER_FILTER
-    if max:
-        max = to_string(datetime.datetime.now()-datetime.timedelta(max))
-        f = '(&%s(&(paymentDate>=%s)(paymentDate<=%s)))' % (f, min,max)
-    else:
-        f = '(&%s(paymentDate>=%s))' % (f, min)
-    conn = get_conn()
-    members = conn.search(filter=f, attrs=['dn'])
-    members = [m['dn'].split(',')[1].split('=')[1] for m in members]
-    return set(members)
+    return set(getMembershipReport(min, max).adherents)
 
 def getAllTimeAdherents():
     """return users with at least one payment
     """
-    conn = get_conn()
-    return set([p['dn'].split(',')[1].split('=')[1] for p in conn.search(
-                        filter='(objectClass=payment)')])
+    return set(getMembershipReport().all_time)
 
 def getAwaitingPayments():
-    """return users with at least one payment
+    """return users with an awaiting payment
     """
-    conn = get_conn()
-    members = set([p['dn'].split(',')[1].split('=')[1] for p in conn.search(
-                        filter='(&(objectClass=payment)(invoiceReference=awaiting*))')])
-    return members
+    return set(getMembershipReport().awaiting)
 
 def getExpiredUsers():
     """return unregulirised users
     """
-    conn = get_conn()
-    members = getAllTimeAdherents() - getAdherents()
-    return members
+    return getMembershipReport().expired
+
+def getMembersByExpirationDate(after=None, before=None, conn=None):
+    """return users whose membershipExpirationDate is in the range. The
+    filtering is done by the server and only dns are retrieved"""
+    f = '(uid=*)'
+    if after:
+        f += '(membershipExpirationDate>=%s)' % to_string(after)
+    if before:
+        f += '(membershipExpirationDate<=%s)' % to_string(before)
+    if conn is None:
+        conn = get_conn()
+    members = conn.iter_search(filter='(&%s)' % f, attrs=['1.1'], page_size=PAGE_SIZE)
+    return set([m['dn'].split(',')[0].split('=')[1] for m in members])
+
+def getExpiringMembers(days=30, conn=None):
+    """return users whose membership expire in the next days"""
+    now = datetime.datetime.now()
+    return getMembersByExpirationDate(after=now, before=now+datetime.timedelta(days),
+                                      conn=conn)
 
 def getMembersOf(uid):
     """return user uids of group"""
@@ -259,19 +341,21 @@ def updateExpirationDate(user):
         expire = to_python(to_string(last.paymentDate), datetime.datetime)+datetime.timedelta(400)
         user.membershipExpirationDate = expire
         user.save()
+        invalidateReports()
     return last
 
 def applyToMembers(callback, filter=None):
-    import string
+    """call callback for each member. Members are processed as they arrive
+    from the server"""
     conn = get_conn()
     if filter:
-        filter='&((uid=%%s*)%s)' % filter
+        if not filter.startswith('('):
+            filter = '(%s)' % filter
+        filter = '(&(uid=*)%s)' % filter
     else:
-        filter='(uid=%s*)' % filter
-    for l in string.lowercase:
-        users = conn.search_nodes(node_class=User, filter = filter % l)
-        for u in users:
-            callback(u)
+        filter = '(uid=*)'
+    for u in conn.iter_search_nodes(node_class=User, filter=filter, page_size=PAGE_SIZE):
+        callback(u)
 
 def add_payment(u, paymentDate, amount=20, comment=''):
     """Add a payment to u"""
@@ -287,6 +371,7 @@ def add_payment(u, paymentDate, amount=20, comment=''):
         p.paymentObject = STUDENT_MEMBERSHIP
     p.invoiceReference = comment
     u.append(p)
+    invalidateReports()
     return p
 
 def main():
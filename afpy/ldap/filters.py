@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+#Copyright (C) 2009 Gael Pasgrimaud
+__doc__ = """Evaluate RFC 4515 search filters against entries in python.
+
+Used to answer searches from a :mod:`~afpy.ldap.replica`:
+
+.. sourcecode:: py
+
+    >>> entry = {'dn': 'uid=gawel,ou=members,dc=afpy,dc=org',
+    ...          'objectClass': ['top', 'person'], 'uid': ['gawel'],
+    ...          'cn': ['Gael Pasgrimaud'], 'birthDate': ['19750410000000Z']}
+    >>> match('(&(objectClass=person)(uid=Gawel))', entry)
+    True
+    >>> match('(|(cn=*pasgri*)(mail=*))', entry)
+    True
+    >>> match('(&(uid=*)(!(birthDate>=19800101000000Z)))', entry)
+    True
+    >>> match('(mail=*)', entry)
+    False
+    >>> parse('(&(uid=gawel)(cn=G*d))')
+    <And [<Equality uid='gawel'>, <Substrings cn=['g', None, 'd']>]>
+
+Matching is case insensitive. Extensible matches are not supported.
+"""
+from afpy.ldap.utils import normalize_dn
+import re
+
+# attributes with a DN syntax. Their values are compared as normalized dns
+DN_ATTRIBUTES = ('member', 'uniquemember')
+
+_escaped = re.compile(r'\\([0-9a-fA-F]{2})')
+
+
+def unescape(value):
+    """decode ``\\XX`` escapes"""
+    return _escaped.sub(lambda m: chr(int(m.group(1), 16)), value)
+
+def normalize_value(attr, value):
+    """return value in lower case. Values of :data:`DN_ATTRIBUTES` are
+    normalized with :func:`~afpy.ldap.utils.normalize_dn`"""
+    if attr.lower() in DN_ATTRIBUTES:
+        return normalize_dn(value)
+    return value.lower()
+
+def normalize(entry):
+    """return a dict with lower case keys and normalized values"""
+    data = {}
+    for k, v in entry.items():
+        if k == 'dn':
+            continue
+        if isinstance(v, basestring):
+            v = [v]
+        data.setdefault(k.lower(), []).extend([normalize_value(k, i) for i in v])
+    return data
+
+
+class Filter(object):
+
+    def match(self, entry):
+        """match an entry returned by :func:`normalize`"""
+        raise NotImplementedError()
+
+
+class And(Filter):
+
+    def __init__(self, filters):
+        self.filters = filters
+
+    def match(self, entry):
+        for f in self.filters:
+            if not f.match(entry):
+                return False
+        return True
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.filters)
+
+
+class Or(And):
+
+    def match(self, entry):
+        for f in self.filters:
+            if f.match(entry):
+                return True
+        return False
+
+
+class Not(Filter):
+
+    def __init__(self, filter):
+        self.filter = filter
+
+    def match(self, entry):
+        return not self.filter.match(entry)
+
+    def __repr__(self):
+        return '<Not %r>' % self.filter
+
+
+class Item(Filter):
+
+    def __init__(self, attr, value=None):
+        self.attr = attr.lower()
+        self.value = value
+
+    def match(self, entry):
+        for v in entry.get(self.attr, ()):
+            if self.compare(v):
+                return True
+        return False
+
+    def __repr__(self):
+        return '<%s %s=%r>' % (self.__class__.__name__, self.attr, self.value)
+
+
+class Presence(Item):
+
+    def match(self, entry):
+        return bool(entry.get(self.attr))
+
+
+class Equality(Item):
+
+    def __init__(self, attr, value):
+        Item.__init__(self, attr, normalize_value(attr, value))
+
+    def compare(self, value):
+        return value == self.value
+
+
+class GreaterOrEqual(Item):
+
+    def compare(self, value):
+        if value.isdigit() and self.value.isdigit():
+            return int(value) >= int(self.value)
+        return value >= self.value
+
+
+class LessOrEqual(Item):
+
+    def compare(self, value):
+        if value.isdigit() and self.value.isdigit():
+            return int(value) <= int(self.value)
+        return value <= self.value
+
+
+class Substrings(Item):
+    """value is a list of parts. None stand for ``*``"""
+
+    def __init__(self, attr, value):
+        Item.__init__(self, attr, value)
+        pattern = ''.join([p is None and '.*' or re.escape(p) for p in value])
+        self.regexp = re.compile('^%s$' % pattern, re.DOTALL)
+
+    def compare(self, value):
+        return self.regexp.match(value) is not None
+
+
+def _item(text):
+    i = text.find('=')
+    if i < 1:
+        raise ValueError('Invalid filter item %r' % text)
+    attr, value = text[:i], text[i+1:]
+    klass = {'>': GreaterOrEqual, '<': LessOrEqual, '~': Equality}.get(attr[-1])
+    if klass is not None:
+        return klass(attr[:-1].strip(), unescape(value).lower())
+    if ':' in attr:
+        raise ValueError('Extensible match is not supported: %r' % text)
+    attr = attr.strip()
+    if value == '*':
+        return Presence(attr)
+    if '*' in value:
+        parts = []
+        for i, part in enumerate(value.split('*')):
+            if i:
+                parts.append(None)
+            if part:
+                parts.append(unescape(part).lower())
+        return Substrings(attr, parts)
+    return Equality(attr, unescape(value).lower())
+
+def _parse(text, pos):
+    """parse the filter starting at pos. Return the filter and the position
+    after the closing parenthesis"""
+    if text[pos] != '(':
+        raise ValueError('Invalid filter %r at %s' % (text, pos))
+    pos += 1
+    op = text[pos]
+    if op in '&|!':
+        pos += 1
+        filters = []
+        while text[pos] == '(':
+            f, pos = _parse(text, pos)
+            filters.append(f)
+            while text[pos] == ' ':
+                pos += 1
+        if text[pos] != ')':
+            raise ValueError('Invalid filter %r at %s' % (text, pos))
+        if op == '&':
+            return And(filters), pos + 1
+        elif op == '|':
+            return Or(filters), pos + 1
+        if len(filters) != 1:
+            raise ValueError('Invalid not filter %r' % text)
+        return Not(filters[0]), pos + 1
+    end = text.find(')', pos)
+    if end < 0:
+        raise ValueError('Invalid filter %r' % text)
+    return _item(text[pos:end]), end + 1
+
+def parse(text):
+    """parse a filter string"""
+    text = text.strip()
+    if not text.startswith('('):
+        text = '(%s)' % text
+    try:
+        f, pos = _parse(text, 0)
+    except IndexError:
+        raise ValueError('Invalid filter %r' % text)
+    if text[pos:].strip():
+        raise ValueError('Invalid filter %r' % text)
+    return f
+
+def match(filter, entry):
+    """return True if entry match filter (a string or a :class:`Filter`)"""
+    if isinstance(filter, basestring):
+        filter = parse(filter)
+    return filter.match(normalize(entry))
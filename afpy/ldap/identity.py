@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+#Copyright (C) 2009 Gael Pasgrimaud
+__doc__ = """A request scoped identity map.
+
+While an :class:`IdentityMap` is active in the current thread,
+:meth:`~afpy.ldap.connection.Connection.get_user`, ``get_group``,
+``get_node`` and ``get_nodes`` return the same node instance for a dn so
+an entry is fetched once:
+
+.. sourcecode:: py
+
+    >>> from afpy.ldap.testing import memory_connection
+    >>> from afpy.ldap.node import User
+    >>> conn = memory_connection()
+    >>> dn = 'uid=gawel,ou=members,dc=afpy,dc=org'
+    >>> with IdentityMap(conn) as identity_map:
+    ...     user = conn.get_node(dn, node_class=User)
+    ...     user is conn.get_node(dn, node_class=User)
+    ...     user.mail = 'gael@afpy.org'
+    True
+    >>> conn.directory.get(dn)['mail']
+    ['gael@afpy.org']
+
+Modified nodes are saved in a :meth:`~afpy.ldap.connection.Connection.batch`
+when the block exit without error.
+
+:class:`IdentityMapMiddleware` use a map per request. The map is available
+in ``environ['afpy.ldap.identity_map']``. Put the middleware before the
+authentication middleware so the user found by the
+:class:`~afpy.ldap.auth.Authenticator` is the one used by the
+:class:`~afpy.ldap.auth.MDPlugin`, the adapters and the application:
+
+.. sourcecode:: py
+
+    app = make_auth_basic(app, {}, conn=conn)
+    app = IdentityMapMiddleware(app, conn)
+
+Nodes are kept until the end of the request. Use ``conn.search_nodes()`` to
+get fresh nodes.
+"""
+import threading
+import logging
+from afpy.ldap.utils import normalize_dn
+
+log = logging.getLogger(__name__)
+
+IDENTITY_MAP_KEY = 'afpy.ldap.identity_map'
+
+_local = threading.local()
+
+
+def current():
+    """return the identity map active in the current thread or None"""
+    return getattr(_local, 'identity_map', None)
+
+
+class IdentityMap(object):
+    """one node instance per dn and node class. Can be used as a context
+    manager which activate the map in the current thread"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        # (normalized dn, node class) -> node
+        self.nodes = {}
+        self._previous = None
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def get_node(self, node_class, dn):
+        """return the node for dn. Create it if needed"""
+        key = (normalize_dn(dn), node_class)
+        node = self.nodes.get(key)
+        if node is None:
+            node = self.nodes[key] = node_class(dn=dn, conn=self.conn)
+        return node
+
+    def register(self, node):
+        """return the node already registered for node's dn or register
+        node"""
+        key = (normalize_dn(node.dn), node.__class__)
+        return self.nodes.setdefault(key, node)
+
+    def forget(self, node):
+        self.nodes.pop((normalize_dn(node.dn), node.__class__), None)
+
+    def dirty(self):
+        """return modified nodes"""
+        return [n for n in self.nodes.values() if n._dirty and n._data]
+
+    def flush(self):
+        """save modified nodes in a batch. Raise a
+        :class:`~afpy.ldap.batch.BatchError` if some saves failed"""
+        nodes = self.dirty()
+        if not nodes:
+            return
+        with self.conn.batch(raise_errors=True):
+            for node in nodes:
+                self.conn.save(node)
+
+    def clear(self):
+        self.nodes.clear()
+
+    def activate(self):
+        self._previous = current()
+        _local.identity_map = self
+
+    def deactivate(self):
+        _local.identity_map = self._previous
+        self._previous = None
+
+    def __enter__(self):
+        self.activate()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            self.deactivate()
+            self.clear()
+
+
+class IdentityMapMiddleware(object):
+    """activate an :class:`IdentityMap` during each request. Modified nodes
+    are saved when the response is closed"""
+
+    def __init__(self, app, conn, flush=True):
+        self.app = app
+        self.conn = conn
+        self.flush = flush
+
+    def __call__(self, environ, start_response):
+        identity_map = IdentityMap(self.conn)
+        environ[IDENTITY_MAP_KEY] = identity_map
+        identity_map.activate()
+        try:
+            app_iter = self.app(environ, start_response)
+        except:
+            identity_map.deactivate()
+            identity_map.clear()
+            raise
+        return ClosingIterator(app_iter, identity_map, self.flush)
+
+
+class ClosingIterator(object):
+    """iterate over the response. Flush and deactivate the map on close()"""
+
+    def __init__(self, app_iter, identity_map, flush=True):
+        self.app_iter = app_iter
+        self.identity_map = identity_map
+        self.flush = flush
+        self._iter = iter(app_iter)
+        self._failed = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return self._iter.next()
+        except StopIteration:
+            raise
+        except:
+            self._failed = True
+            raise
+
+    def close(self):
+        identity_map = self.identity_map
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+            if self.flush and not self._failed:
+                identity_map.flush()
+        finally:
+            identity_map.deactivate()
+            identity_map.clear()
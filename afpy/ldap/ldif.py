@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+#Copyright (C) 2009 Gael Pasgrimaud
+from __future__ import absolute_import
+__doc__ = """Streaming LDIF import and export.
+
+Entries are read one by one so files of any size can be processed:
+
+.. sourcecode:: py
+
+    >>> from StringIO import StringIO
+    >>> data = StringIO('\\n'.join([
+    ...     'version: 1',
+    ...     '',
+    ...     '# a member',
+    ...     'dn: uid=gawel,ou=members,dc=afpy,dc=org',
+    ...     'objectClass: top',
+    ...     'objectClass: person',
+    ...     'cn:: R2HDq2w=',
+    ...     'description: a long',
+    ...     '  line',
+    ...     '']))
+    >>> for dn, entry in read_entries(data):
+    ...     print dn
+    ...     print sorted(entry.items())
+    uid=gawel,ou=members,dc=afpy,dc=org
+    [('cn', ['Ga\\xc3\\xabl']), ('description', ['a long line']), ('objectClass', ['top', 'person'])]
+
+Values are kept in the server's encoding (utf-8) so export and import are
+lossless. Use :func:`iter_nodes` to get nodes of the connection's classes.
+
+Two console scripts are provided:
+
+.. sourcecode:: sh
+
+    # paged export. Memory usage does not depend on the number of entries
+    $ ldap-export -s afpy -b ou=members,dc=afpy,dc=org -o members.ldif
+    # show the differences between the file and the directory
+    $ ldap-import -s test --dry-run members.ldif
+    # pipelined import. Run it again to resume after a failure
+    $ ldap-import -s test -w 64 --checkpoint members.pos members.ldif
+
+Entries which already exist are skipped by ldap-import. Entries added before
+their parent are retried at the end of the import. Change records are not
+supported.
+"""
+from collections import deque
+from itertools import islice
+import base64
+import logging
+import os
+import sys
+import ldap
+import ldif
+from afpy.ldap.connection import Connection
+from afpy.ldap.connection import BINARY_ATTRIBUTES
+from afpy.ldap.connection import convert_entry
+from afpy.ldap.utils import normalize_dn
+from afpy.ldap.utils import option_parser
+
+log = logging.getLogger(__name__)
+
+# number of entries between two checkpoints
+CHECKPOINT_INTERVAL = 1000
+
+
+def _lines(fileobj):
+    """yield unfolded lines without comments. An empty string is yielded at
+    the end of each record"""
+    current = None
+    for line in fileobj:
+        line = line.rstrip('\r\n')
+        if line.startswith(' '):
+            if current is not None:
+                current += line[1:]
+            continue
+        if current is not None:
+            yield current
+        current = None
+        if not line:
+            yield ''
+        elif not line.startswith('#'):
+            current = line
+    if current is not None:
+        yield current
+    yield ''
+
+def _parse_line(line):
+    attr, sep, value = line.partition(':')
+    if not sep:
+        raise ValueError('Invalid LDIF line %r' % line)
+    if value.startswith(':'):
+        return attr, base64.b64decode(value[1:].strip())
+    if value.startswith('<'):
+        raise ValueError('URL values are not supported: %r' % line)
+    return attr, value.lstrip(' ')
+
+def read_entries(fileobj):
+    """yield ``(dn, entry)`` for each record of a LDIF file"""
+    dn = None
+    entry = {}
+    for line in _lines(fileobj):
+        if not line:
+            if dn is not None:
+                yield dn, entry
+            dn = None
+            entry = {}
+            continue
+        attr, value = _parse_line(line)
+        if dn is None:
+            if attr.lower() == 'version':
+                continue
+            if attr.lower() != 'dn':
+                raise ValueError('A record must start with a dn. Got %r' % line)
+            dn = value
+        elif attr.lower() == 'changetype':
+            raise ValueError('Change records are not supported (%s)' % dn)
+        else:
+            entry.setdefault(attr, []).append(value)
+
+def get_node_class(conn, dn):
+    """return the class used for dn: the user, group or perm class of conn
+    with the nearest ``base_dn``. Default to ``conn.node_class``"""
+    key = normalize_dn(dn)
+    found, length = conn.node_class, -1
+    for klass in (conn.user_class, conn.group_class, conn.perm_class):
+        base = klass is not None and klass.base_dn
+        if base:
+            base = normalize_dn(base)
+            if key.endswith(',' + base) and len(base) > length:
+                found, length = klass, len(base)
+    return found
+
+def iter_nodes(conn, fileobj):
+    """yield new nodes for the entries of a LDIF file. Values are converted
+    like search results"""
+    lconn = conn.connection_factory()
+    for dn, entry in read_entries(fileobj):
+        entry = convert_entry(lconn, dn, entry)
+        klass = get_node_class(conn, entry['dn'])
+        yield klass(dn=entry['dn'], attrs=entry, conn=conn)
+
+def export(conn, fileobj, base_dn=None, filter='(objectClass=*)', attrs=None,
+           scope=ldap.SCOPE_SUBTREE, page_size=500):
+    """write entries to fileobj with a paged search. Return the number of
+    entries"""
+    writer = ldif.LDIFWriter(fileobj)
+    count = 0
+    for entry in conn.iter_search(base_dn=base_dn or conn.base_dn, scope=scope,
+                                  filter=filter, attrs=attrs,
+                                  page_size=page_size, raw=True):
+        dn = entry.pop('dn')
+        writer.unparse(dn, entry)
+        count += 1
+    return count
+
+def _printable(attr, value):
+    if attr.lower() in BINARY_ATTRIBUTES or '\0' in value:
+        return '<%s bytes>' % len(value)
+    return value
+
+def diff_entries(conn, entries, out=sys.stdout):
+    """print the differences between entries and the directory. Return the
+    number of entries which would be added and the number of existing
+    entries which differ (those are skipped by :class:`Importer`)"""
+    lconn = conn.connection_factory()
+    added = differ = 0
+    for dn, entry in entries:
+        try:
+            current = list(conn.iter_search(base_dn=lconn._encode_outgoing(dn),
+                                            scope=ldap.SCOPE_BASE, raw=True))
+        except ldap.NO_SUCH_OBJECT:
+            current = None
+        if not current:
+            klass = get_node_class(conn, dn)
+            print >> out, 'add: %s (%s)' % (dn, klass.__name__)
+            added += 1
+            continue
+        old_entry = {}
+        for k, v in current[0].items():
+            if k != 'dn':
+                old_entry.setdefault(k.lower(), []).extend(v)
+        new_entry = {}
+        for k, v in entry.items():
+            new_entry.setdefault(k.lower(), []).extend(v)
+        lines = []
+        for attr in sorted(set(old_entry) | set(new_entry)):
+            old = old_entry.get(attr, [])
+            new = new_entry.get(attr, [])
+            lines.extend(['  - %s: %s' % (attr, _printable(attr, v))
+                          for v in old if v not in new])
+            lines.extend(['  + %s: %s' % (attr, _printable(attr, v))
+                          for v in new if v not in old])
+        if lines:
+            print >> out, 'exists: %s' % dn
+            for line in lines:
+                print >> out, line
+            differ += 1
+    return added, differ
+
+def read_checkpoint(filename):
+    """return the number of entries already processed"""
+    if filename and os.path.exists(filename):
+        value = open(filename).read().strip()
+        return value and int(value) or 0
+    return 0
+
+def write_checkpoint(filename, position):
+    tmp = filename + '.tmp'
+    fd = open(tmp, 'w')
+    try:
+        fd.write('%s\n' % position)
+    finally:
+        fd.close()
+    os.rename(tmp, filename)
+
+
+class Importer(object):
+    """add the entries of a LDIF file with a
+    :class:`~afpy.ldap.batch.Batch`. The position of the last processed
+    entry is saved in ``checkpoint`` so an import can be resumed"""
+
+    def __init__(self, conn, window=None, checkpoint=None):
+        self.conn = conn
+        self.window = window
+        self.checkpoint = checkpoint
+        self.position = read_checkpoint(checkpoint)
+        self.added = 0
+        self.skipped = 0
+        self.errors = []
+        self._saved = self.position
+        self._sent = deque()
+        self._retry = []
+        self._collected = 0
+        self._down = False
+
+    def run(self, fileobj):
+        entries = read_entries(fileobj)
+        # self.position is updated while entries are sent
+        start = self.position
+        if start:
+            log.info('Resuming after %s entries', start)
+            entries = islice(entries, start, None)
+        try:
+            with self.conn.batch(window=self.window) as batch:
+                self._collected = 0
+                for index, (dn, entry) in enumerate(entries, start):
+                    batch.add_entry(dn, entry)
+                    self._sent.append((index, dn, entry))
+                    self._collect(batch)
+            self._collect(batch)
+            self._retry_orphans()
+        finally:
+            self._save_checkpoint(force=True)
+        return self
+
+    def _collect(self, batch, retrying=False):
+        """process the responses received since the last call"""
+        results = batch.results
+        while self._collected < len(results):
+            action, dn, error = results[self._collected]
+            self._collected += 1
+            item = self._sent.popleft()
+            if isinstance(error, ldap.SERVER_DOWN):
+                self._down = True
+            if self._down:
+                # not processed
+                continue
+            if not retrying:
+                self.position += 1
+            if error is None:
+                self.added += 1
+            elif isinstance(error, ldap.ALREADY_EXISTS):
+                self.skipped += 1
+            elif isinstance(error, ldap.NO_SUCH_OBJECT):
+                # parent not added yet
+                self._retry.append(item + (error,))
+            else:
+                self.errors.append((dn, error))
+        self._save_checkpoint()
+
+    def _retry_orphans(self):
+        while self._retry and not self._down:
+            retry, self._retry = self._retry, []
+            with self.conn.batch(window=self.window) as batch:
+                self._collected = 0
+                for index, dn, entry, error in retry:
+                    batch.add_entry(dn, entry)
+                    self._sent.append((index, dn, entry))
+                    self._collect(batch, retrying=True)
+            self._collect(batch, retrying=True)
+            if len(self._retry) == len(retry):
+                # no progress. parents are really missing
+                self.errors.extend([(dn, error) for index, dn, entry, error in self._retry])
+                self._retry = []
+
+    def _save_checkpoint(self, force=False):
+        if not self.checkpoint:
+            return
+        position = min([r[0] for r in self._retry] + [self.position])
+        if force or position - self._saved >= CHECKPOINT_INTERVAL:
+            write_checkpoint(self.checkpoint, position)
+            self._saved = position
+
+
+def export_main():
+    parser = option_parser('%prog [options] [attributes]')
+    parser.add_option('-b', '--base-dn', dest='base_dn', default=None)
+    parser.add_option('-f', '--filter', dest='filter', default='(objectClass=*)')
+    parser.add_option('-p', '--page-size', dest='page_size', type='int', default=500)
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help='Output file. Default to stdout')
+    options, args = parser.parse_args()
+    conn = Connection(section=options.section, filename=options.config)
+    out = options.output and open(options.output, 'wb') or sys.stdout
+    try:
+        count = export(conn, out, base_dn=options.base_dn, filter=options.filter,
+                       attrs=args or None, page_size=options.page_size)
+    finally:
+        if options.output:
+            out.close()
+    print >> sys.stderr, '%s entries exported' % count
+
+def import_main():
+    parser = option_parser('%prog [options] [file.ldif]')
+    parser.add_option('-w', '--window', dest='window', type='int', default=None,
+                      help='Number of requests in flight')
+    parser.add_option('--checkpoint', dest='checkpoint', default=None,
+                      help='File used to store the position of the import')
+    parser.add_option('-n', '--dry-run', dest='dry_run', action='store_true',
+                      default=False, help='Only show the differences')
+    options, args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    conn = Connection(section=options.section, filename=options.config)
+    fd = args and open(args[0], 'rb') or sys.stdin
+    if options.dry_run:
+        added, differ = diff_entries(conn, read_entries(fd))
+        print >> sys.stderr, '%s entries would be added, %s existing entries differ' % (
+                    added, differ)
+        return
+    importer = Importer(conn, window=options.window,
+                        checkpoint=options.checkpoint).run(fd)
+    for dn, error in importer.errors:
+        print >> sys.stderr, 'Error while adding %s: %s' % (dn, error)
+    print >> sys.stderr, '%s entries added, %s skipped, %s errors' % (
+                importer.added, importer.skipped, len(importer.errors))
+    if importer.errors:
+        sys.exit(1)
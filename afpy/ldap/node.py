@@ -6,11 +6,48 @@ from ldaputil.passwd import UserPassword
 import datetime
 import schema
 import ldap
-import string
+import threading
 import utils
 import sys
 
 
+def attribute_modlist(attr, old, new):
+    """return the minimal modlist to change the values of attr:
+
+    .. sourcecode:: py
+
+        >>> attribute_modlist('mail', ['a@afpy.org'], ['b@afpy.org'])
+        [(2, 'mail', ['b@afpy.org'])]
+        >>> attribute_modlist('member', ['a', 'b', 'c'], ['a', 'b', 'd'])
+        [(1, 'member', ['c']), (0, 'member', ['d'])]
+        >>> attribute_modlist('mail', ['a@afpy.org'], [])
+        [(1, 'mail', None)]
+        >>> attribute_modlist('mail', ['a@afpy.org'], ['a@afpy.org'])
+        []
+        >>> attribute_modlist('mail', [], 'a@afpy.org;b@afpy.org')
+        [(0, 'mail', ['a@afpy.org', 'b@afpy.org'])]
+
+    """
+    old = [v for v in utils.to_list(old) if v not in ('', None)]
+    new = [v for v in utils.to_values(new, attr) if v not in ('', None)]
+    if len(old) == len(new) and set(old) == set(new):
+        return []
+    if not new:
+        return [(ldap.MOD_DELETE, attr, None)]
+    if not old:
+        return [(ldap.MOD_ADD, attr, new)]
+    removed = [v for v in old if v not in new]
+    added = [v for v in new if v not in old]
+    if len(removed) + len(added) >= len(new):
+        return [(ldap.MOD_REPLACE, attr, new)]
+    modlist = []
+    if removed:
+        modlist.append((ldap.MOD_DELETE, attr, removed))
+    if added:
+        modlist.append((ldap.MOD_ADD, attr, added))
+    return modlist
+
+
 class Node(object):
     """A LDAP node. Base class for all LDAP objects:
 
@@ -27,6 +64,10 @@ class Node(object):
     _base_dn = None
     _defaults = {}
     _field_types = {}
+    _projection = True
+    _partial = None
+    _snapshot = None
+    _dirty = None
 
     dn = schema.Dn('dn')
     rdn = schema.ReadonlyAttribute('rdn')
@@ -75,6 +116,44 @@ class Node(object):
         props.sort(cmp=cmp_prop)
         return props
 
+    @classmethod
+    def attributes(cls):
+        """return the ldap attributes loaded by default: the ones used by
+        the class properties. None means all attributes. Other attributes
+        are retrieved on demand"""
+        if not cls._projection:
+            return None
+        if '_attributes' not in cls.__dict__:
+            names = ['objectClass']
+            for k, v in cls.properties():
+                if v.stored and v.name not in names:
+                    names.append(v.name)
+            cls._attributes = len(names) > 1 and names or None
+        attrs = cls._attributes
+        if attrs is not None and cls._rdn and cls._rdn not in attrs:
+            attrs = attrs + [cls._rdn]
+        return attrs
+
+    @classmethod
+    def frozen_class(cls):
+        """return the :class:`FrozenNode` class used for this node class"""
+        if '_frozen_class' not in cls.__dict__:
+            attrs = dict(__slots__=(), __module__=cls.__module__,
+                         _node_class=cls, _names=[], _index={},
+                         _lock=threading.Lock())
+            for k, v in cls.properties():
+                if v.stored:
+                    attrs[k] = v
+            cls._frozen_class = type('Frozen%s' % cls.__name__,
+                                     (FrozenNode,), attrs)
+        return cls._frozen_class
+
+    def freeze(self):
+        """return a read only :class:`FrozenNode` copy of the node"""
+        data = self.normalized_data()
+        return self.frozen_class().from_entry(self._dn, data, conn=self._conn,
+                                              attrs=self._partial)
+
     @classmethod
     def build_dn(cls, uid):
         """build a dn for uid from node attributes"""
@@ -100,23 +179,13 @@ class Node(object):
 
     @classmethod
     def unlimited_search(cls, filter='', conn=None, **kwargs):
-        """same as search but handle SIZELIMIT_EXCEEDED errors"""
+        """same as search but use a paged search to get all the results
+        without hitting the server's size limit"""
         conn = conn or cls.conn
         if not filter.startswith('('):
             filter = '(%s)' % filter
-        try:
-            return cls.search(cls.conn, filter=filter)
-        except ldap.SIZELIMIT_EXCEEDED:
-            pass
-        results = []
-        for l in string.ascii_lowercase:
-            try:
-                results.extend(
-                   cls.search(filter='(&(%s=%s%s*)%s)' % (cls.rdn, f, l, filter), conn=conn)
-                   )
-            except ldap.SIZELIMIT_EXCEEDED:
-                pass
-        return results
+        kwargs.setdefault('page_size', conn.page_size or 500)
+        return cls.search(conn=conn, filter=filter, **kwargs)
 
     def bind(self, conn):
         """rebind instance to conn"""
@@ -160,22 +229,116 @@ class Node(object):
         if not self._conn:
             # new instance. need to store data thought
             return self._data
+        attrs = self.attributes()
         try:
-            data = self._conn.get_dn(self._dn)
+            data = self._conn.get_dn(self._dn, attrs=attrs)
         except ValueError:
             # new instance. need to store data thought
             return self._data
+        return self._load(data, attrs)
+
+    def _load(self, data, attrs):
+        """fill the node with a :meth:`~afpy.ldap.connection.Connection.get_dn` result"""
         results = data.get('results', {})
         if len(results) == 1:
             for k, v in results[0].items():
                 if len(v) == 1:
                     v = v[0]
                 self._data[k] = v
-
+            self._set_partial(attrs)
+            self._set_snapshot(results[0])
         return self._data
 
+    def _set_snapshot(self, entry):
+        """remember the server state of the node"""
+        self._snapshot = dict([(k.lower(), utils.to_list(v))
+                               for k, v in entry.items() if k != 'dn'])
+        self._dirty = set()
+
+    def _clear(self):
+        """forget loaded data"""
+        self._data = None
+        self._partial = None
+        self._snapshot = None
+        self._dirty = None
+
+    def _touch(self, attr):
+        """mark attr as modified"""
+        if self._dirty is None:
+            self._dirty = set()
+        self._dirty.add(attr)
+
+    def _modlist(self):
+        """return the modlist for modified attributes or None if the node
+        was not loaded from the directory"""
+        if self._snapshot is None:
+            return None
+        dirty = self._dirty or ()
+        if self._rdn in dirty:
+            # let LDAPConnection.modify() handle the rdn change
+            return None
+        partial = self._partial
+        modlist = []
+        for attr in sorted(dirty):
+            new = self._data.get(attr, [])
+            if partial is not None and attr.lower() not in partial:
+                # not loaded. the server's values are unknown
+                new = [v for v in utils.to_values(new, attr) if v not in ('', None)]
+                modlist.append((ldap.MOD_REPLACE, attr, new or None))
+                continue
+            modlist.extend(attribute_modlist(attr,
+                                             self._snapshot.get(attr.lower(), []),
+                                             new))
+        return modlist
+
+    def _renamed(self):
+        """True if the rdn value in data is not the one of the dn"""
+        rdn = self._rdn
+        if not (rdn and self._dn and self._data) or rdn not in self._data:
+            return False
+        current = self._dn.split(',', 1)[0].split('=', 1)[-1].strip().lower()
+        values = [v.lower() for v in utils.to_list(self._data[rdn])
+                    if isinstance(v, basestring)]
+        return current not in values
+
+    def _set_partial(self, attrs):
+        """mark the node as partially loaded with attrs"""
+        if attrs is None or '*' in attrs:
+            self._partial = None
+        else:
+            self._partial = set([a.lower() for a in attrs])
+
+    def _fetch(self, attr):
+        """retrieve an attribute which was not loaded. Return True if the
+        node got new data"""
+        partial = self._partial
+        if partial is None or attr.startswith('_') or not self._conn:
+            return False
+        if attr.lower() in partial:
+            return False
+        partial.add(attr.lower())
+        try:
+            data = self._conn.get_dn(self._dn, attrs=[attr])
+        except ValueError:
+            return False
+        results = data.get('results', {})
+        updated = False
+        if len(results) == 1:
+            for k, v in results[0].items():
+                if k not in self._data:
+                    if self._snapshot is not None and k != 'dn':
+                        self._snapshot[k.lower()] = utils.to_list(v)
+                    if len(v) == 1:
+                        v = v[0]
+                    self._data[k] = v
+                    updated = True
+        return updated
+
     def get(self, attr, default=None):
-        value = self.normalized_data().get(attr, default)
+        data = self.normalized_data()
+        if attr not in data:
+            self._fetch(attr)
+        value = data.get(attr, default)
         type = self._field_types.get(attr, None)
         if type:
             return utils.to_python(value, type)
@@ -183,8 +346,11 @@ class Node(object):
 
     def __getattr__(self, attr):
         """get a node attribute"""
+        data = self.normalized_data()
+        if attr not in data:
+            self._fetch(attr)
         try:
-            value = self.normalized_data()[attr]
+            value = data[attr]
         except KeyError:
             raise AttributeError('%r as no attribute %s' % (self, attr))
         type = self._field_types.get(attr, None)
@@ -204,6 +370,7 @@ class Node(object):
             else:
                 value = utils.to_string(value)
             data[attr] = value
+            self._touch(attr)
 
     def __delattr__(self, attr):
         """del a node attribute"""
@@ -211,8 +378,10 @@ class Node(object):
             object.__delattr__(self, attr)
         else:
             data = self.normalized_data()
-            if attr in data:
+            partial = self._partial
+            if attr in data or (partial is not None and attr.lower() not in partial):
                 data[attr] = []
+                self._touch(attr)
 
     def __eq__(self, node):
         return node._dn == self._dn
@@ -248,6 +417,161 @@ class Node(object):
         return '\n'.join(out)
 
 
+class FrozenNode(object):
+    """A read only node with a small memory footprint. Use it to keep a
+    lot of nodes in memory. Attribute names are shared by all the instances
+    of a class and values are stored in a tuple:
+
+    .. sourcecode:: py
+
+        >>> node = Node('uid=gawel,dc=afpy,dc=org',
+        ...             attrs={'uid': ['gawel'], 'mail': ['gawel@afpy.org']})
+        >>> frozen = node.freeze()
+        >>> frozen
+        <FrozenNode at uid=gawel,dc=afpy,dc=org>
+        >>> print frozen.mail
+        gawel@afpy.org
+        >>> frozen.mail = 'other@afpy.org'
+        Traceback (most recent call last):
+        ...
+        TypeError: <FrozenNode at uid=gawel,dc=afpy,dc=org> is read only
+        >>> print frozen.thaw().mail
+        gawel@afpy.org
+
+    Properties of the node class are available. Connection's search methods
+    return frozen nodes when called with ``frozen=True``. A node thawed
+    from a search with ``attrs`` fetch the other attributes when needed.
+    """
+    __slots__ = ('_dn', '_conn', '_values', '_partial')
+
+    _node_class = Node
+    # attribute names shared by all instances and their position in _values
+    _names = []
+    _index = {}
+    _lock = threading.Lock()
+
+    def __init__(self, dn, values, conn=None, partial=None):
+        object.__setattr__(self, '_dn', dn)
+        object.__setattr__(self, '_values', values)
+        object.__setattr__(self, '_conn', conn)
+        # lowercased names of the loaded attributes or None
+        object.__setattr__(self, '_partial', partial)
+
+    @classmethod
+    def from_entry(cls, dn, entry, conn=None, attrs=None):
+        """build a frozen node from a search result entry. ``attrs`` are the
+        attributes which were retrieved (None means all)"""
+        index = cls._index
+        values = [None] * len(cls._names)
+        for k, v in entry.items():
+            if k == 'dn':
+                continue
+            i = index.get(k)
+            if i is None:
+                i = cls._add_name(k)
+                index = cls._index
+            if i >= len(values):
+                values.extend([None] * (i + 1 - len(values)))
+            if isinstance(v, (list, tuple)):
+                if len(v) == 1:
+                    v = v[0]
+                else:
+                    v = tuple(v)
+            values[i] = v
+        partial = None
+        if attrs is not None and '*' not in attrs:
+            partial = frozenset([a.lower() for a in attrs])
+        return cls(dn, tuple(values), conn=conn, partial=partial)
+
+    @classmethod
+    def _add_name(cls, name):
+        cls._lock.acquire()
+        try:
+            if name not in cls._index:
+                # copy so readers never see a partially updated dict
+                index = cls._index.copy()
+                index[name] = len(cls._names)
+                cls._names.append(name)
+                cls._index = index
+            return cls._index[name]
+        finally:
+            cls._lock.release()
+
+    @property
+    def dn(self):
+        return self._dn
+
+    @property
+    def conn(self):
+        return self._conn or self._node_class.conn
+
+    @property
+    def rdn(self):
+        return self._node_class.rdn
+
+    @property
+    def base_dn(self):
+        return self._node_class.base_dn
+
+    @property
+    def data(self):
+        return self.normalized_data()
+
+    def normalized_data(self):
+        """return node values as a new dict"""
+        names = self._names
+        return dict([(names[i], v) for i, v in enumerate(self._values)
+                                   if v is not None])
+
+    def _fetch(self, attr):
+        return False
+
+    def _touch(self, attr):
+        raise TypeError('%r is read only' % self)
+
+    def thaw(self):
+        """return a :class:`Node` with the same values"""
+        entry = {}
+        for k, v in self.normalized_data().items():
+            entry[k] = isinstance(v, tuple) and list(v) or [v]
+        node = self._node_class(dn=self._dn, attrs=entry, conn=self._conn)
+        node._set_partial(self._partial)
+        node._set_snapshot(entry)
+        return node
+
+    def get(self, attr, default=None):
+        i = self._index.get(attr)
+        if i is None or i >= len(self._values) or self._values[i] is None:
+            return default
+        value = self._values[i]
+        type = self._node_class._field_types.get(attr, None)
+        if type:
+            return utils.to_python(value, type)
+        return value
+
+    def __getattr__(self, attr):
+        """get a node attribute"""
+        value = self.get(attr, self)
+        if value is self:
+            raise AttributeError('%r as no attribute %s' % (self, attr))
+        return value
+
+    def __setattr__(self, attr, value):
+        self._touch(attr)
+
+    def __delattr__(self, attr):
+        self._touch(attr)
+
+    def __eq__(self, node):
+        return node._dn == self._dn
+
+    def __ne__(self, node):
+        return node._dn != self._dn
+
+    def __repr__(self):
+        return '<%s at %s>' % (self.__class__.__name__, self._dn)
+
+
 class User(Node):
     """base class for user nodes"""
 
@@ -259,10 +583,12 @@ class User(Node):
     def change_password(self, passwd, scheme='ssha', charset='utf-8', multiple=0):
         """allow to change password"""
         if passwd:
-            password = UserPassword(self._conn._conn.connect(),
-                                    self._dn, charset=charset,
-                                    multiple=multiple)
-            password.changePassword(None, passwd, scheme)
+            with self._conn.pool.connection() as conn:
+                password = UserPassword(conn.connect(),
+                                        self._dn, charset=charset,
+                                        multiple=multiple)
+                password.changePassword(None, passwd, scheme)
+            self._conn.invalidate(self._dn)
 
 
     groups = schema.ListOfGroupsProperty('groups', title='Groups')
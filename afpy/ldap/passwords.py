@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+#Copyright (C) 2009 Gael Pasgrimaud
+__doc__ = """Hash, verify, audit and migrate ``userPassword`` values.
+
+Values use the RFC 2307 syntax. Salted SHA-2 and PBKDF2 are supported in
+addition to the schemes of :mod:`~afpy.ldap.ldaputil.passwd`:
+
+.. sourcecode:: py
+
+    >>> value = encode('secret', 'ssha512')
+    >>> value.startswith('{SSHA512}')
+    True
+    >>> verify('secret', value), verify('toto', value)
+    (True, False)
+    >>> verify('secret', '{SSHA}4quMECnTMGBp5iXN+oM7elda7HRhZnB5c2FsdA==')
+    True
+    >>> verify('secret', encode('secret', 'pbkdf2-sha256', rounds=10))
+    True
+    >>> [classify(v) for v in ('{SSHA}4quMECnTMGBp5iXN+oM7elda7HRhZnB5c2FsdA==',
+    ...                        '{crypt}abJnggxhB/yWI', 'secret', value)]
+    ['ssha', 'crypt', 'plain', 'ssha512']
+    >>> [strength(s) for s in ('md5', 'ssha', 'ssha512', 'sasl')]
+    ['weak', 'legacy', 'strong', 'unknown']
+
+:func:`audit` stream the values of a directory with a paged search:
+
+.. sourcecode:: py
+
+    >>> from afpy.ldap.testing import memory_connection
+    >>> conn = memory_connection()
+    >>> report = audit(conn)
+    >>> report.count, report.schemes
+    (1, {'ssha': 1})
+    >>> report.legacy
+    ['uid=gawel,ou=members,dc=afpy,dc=org']
+
+Plain text values can be hashed without the help of the users. Hashes are
+computed in a pool of processes and saved in a
+:meth:`~afpy.ldap.connection.Connection.batch`:
+
+.. sourcecode:: py
+
+    >>> migrate(conn, processes=1)
+    0
+
+Other values can only be replaced when the password is known.
+:class:`~afpy.ldap.auth.Authenticator` call :func:`rehash` after a
+successful bind if ``rehash_scheme`` is set:
+
+.. sourcecode:: py
+
+    >>> dn = 'uid=gawel,ou=members,dc=afpy,dc=org'
+    >>> rehash(conn, dn, 'secret', 'ssha512')
+    True
+    >>> audit(conn).schemes
+    {'ssha512': 1}
+    >>> conn.check(dn, 'secret')
+    True
+
+The ``ldap-passwords`` script print a report and migrate plain text values
+with ``--migrate``.
+"""
+from afpy.ldap.node import Node
+from afpy.ldap.utils import compare_digest
+from afpy.ldap.utils import pbkdf2_sha256
+import multiprocessing
+import binascii
+import logging
+import hashlib
+import base64
+import crypt
+import ldap
+import sys
+import os
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SCHEME = 'ssha512'
+PBKDF2_ROUNDS = 10000
+SALT_SIZE = 16
+
+# scheme -> hash function for {SCHEME}base64(digest + salt) values
+DIGESTS = {
+    'md5': hashlib.md5,
+    'smd5': hashlib.md5,
+    'sha': hashlib.sha1,
+    'ssha': hashlib.sha1,
+    'sha256': hashlib.sha256,
+    'ssha256': hashlib.sha256,
+    'sha512': hashlib.sha512,
+    'ssha512': hashlib.sha512,
+    }
+
+WEAK_SCHEMES = ('plain', 'crypt', 'md5', 'sha', 'sha256', 'sha512')
+LEGACY_SCHEMES = ('smd5', 'ssha')
+STRONG_SCHEMES = ('ssha256', 'ssha512', 'pbkdf2-sha256')
+
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def _split(value):
+    """return (scheme, encoded value)"""
+    value = _utf8(value).strip()
+    if value.startswith('{') and '}' in value:
+        scheme, encoded = value[1:].split('}', 1)
+        scheme = scheme.lower()
+        if scheme == 'cleartext':
+            scheme = 'plain'
+        return scheme, encoded
+    return 'plain', value
+
+def classify(value):
+    """return the lower case scheme of a value. ``plain`` for plain text"""
+    return _split(value)[0]
+
+def strength(scheme):
+    """return ``weak``, ``legacy``, ``strong`` or ``unknown``"""
+    if scheme in WEAK_SCHEMES:
+        return 'weak'
+    if scheme in LEGACY_SCHEMES:
+        return 'legacy'
+    if scheme in STRONG_SCHEMES:
+        return 'strong'
+    return 'unknown'
+
+def _ab64_encode(data):
+    return base64.b64encode(data).rstrip('=').replace('+', '.')
+
+def _ab64_decode(data):
+    data = data.replace('.', '+')
+    return base64.b64decode(data + '=' * (-len(data) % 4))
+
+def encode(password, scheme=DEFAULT_SCHEME, salt=None, rounds=PBKDF2_ROUNDS):
+    """return a ``userPassword`` value for password"""
+    password = _utf8(password)
+    scheme = scheme.lower()
+    if scheme == 'pbkdf2-sha256':
+        salt = salt or os.urandom(SALT_SIZE)
+        digest = pbkdf2_sha256(password, salt, rounds)
+        return '{PBKDF2-SHA256}%s$%s$%s' % (rounds, _ab64_encode(salt),
+                                            _ab64_encode(digest))
+    if scheme in DIGESTS:
+        if scheme.startswith('s'):
+            salt = salt or os.urandom(SALT_SIZE)
+        else:
+            salt = ''
+        digest = DIGESTS[scheme](password + salt).digest()
+        return '{%s}%s' % (scheme.upper(), base64.b64encode(digest + salt))
+    if scheme == 'crypt':
+        salt = salt or binascii.b2a_base64(os.urandom(3))[:2].replace('+', '.')
+        return '{CRYPT}%s' % crypt.crypt(password, salt)
+    if scheme == 'plain':
+        return password
+    raise ValueError('Unknown scheme %r' % scheme)
+
+def verify(password, value):
+    """return True if password match the ``userPassword`` value"""
+    password = _utf8(password)
+    scheme, encoded = _split(value)
+    try:
+        if scheme == 'plain':
+            return compare_digest(password, encoded)
+        if scheme == 'crypt':
+            return compare_digest(crypt.crypt(password, encoded), encoded)
+        if scheme in DIGESTS:
+            func = DIGESTS[scheme]
+            data = base64.b64decode(encoded)
+            size = func().digest_size
+            digest, salt = data[:size], data[size:]
+            return compare_digest(func(password + salt).digest(), digest)
+        if scheme == 'pbkdf2-sha256':
+            rounds, salt, digest = encoded.split('$')
+            digest = _ab64_decode(digest)
+            return compare_digest(
+                pbkdf2_sha256(password, _ab64_decode(salt), int(rounds)), digest)
+    except (TypeError, ValueError, binascii.Error):
+        log.warn('Invalid %s value', scheme)
+    return False
+
+def needs_rehash(value, scheme=DEFAULT_SCHEME, rounds=PBKDF2_ROUNDS):
+    """return True if value don't use scheme (or use less rounds)"""
+    current, encoded = _split(value)
+    if current != scheme.lower():
+        return True
+    if current == 'pbkdf2-sha256':
+        try:
+            return int(encoded.split('$', 1)[0]) < rounds
+        except ValueError:
+            return True
+    return False
+
+def get_values(entry):
+    """return the ``userPassword`` values of a search result entry"""
+    for key, values in entry.items():
+        if key.lower() == 'userpassword':
+            if isinstance(values, basestring):
+                values = [values]
+            return [_utf8(v) for v in values]
+    return []
+
+def _encode(args):
+    return encode(*args)
+
+def _verify(args):
+    return verify(*args)
+
+def _map(func, args, processes=None, chunksize=100, pool=None):
+    if pool is not None:
+        return pool.map(func, args, chunksize)
+    if processes == 1 or len(args) < 2:
+        return map(func, args)
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(func, args, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+def encode_many(passwords, scheme=DEFAULT_SCHEME, rounds=PBKDF2_ROUNDS,
+                processes=None, chunksize=100, pool=None):
+    """hash passwords in a pool of ``processes`` processes (one per cpu by
+    default). Return values in the same order. ``pool`` is an existing
+    ``multiprocessing.Pool`` to use instead of a new one"""
+    args = [(p, scheme, None, rounds) for p in passwords]
+    return _map(_encode, args, processes, chunksize, pool)
+
+def verify_many(pairs, processes=None, chunksize=100, pool=None):
+    """like :func:`encode_many` for a list of (password, value)"""
+    return _map(_verify, list(pairs), processes, chunksize, pool)
+
+
+class Report(object):
+    """counters of an audit. ``weak``, ``legacy`` and ``unknown`` are lists
+    of dn. ``multiple`` is the list of dn with more than one value"""
+
+    def __init__(self):
+        self.count = 0
+        self.schemes = {}
+        self.weak = []
+        self.legacy = []
+        self.unknown = []
+        self.multiple = []
+
+    def add(self, dn, values):
+        self.count += 1
+        if len(values) > 1:
+            self.multiple.append(dn)
+        levels = set()
+        for value in values:
+            scheme = classify(value)
+            self.schemes[scheme] = self.schemes.get(scheme, 0) + 1
+            levels.add(strength(scheme))
+        for level in ('weak', 'legacy', 'unknown'):
+            if level in levels:
+                getattr(self, level).append(dn)
+                break
+
+    def __str__(self):
+        lines = ['%s entries' % self.count]
+        for scheme, count in sorted(self.schemes.items()):
+            lines.append('  %-16s %8s  %s' % (scheme, count, strength(scheme)))
+        for level in ('weak', 'legacy', 'unknown', 'multiple'):
+            lines.append('%s %s' % (len(getattr(self, level)), level))
+        return '\n'.join(lines)
+
+
+def iter_passwords(conn, base_dn=None, filter='(userPassword=*)', page_size=500):
+    """yield (dn, values) for entries with a ``userPassword``"""
+    for entry in conn.iter_search(base_dn=base_dn or conn.base_dn,
+                                  scope=ldap.SCOPE_SUBTREE, filter=filter,
+                                  attrs=['userPassword'], page_size=page_size,
+                                  use_replica=False):
+        values = get_values(entry)
+        if values:
+            yield entry['dn'], values
+
+def audit(conn, base_dn=None, filter='(userPassword=*)', page_size=500):
+    """return a :class:`Report` for the entries of base_dn"""
+    report = Report()
+    for dn, values in iter_passwords(conn, base_dn, filter, page_size):
+        report.add(dn, values)
+    return report
+
+def _save(conn, dn, value):
+    conn.save(Node(dn=dn, attrs={'userPassword': value}, conn=conn))
+
+def migrate(conn, scheme=DEFAULT_SCHEME, rounds=PBKDF2_ROUNDS, base_dn=None,
+            filter='(userPassword=*)', page_size=500, batch_size=1000,
+            processes=None, dry_run=False):
+    """hash plain text values with scheme. Entries are hashed by
+    ``batch_size`` in a pool of processes. Return the number of entries
+    modified"""
+    count = 0
+    pending = []
+    pool = None
+    if processes != 1:
+        pool = multiprocessing.Pool(processes)
+    def flush():
+        hashes = encode_many([v for dn, v in pending], scheme, rounds,
+                             processes=processes, pool=pool)
+        if not dry_run:
+            with conn.batch(raise_errors=True):
+                for (dn, v), value in zip(pending, hashes):
+                    _save(conn, dn, value)
+        del pending[:]
+    try:
+        for dn, values in iter_passwords(conn, base_dn, filter, page_size):
+            if len(values) != 1 or classify(values[0]) != 'plain':
+                continue
+            pending.append((dn, _split(values[0])[1]))
+            count += 1
+            if len(pending) >= batch_size:
+                flush()
+        if pending:
+            flush()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return count
+
+def rehash(conn, dn, password, scheme=DEFAULT_SCHEME, rounds=PBKDF2_ROUNDS,
+           values=None):
+    """replace the value of dn by a hash of password using scheme if the
+    current value match password and use another scheme. Return True if
+    the value was replaced. ``values`` are the current ``userPassword``
+    values of dn. They are retrieved from the server if None"""
+    if values is None:
+        results = conn.search(base_dn=dn, scope=ldap.SCOPE_BASE,
+                              filter='(objectClass=*)', attrs=['userPassword'],
+                              use_replica=False)
+        values = results and get_values(results[0]) or []
+    if len(values) != 1 or not needs_rehash(values[0], scheme, rounds):
+        return False
+    if not verify(password, values[0]):
+        return False
+    _save(conn, dn, encode(password, scheme, rounds=rounds))
+    log.info('Password of %s hashed with %s', dn, scheme)
+    return True
+
+
+def main():
+    from afpy.ldap.connection import Connection
+    from afpy.ldap.utils import option_parser
+    parser = option_parser('%prog [options]')
+    parser.add_option('-b', '--base-dn', dest='base_dn', default=None)
+    parser.add_option('-f', '--filter', dest='filter', default='(userPassword=*)')
+    parser.add_option('-p', '--page-size', dest='page_size', type='int', default=500)
+    parser.add_option('-l', '--list', dest='list', action='store_true',
+                      default=False, help='List weak, legacy and unknown entries')
+    parser.add_option('--migrate', dest='migrate', action='store_true',
+                      default=False, help='Hash plain text values')
+    parser.add_option('-S', '--scheme', dest='scheme', default=DEFAULT_SCHEME,
+                      help='Scheme used by --migrate. Default to %s' % DEFAULT_SCHEME)
+    parser.add_option('-r', '--rounds', dest='rounds', type='int',
+                      default=PBKDF2_ROUNDS, help='PBKDF2 rounds')
+    parser.add_option('-j', '--processes', dest='processes', type='int',
+                      default=None, help='Number of processes. Default to one per cpu')
+    parser.add_option('-n', '--dry-run', dest='dry_run', action='store_true',
+                      default=False, help='Hash values but do not save them')
+    options, args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    conn = Connection(section=options.section, filename=options.config)
+    if options.migrate:
+        count = migrate(conn, scheme=options.scheme, rounds=options.rounds,
+                        base_dn=options.base_dn, filter=options.filter,
+                        page_size=options.page_size,
+                        processes=options.processes, dry_run=options.dry_run)
+        print >> sys.stderr, '%s plain text values hashed with %s' % (
+                    count, options.scheme)
+    report = audit(conn, base_dn=options.base_dn, filter=options.filter,
+                   page_size=options.page_size)
+    print report
+    if options.list:
+        for level in ('weak', 'legacy', 'unknown'):
+            for dn in getattr(report, level):
+                print '%s: %s' % (level, dn)
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+#Copyright (C) 2009 Gael Pasgrimaud
+__doc__ = """A thread safe pool of :class:`dataflake.ldapconnection.connection.LDAPConnection`.
+
+Each pooled ``LDAPConnection`` own its own socket so worker threads don't
+share a single :class:`~afpy.ldap.connection.SmartLDAPObject`. A thread
+always get the same connection back when it check out twice (nested calls
+like ``Node.save()`` -> ``Connection.save()``):
+
+.. sourcecode:: py
+
+    pool = ConnectionPool(conn.connection_factory, size=5, max_overflow=10)
+    with pool.connection() as lconn:
+        lconn.search(dn, ldap.SCOPE_BASE)
+
+Pools are configured via the ``.ini`` file:
+
+.. sourcecode:: ini
+
+    [myldap]
+    # connections kept open
+    ldap.pool_size = 5
+    # extra connections opened under load
+    ldap.pool_max_overflow = 10
+    # seconds to wait for a connection when the pool is exhausted
+    ldap.pool_timeout = 30
+    # max lifetime of a connection in seconds
+    ldap.pool_recycle = 3600
+    # check idle connections with a whoami request after this many seconds
+    ldap.pool_ping = 60
+    # size of the pool used by Connection.check()
+    ldap.bind_pool_size = 5
+
+"""
+from contextlib import contextmanager
+import threading
+import logging
+import time
+import ldap
+
+log = logging.getLogger(__name__)
+
+
+class PoolTimeout(RuntimeError):
+    """raised when no connection is available after ``timeout`` seconds"""
+
+
+class _Record(object):
+    """a pooled connection and its metadata"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created = time.time()
+        self.checkin = self.created
+        self.invalid = False
+        self.count = 0
+
+
+class ConnectionPool(object):
+    """A bounded pool of connections built by ``factory``.
+
+    ``size`` connections are kept open. ``max_overflow`` more can be opened
+    under load but are closed when released. If ``reset_bind`` is true the
+    bind of a connection is forgotten when it's released. This is used for
+    the pool dedicated to :meth:`~afpy.ldap.connection.Connection.check`.
+    """
+
+    def __init__(self, factory, size=5, max_overflow=10, timeout=30,
+                 recycle=3600, ping=60, reset_bind=False):
+        self.factory = factory
+        self.size = max(int(size), 1)
+        self.max_overflow = max(int(max_overflow), 0)
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping = ping
+        self.reset_bind = reset_bind
+        self._idle = []
+        self._opened = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._local = threading.local()
+
+    @property
+    def opened(self):
+        """number of connections currently opened by the pool"""
+        return self._opened
+
+    @property
+    def idle(self):
+        """number of connections waiting in the pool"""
+        return len(self._idle)
+
+    def current(self):
+        """return the connection checked out by the current thread if any"""
+        record = getattr(self._local, 'record', None)
+        return record and record.conn or None
+
+    def checkout(self):
+        """return a connection record. The current thread get the one it
+        already hold if any"""
+        record = getattr(self._local, 'record', None)
+        if record is None:
+            record = self._get()
+            self._local.record = record
+        record.count += 1
+        return record
+
+    def checkin(self, record):
+        """release a record returned by :meth:`checkout`"""
+        record.count -= 1
+        if record.count > 0:
+            return
+        if getattr(self._local, 'record', None) is record:
+            self._local.record = None
+        if self.reset_bind:
+            self._reset_bind(record.conn)
+        self._put(record)
+
+    @contextmanager
+    def connection(self):
+        """context manager wich yield a ``LDAPConnection``"""
+        record = self.checkout()
+        try:
+            yield record.conn
+        except ldap.SERVER_DOWN:
+            # don't give a dead socket to the next thread
+            record.invalid = True
+            raise
+        finally:
+            self.checkin(record)
+
+    def dispose(self):
+        """close all idle connections"""
+        self._cond.acquire()
+        try:
+            idle, self._idle = self._idle, []
+            self._opened -= len(idle)
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        for record in idle:
+            self._close(record)
+
+    def _get(self):
+        deadline = None
+        while True:
+            record = None
+            self._cond.acquire()
+            try:
+                if self._idle:
+                    record = self._idle.pop()
+                elif self._opened < self.size + self.max_overflow:
+                    self._opened += 1
+                    record = False
+                else:
+                    if deadline is None:
+                        deadline = time.time() + (self.timeout or 0)
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolTimeout(
+                            'No connection available after %ss (%s opened)' % (
+                            self.timeout, self._opened))
+                    self._cond.wait(remaining)
+            finally:
+                self._cond.release()
+            if record is False:
+                return self._open()
+            elif record is not None:
+                if self._is_valid(record):
+                    return record
+                self._discard(record)
+
+    def _open(self):
+        try:
+            return _Record(self.factory())
+        except:
+            self._discard(None)
+            raise
+
+    def _discard(self, record):
+        self._cond.acquire()
+        try:
+            self._opened -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        if record is not None:
+            self._close(record)
+
+    def _put(self, record):
+        record.checkin = time.time()
+        self._cond.acquire()
+        try:
+            if len(self._idle) < self.size and not self._expired(record):
+                self._idle.append(record)
+                record = None
+            else:
+                self._opened -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        if record is not None:
+            self._close(record)
+
+    def _expired(self, record):
+        if record.invalid:
+            return True
+        return self.recycle and time.time() - record.created > self.recycle
+
+    def _is_valid(self, record):
+        """check an idle connection before giving it to a thread"""
+        if self._expired(record):
+            return False
+        if self.ping and time.time() - record.checkin > self.ping:
+            conn = record.conn._getConnection()
+            if conn is not None:
+                try:
+                    conn.whoami_s()
+                except ldap.LDAPError, e:
+                    log.warn('Dropping dead connection %r: %s', record.conn, e)
+                    return False
+        return True
+
+    def _reset_bind(self, conn):
+        conn = conn._getConnection()
+        if conn is not None:
+            # force LDAPConnection.connect() to bind again
+            conn._last_bind = None
+
+    def _close(self, record):
+        try:
+            record.conn.disconnect()
+        except Exception, e:
+            log.debug('Error while closing %r: %s', record.conn, e)
+
+    def __repr__(self):
+        return '<%s %s/%s opened, %s idle>' % (self.__class__.__name__,
+                    self._opened, self.size + self.max_overflow, len(self._idle))
+
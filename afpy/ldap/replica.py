@@ -0,0 +1,483 @@
+# -*- coding: utf-8 -*-
+#Copyright (C) 2009 Gael Pasgrimaud
+__doc__ = """An in-process mirror of some subtrees of the directory.
+
+When configured, :meth:`~afpy.ldap.connection.Connection.get_dn`,
+:meth:`~afpy.ldap.connection.Connection.search` (and so ``search_nodes`` and
+``get_groups``) are answered from the mirror instead of the server:
+
+.. sourcecode:: ini
+
+    [myldap]
+    # syncrepl, poll or auto (syncrepl if the server support it)
+    ldap.replica = auto
+    # subtrees to mirror. Default to user_dn and group_dn
+    ldap.replica_bases = ou=members,dc=afpy,dc=org;ou=groups,dc=afpy,dc=org
+    # seconds between two polls
+    ldap.replica_interval = 60
+    # don't use the mirror if it was not synchronized for this many seconds
+    ldap.replica_max_staleness = 300
+    # seconds between two scans for deleted entries when polling
+    ldap.replica_full_scan_interval = 600
+
+With ``syncrepl`` the mirror is updated by a RFC 4533 refreshAndPersist
+search. Without it the server is polled for entries with a newer
+``modifyTimestamp`` and deleted entries are detected with a dn only search
+of the whole subtree, every ``replica_full_scan_interval`` seconds (``0``
+means at each poll). Entries deleted by the process are checked at each
+poll.
+
+An entry written by the process is read from the server until the mirror
+got the change. Searches with a filter the mirror can't evaluate go to the
+server too.
+
+A replica can be synchronized by hand, which is useful in tests:
+
+.. sourcecode:: py
+
+    replica = Replica(conn, bases=['ou=members,dc=afpy,dc=org'], mode='poll')
+    replica.sync()
+    replica.lookup('uid=gawel,ou=members,dc=afpy,dc=org')
+"""
+import threading
+import logging
+import time
+import ldap
+import ldap.ldapobject
+import connection
+import filters
+from utils import normalize_dn
+try:
+    from ldap.syncrepl import SyncreplConsumer
+except ImportError:
+    SyncreplConsumer = None
+
+log = logging.getLogger(__name__)
+
+
+def in_scope(key, base, scope):
+    """True if the normalized dn key is in the scope of base"""
+    if scope == ldap.SCOPE_BASE:
+        return key == base
+    if scope == ldap.SCOPE_ONELEVEL:
+        parts = key.split(',', 1)
+        return len(parts) == 2 and parts[1] == base
+    return key == base or key.endswith(',' + base)
+
+def project(entry, attrs):
+    """return a copy of entry with only attrs"""
+    if attrs is None or '*' in attrs:
+        return dict([(k, isinstance(v, list) and list(v) or v)
+                     for k, v in entry.items()])
+    attrs = set([a.lower() for a in attrs])
+    result = dict([(k, list(v)) for k, v in entry.items()
+                                if k != 'dn' and k.lower() in attrs])
+    result['dn'] = entry['dn']
+    return result
+
+
+class Replica(object):
+    """Mirror of ``bases``. ``mode`` is ``syncrepl``, ``poll`` or ``auto``"""
+
+    def __init__(self, conn, bases=None, mode='auto', interval=60,
+                 max_staleness=300, page_size=500, full_scan_interval=600):
+        if mode not in ('auto', 'syncrepl', 'poll'):
+            raise ValueError('Invalid replica mode %r' % mode)
+        self.conn = conn
+        self._bases = bases
+        self.mode = mode
+        self.active_mode = None
+        self.interval = interval
+        self.max_staleness = max_staleness
+        self.page_size = page_size
+        self.full_scan_interval = full_scan_interval
+        # time of the last successful synchronization
+        self.synced = None
+        # normalized dn -> (entry, filters.normalize(entry))
+        self._entries = {}
+        # normalized dn -> time of the last local write
+        self._stale = {}
+        self._fresh_since = 0
+        # base -> last modifyTimestamp seen
+        self._highwater = {}
+        # base -> time of the last search for deleted entries
+        self._scanned = {}
+        self._workers = []
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def bases(self):
+        """mirrored subtrees"""
+        if self._bases is None:
+            self._bases = [k.base_dn for k in (self.conn.user_class,
+                                               self.conn.group_class)
+                                     if k is not None and k.base_dn]
+        return self._bases
+
+    @property
+    def ready(self):
+        """True if the mirror can be used"""
+        synced = self.synced
+        return synced is not None and \
+               time.time() - synced <= self.max_staleness
+
+    def __len__(self):
+        return len(self._entries)
+
+    def covers(self, key):
+        """True if the normalized dn key is in a mirrored subtree"""
+        for base in self.bases:
+            base = normalize_dn(base)
+            if key == base or key.endswith(',' + base):
+                return True
+        return False
+
+    def invalidate(self, dn=None):
+        """mark dn as modified by this process. Used as an invalidation hook
+        of the connection"""
+        key = dn and normalize_dn(dn) or None
+        self._lock.acquire()
+        try:
+            self._stale[key] = time.time()
+        finally:
+            self._lock.release()
+
+    def _is_stale(self, key, subtree=False):
+        self._lock.acquire()
+        try:
+            for k, t in self._stale.items():
+                if t < self._fresh_since:
+                    del self._stale[k]
+                elif k is None or k == key or \
+                     (subtree and k.endswith(',' + key)):
+                    return True
+            return False
+        finally:
+            self._lock.release()
+
+    def lookup(self, dn, attrs=None):
+        """return a :meth:`~afpy.ldap.connection.Connection.get_dn` result
+        or None if the mirror can't answer. Raise ValueError if dn does not
+        exist"""
+        key = normalize_dn(dn)
+        if not self.ready or not self.covers(key) or self._is_stale(key):
+            return None
+        item = self._entries.get(key)
+        if item is None:
+            raise ValueError(dn)
+        return dict(size=1, results=[project(item[0], attrs)], exception='')
+
+    def search(self, base_dn, scope=ldap.SCOPE_SUBTREE,
+               filter='(objectClass=*)', attrs=None):
+        """return search results or None if the mirror can't answer"""
+        base = normalize_dn(base_dn)
+        if not self.ready or not self.covers(base) or \
+           self._is_stale(base, subtree=scope != ldap.SCOPE_BASE):
+            return None
+        try:
+            f = filters.parse(filter)
+        except ValueError, e:
+            log.debug('Using the server for %s: %s', filter, e)
+            return None
+        self._lock.acquire()
+        try:
+            if base not in self._entries:
+                raise ldap.NO_SUCH_OBJECT({'desc': 'No such object', 'matched': ''})
+            items = self._entries.items()
+        finally:
+            self._lock.release()
+        return [project(entry, attrs) for key, (entry, normalized) in items
+                        if in_scope(key, base, scope) and f.match(normalized)]
+
+    def _set(self, entry, clear=False):
+        key = normalize_dn(entry['dn'])
+        self._lock.acquire()
+        try:
+            self._entries[key] = (entry, filters.normalize(entry))
+            if clear:
+                self._stale.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def _remove(self, key, clear=False):
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+            if clear:
+                self._stale.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def _search(self, base, filter, attrs):
+        try:
+            return list(self.conn.iter_search(base_dn=base, filter=filter,
+                                              scope=ldap.SCOPE_SUBTREE,
+                                              attrs=attrs, use_replica=False,
+                                              page_size=self.page_size))
+        except ldap.NO_SUCH_OBJECT:
+            log.warn('Replica base %s does not exist', base)
+            return []
+
+    def _exists(self, key):
+        try:
+            return len(list(self.conn.iter_search(base_dn=key,
+                                                  scope=ldap.SCOPE_BASE,
+                                                  attrs=['1.1'],
+                                                  use_replica=False))) > 0
+        except ldap.NO_SUCH_OBJECT:
+            return False
+
+    def sync(self, full_scan=False):
+        """poll the server for changes. Return the number of entries updated.
+        Look for deleted entries if ``full_scan`` is true or if the last
+        scan is older than ``full_scan_interval``"""
+        started = time.time()
+        count = 0
+        for base in self.bases:
+            count += self._sync_base(base, started, full_scan)
+        self._lock.acquire()
+        try:
+            self.synced = started
+            self._fresh_since = started
+        finally:
+            self._lock.release()
+        return count
+
+    def _sync_base(self, base, started, full_scan=False):
+        key = normalize_dn(base)
+        highwater = self._highwater.get(key)
+        if highwater:
+            filter = '(modifyTimestamp>=%s)' % highwater
+        else:
+            filter = '(objectClass=*)'
+        count = 0
+        latest = highwater
+        for entry in self._search(base, filter, ['*', 'modifyTimestamp']):
+            for k in entry.keys():
+                if k.lower() == 'modifytimestamp':
+                    stamp = entry.pop(k)[0]
+                    if stamp > latest:
+                        latest = stamp
+            self._set(entry)
+            count += 1
+        if not highwater:
+            self._scanned[key] = started
+        elif full_scan or \
+             started - self._scanned.get(key, 0) >= self.full_scan_interval:
+            # deleted or renamed entries
+            dns = set([normalize_dn(e['dn']) for e in self._search(base, '(objectClass=*)', ['1.1'])])
+            self._lock.acquire()
+            try:
+                removed = [k for k in self._entries
+                             if in_scope(k, key, ldap.SCOPE_SUBTREE) and k not in dns]
+                for k in removed:
+                    del self._entries[k]
+            finally:
+                self._lock.release()
+            count += len(removed)
+            self._scanned[key] = started
+        else:
+            # entries deleted or renamed by this process
+            self._lock.acquire()
+            try:
+                written = [k for k in self._stale
+                             if k is not None and k in self._entries and
+                                in_scope(k, key, ldap.SCOPE_SUBTREE)]
+            finally:
+                self._lock.release()
+            removed = [k for k in written if not self._exists(k)]
+            for k in removed:
+                self._remove(k)
+            count += len(removed)
+        self._highwater[key] = latest
+        return count
+
+    def start(self):
+        """load the mirror and keep it up to date in a background thread"""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            name='afpy.ldap.replica')
+            self._thread.setDaemon(True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """stop the background thread"""
+        self._stop.set()
+        thread, self._thread = self._thread, None
+        if thread is not None and thread is not threading.currentThread():
+            thread.join(self.interval)
+        self._close_workers()
+
+    def _run(self):
+        while not self._stop.isSet():
+            try:
+                if self.active_mode is None:
+                    self._setup()
+                elif self.active_mode == 'poll':
+                    if self._stop.wait(self.interval):
+                        break
+                    self.sync()
+                else:
+                    self._persist()
+            except ldap.LDAPError, e:
+                log.warn('Replica synchronization failed: %s', e)
+                self._close_workers()
+                self._stop.wait(self.interval)
+            except Exception, e:
+                log.exception('Replica synchronization failed: %s', e)
+                self._stop.wait(self.interval)
+
+    def _setup(self):
+        """choose the synchronization mode and load the mirror"""
+        if self.mode != 'poll':
+            try:
+                self._refresh()
+            except (ldap.LDAPError, RuntimeError), e:
+                self._close_workers()
+                self._workers = []
+                if self.mode == 'syncrepl':
+                    raise
+                log.warn('syncrepl not available (%s). Polling every %ss',
+                         e, self.interval)
+                self._lock.acquire()
+                try:
+                    self._entries.clear()
+                finally:
+                    self._lock.release()
+            else:
+                self.active_mode = 'syncrepl'
+                return
+        self.sync()
+        self.active_mode = 'poll'
+
+    def _refresh(self):
+        """initial content of a syncrepl replica"""
+        if SyncreplConsumer is None:
+            raise RuntimeError('This python-ldap does not support syncrepl')
+        self._workers = [_SyncreplWorker(self, base) for base in self.bases]
+        for worker in self._workers:
+            worker.connect()
+            while not worker.refreshed and not self._stop.isSet():
+                if not worker.poll(1):
+                    break
+        self._touch()
+
+    def _persist(self):
+        for worker in self._workers:
+            if worker.ldap_conn is None:
+                worker.connect()
+            worker.poll(1. / len(self._workers))
+        self._touch()
+
+    def _touch(self):
+        now = time.time()
+        self.synced = now
+        # local writes are replicated quickly. Don't wait for ever a
+        # change wich failed
+        self._fresh_since = now - self.interval
+
+    def _close_workers(self):
+        for worker in self._workers:
+            worker.close()
+
+
+if SyncreplConsumer is not None:
+
+    class SyncreplObject(ldap.ldapobject.LDAPObject, SyncreplConsumer):
+        """a connection which forward syncrepl events to a worker"""
+        worker = None
+
+        def syncrepl_get_cookie(self):
+            return self.worker.cookie
+
+        def syncrepl_set_cookie(self, cookie):
+            self.worker.cookie = cookie
+
+        def syncrepl_entry(self, dn, attributes, uuid):
+            self.worker.entry(dn, attributes, uuid)
+
+        def syncrepl_delete(self, uuids):
+            self.worker.delete(uuids)
+
+        def syncrepl_present(self, uuids, refreshDeletes=False):
+            self.worker.present(uuids, refreshDeletes)
+
+        def syncrepl_refreshdone(self):
+            self.worker.refreshed = True
+
+
+class _SyncreplWorker(object):
+    """a refreshAndPersist search on one base"""
+
+    def __init__(self, replica, base):
+        self.replica = replica
+        self.base = base
+        self.cookie = None
+        self.refreshed = False
+        self.ldap_conn = None
+        self.msgid = None
+        # uuid -> normalized dn
+        self.uuids = {}
+        self.present_uuids = set()
+        self.lconn = replica.conn.connection_factory()
+
+    def connect(self):
+        conn = self.replica.conn
+        url = self.lconn.servers.keys()[0]
+        ldap_conn = SyncreplObject(url)
+        ldap_conn.worker = self
+        ldap_conn.protocol_version = ldap.VERSION3
+        ldap_conn.simple_bind_s(self.lconn._encode_incoming(conn.bind_dn),
+                                self.lconn._encode_incoming(conn.bind_pw))
+        self.msgid = ldap_conn.syncrepl_search(
+                        connection.escape_dn(self.lconn._encode_incoming(self.base)),
+                        ldap.SCOPE_SUBTREE, mode='refreshAndPersist',
+                        filterstr='(objectClass=*)', attrlist=['*'])
+        self.ldap_conn = ldap_conn
+
+    def poll(self, timeout):
+        """process the available events. Return False if the search is
+        complete"""
+        try:
+            return self.ldap_conn.syncrepl_poll(msgid=self.msgid,
+                                                timeout=timeout, all=1)
+        except ldap.TIMEOUT:
+            return True
+
+    def close(self):
+        if self.ldap_conn is not None:
+            try:
+                self.ldap_conn.unbind_s()
+            except ldap.LDAPError:
+                pass
+            self.ldap_conn = None
+
+    def entry(self, dn, attributes, uuid):
+        entry = connection.convert_entry(self.lconn, dn, attributes)
+        key = normalize_dn(entry['dn'])
+        old = self.uuids.get(uuid)
+        if old is not None and old != key:
+            # renamed
+            self.replica._remove(old, clear=True)
+        self.uuids[uuid] = key
+        self.present_uuids.add(uuid)
+        self.replica._set(entry, clear=True)
+
+    def delete(self, uuids):
+        for uuid in uuids:
+            key = self.uuids.pop(uuid, None)
+            if key is not None:
+                self.replica._remove(key, clear=True)
+
+    def present(self, uuids, refreshDeletes=False):
+        if uuids is None:
+            if refreshDeletes is False:
+                self.delete([u for u in self.uuids.keys()
+                               if u not in self.present_uuids])
+            self.present_uuids = set()
+        else:
+            self.present_uuids.update(uuids)
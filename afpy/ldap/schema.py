@@ -99,6 +99,10 @@ class Dn(Attribute):
 class Property(property):
     klass = str
     count = 0
+    # True if the property is stored in a ldap attribute
+    stored = True
+    # (utils.generation, converter) built on first access
+    _converter = (None, None)
 
     def __init__(self, name, title=None, description='', required=False):
         self.name = name
@@ -117,8 +121,13 @@ class Property(property):
         except ValueError:
             # new node
             return ''
-        value = data.get(self.name)
-        return utils.to_python(value, self.klass)
+        if self.name not in data:
+            instance._fetch(self.name)
+        generation, converter = self._converter
+        if generation != utils.generation:
+            converter = utils.python_converter(self.klass)
+            self._converter = (utils.generation, converter)
+        return converter(data.get(self.name))
 
     def __set__(self, instance, value):
         data = instance.normalized_data()
@@ -126,10 +135,12 @@ class Property(property):
             data[self.name] = []
         else:
             data[self.name] = utils.to_string(value)
+        instance._touch(self.name)
 
     def __delete__(self, instance):
         data = instance.normalized_data()
         data[self.name] = []
+        instance._touch(self.name)
 
     def __repr__(self):
         return '<%s %r>' % (self.__class__.__name__, self.name)
@@ -163,6 +174,8 @@ class ListProperty(Property):
         if instance is None:
             return self
         data = instance.normalized_data()
+        if self.name not in data:
+            instance._fetch(self.name)
         value = data.get(self.name)
         if not value:
             value = []
@@ -180,6 +193,7 @@ class ListProperty(Property):
             if not isinstance(i, self.item_class):
                 raise TypeError('All items of %s must by %s not %s' % (self.name, self.item_class, type(i)))
         data[self.name] = self._to_ldap(value, instance)
+        instance._touch(self.name)
 
 class SetProperty(ListProperty):
     klass = set
@@ -197,7 +211,7 @@ class SetOfNodesProperty(SetProperty):
     def _to_python(self, value, instance=None):
         if instance.conn:
             value = self.klass(value or [])
-            return self.klass([self.item_class(dn=v, conn=instance.conn) for v in value])
+            return self.klass(instance.conn.get_nodes(value, node_class=self.item_class))
         else:
             return self.klass()
 
@@ -206,6 +220,7 @@ class SetOfNodesProperty(SetProperty):
 
 class ListOfGroupNodesProperty(ListProperty):
     _item_class = 'group'
+    stored = False
 
     def __init__(self, name, title, required=False):
         ListProperty.__init__(self, name, title, required)
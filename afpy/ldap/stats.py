@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+#Copyright (C) 2009 Gael Pasgrimaud
+__doc__ = """Counters, latency histograms and slow operation log.
+
+Each operation done by a :class:`~afpy.ldap.connection.Connection` (search,
+get, bind, modify, add, delete) call the functions of its
+``operation_hooks`` with an :class:`Event`. A :class:`Stats` object is
+registered when ``ldap.stats`` is set:
+
+.. sourcecode:: ini
+
+    [myldap]
+    ldap.stats = true
+    # log operations slower than this many seconds
+    ldap.slow_threshold = 0.5
+
+.. sourcecode:: py
+
+    >>> stats = Stats(slow_threshold=.5)
+    >>> stats(Event('search', .003, base_dn='ou=members,dc=afpy,dc=org',
+    ...             filter='(uid=gawel)', size=1,
+    ...             caller='get_groups <- afpy.ldap.auth:_get_groups'))
+    >>> stats(Event('get', 0, source='cache'))
+    >>> stats(Event('get', .8, base_dn='uid=gawel,ou=members,dc=afpy,dc=org'))
+    >>> snapshot = stats.snapshot()
+    >>> search = snapshot['operations']['search']
+    >>> search['count'], search['size_total'], search['latency']['p50']
+    (1, 1, 0.005)
+    >>> sorted(snapshot['operations']['get']['sources'].items())
+    [('cache', 1), ('server', 1)]
+    >>> snapshot['callers'][0]['caller']
+    u'get_groups <- afpy.ldap.auth:_get_groups'
+    >>> [e['base_dn'] for e in snapshot['slow']]
+    [u'uid=gawel,ou=members,dc=afpy,dc=org']
+
+Latencies are only recorded for operations answered by the server. The
+``caller`` of an event is the outermost ``Connection`` method and the
+function which called it. Operations sent by
+:meth:`~afpy.ldap.connection.Connection.batch` and
+:class:`~afpy.ldap.aio.AsyncConnection` are not recorded.
+
+:class:`StatsApp` serve a JSON snapshot. Use it in your WSGI stack with the
+connection used by your application:
+
+.. sourcecode:: py
+
+    app = StatsMiddleware(app, conn, path='/_ldap_stats')
+
+A ``POST`` to ``/_ldap_stats`` return the snapshot and reset the counters.
+
+The snapshot contains dn, filters and the code calling the connection.
+By default only requests from the local host are served (see
+:func:`local_only`). Behind a reverse proxy every request comes from the
+proxy so protect the path there or pass your own ``authorize`` function,
+which take the WSGI environ and return True if the request is allowed.
+"""
+from collections import deque
+import threading
+import logging
+import bisect
+import time
+import json
+import sys
+
+log = logging.getLogger(__name__)
+
+# upper bounds of the latency buckets in seconds
+BUCKETS = (.001, .002, .005, .01, .02, .05, .1, .2, .5, 1., 2., 5.)
+
+# encoding of the byte strings of the Connection api
+API_ENCODING = 'iso-8859-15'
+
+# modules skipped when looking for the caller of an operation
+INTERNAL_MODULES = ('afpy.ldap.connection', 'afpy.ldap.stats',
+                    'afpy.ldap.pool', 'contextlib')
+
+
+def caller():
+    """return ``method <- module:function`` where method is the outermost
+    :class:`~afpy.ldap.connection.Connection` method of the stack"""
+    frame = sys._getframe(1)
+    method = None
+    while frame is not None:
+        module = frame.f_globals.get('__name__')
+        if module == 'afpy.ldap.connection':
+            method = frame.f_code.co_name
+        elif module not in INTERNAL_MODULES:
+            return '%s <- %s:%s' % (method, module, frame.f_code.co_name)
+        frame = frame.f_back
+    return method
+
+
+def _text(value):
+    if isinstance(value, str):
+        return value.decode(API_ENCODING)
+    return value
+
+
+class Event(object):
+    """an operation. ``source`` is ``server``, ``cache`` or ``replica``"""
+
+    def __init__(self, op, duration=0., base_dn=None, filter=None, scope=None,
+                 size=None, error=None, source='server', caller=None):
+        self.op = op
+        self.duration = duration
+        self.base_dn = base_dn
+        self.filter = filter
+        self.scope = scope
+        self.size = size
+        self.error = error
+        self.source = source
+        self.caller = caller
+
+    def as_dict(self):
+        """return a dict of plain values. Strings are unicode"""
+        return dict(op=self.op, duration=self.duration,
+                    base_dn=_text(self.base_dn), filter=_text(self.filter),
+                    scope=self.scope, size=self.size,
+                    error=self.error is not None and repr(self.error) or None,
+                    source=self.source, caller=_text(self.caller))
+
+    def __repr__(self):
+        return '<Event %s %s %.3fs>' % (self.op, self.base_dn, self.duration)
+
+
+class Histogram(object):
+    """latency histogram with fixed buckets"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """upper bound of the bucket containing the q percentile"""
+        if not self.count:
+            return 0.
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def snapshot(self):
+        return dict(count=self.count, total=self.total, max=self.max,
+                    mean=self.count and self.total / self.count or 0.,
+                    p50=self.percentile(.5), p90=self.percentile(.9),
+                    p99=self.percentile(.99),
+                    buckets=zip(self.buckets + ('inf',), self.counts))
+
+
+class OperationStats(object):
+    """counters of an operation type"""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.sources = {}
+        self.size_total = 0
+        self.size_max = 0
+        self.latency = Histogram()
+
+    def add(self, event):
+        self.count += 1
+        if event.error is not None:
+            self.errors += 1
+        self.sources[event.source] = self.sources.get(event.source, 0) + 1
+        if event.size:
+            self.size_total += event.size
+            self.size_max = max(self.size_max, event.size)
+        if event.source == 'server':
+            self.latency.add(event.duration)
+
+    def snapshot(self):
+        return dict(count=self.count, errors=self.errors,
+                    sources=dict(self.sources),
+                    size_total=self.size_total, size_max=self.size_max,
+                    latency=self.latency.snapshot())
+
+
+class Stats(object):
+    """a hook which aggregate events. Operations slower than
+    ``slow_threshold`` seconds are logged and the last ``slow_log_size``
+    ones are kept"""
+
+    def __init__(self, slow_threshold=0, slow_log_size=100, caches=None):
+        self.slow_threshold = slow_threshold
+        self.slow_log_size = slow_log_size
+        # name -> LRUCache
+        self.caches = caches if caches is not None else {}
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """reset counters"""
+        with self._lock:
+            self.started = time.time()
+            self.operations = {}
+            # caller -> [count, total duration]
+            self.callers = {}
+            self.slow = deque(maxlen=self.slow_log_size)
+
+    def __call__(self, event):
+        slow = self.slow_threshold and event.source == 'server' and \
+               event.duration >= self.slow_threshold
+        with self._lock:
+            stats = self.operations.get(event.op)
+            if stats is None:
+                stats = self.operations[event.op] = OperationStats()
+            stats.add(event)
+            if event.caller:
+                value = self.callers.get(event.caller)
+                if value is None:
+                    value = self.callers[event.caller] = [0, 0.]
+                value[0] += 1
+                value[1] += event.duration
+            if slow:
+                self.slow.append(event)
+        if slow:
+            log.warning('Slow %s (%.3fs): base=%s scope=%s filter=%s size=%s caller=%s',
+                        event.op, event.duration, event.base_dn, event.scope,
+                        event.filter, event.size, event.caller)
+
+    def snapshot(self, callers=20):
+        """return a dict of plain values. Only the ``callers`` callers with
+        the highest total duration are included"""
+        with self._lock:
+            operations = dict([(k, v.snapshot()) for k, v in self.operations.items()])
+            top = sorted(self.callers.items(), key=lambda i: i[1][1], reverse=True)
+            top = [dict(caller=_text(k), count=v[0], total=v[1]) for k, v in top[:callers]]
+            slow = [e.as_dict() for e in self.slow]
+            started = self.started
+        caches = dict([(k, v.stats()) for k, v in self.caches.items()])
+        return dict(started=started, uptime=time.time() - started,
+                    operations=operations, callers=top, slow=slow,
+                    caches=caches)
+
+
+def local_only(environ):
+    """True if the request come from the local host"""
+    return environ.get('REMOTE_ADDR') in ('127.0.0.1', '::1')
+
+
+class StatsApp(object):
+    """WSGI application serving ``conn.stats.snapshot()`` as JSON. A
+    ``POST`` reset the counters. Requests are rejected unless
+    ``authorize(environ)`` is true"""
+
+    def __init__(self, conn, authorize=local_only):
+        self.conn = conn
+        self.authorize = authorize
+
+    def __call__(self, environ, start_response):
+        if not self.authorize(environ):
+            start_response('403 Forbidden', [('Content-Type', 'text/plain')])
+            return ['Forbidden']
+        method = environ.get('REQUEST_METHOD', 'GET')
+        if method not in ('GET', 'HEAD', 'POST'):
+            start_response('405 Method Not Allowed',
+                           [('Content-Type', 'text/plain'),
+                            ('Allow', 'GET, HEAD, POST')])
+            return ['Method not allowed']
+        stats = self.conn.stats
+        if stats is None:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return ['ldap.stats is not enabled']
+        body = json.dumps(stats.snapshot(), indent=2, sort_keys=True)
+        if method == 'POST':
+            stats.reset()
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Content-Length', str(len(body))),
+                                  ('Cache-Control', 'no-cache')])
+        return [body]
+
+
+class StatsMiddleware(object):
+    """serve a :class:`StatsApp` at ``path``"""
+
+    def __init__(self, app, conn, path='/_ldap_stats', authorize=local_only):
+        self.app = app
+        self.stats_app = StatsApp(conn, authorize=authorize)
+        self.path = path
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') == self.path:
+            return self.stats_app(environ, start_response)
+        return self.app(environ, start_response)
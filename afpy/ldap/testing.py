@@ -1,5 +1,89 @@
 # -*- coding: utf-8 -*-
+#Copyright (C) 2009 Gael Pasgrimaud
+__doc__ = """Testing helpers.
+
+:class:`MemoryConnection` is a :class:`~afpy.ldap.connection.Connection` to
+an in memory directory. No server is needed:
+
+.. sourcecode:: py
+
+    >>> conn = memory_connection()
+    >>> conn.search_nodes(filter='(uid=gawel)')
+    [<Node at uid=gawel,ou=members,dc=afpy,dc=org>]
+    >>> from afpy.ldap.node import User
+    >>> user = User(dn='uid=gawel,ou=members,dc=afpy,dc=org', conn=conn)
+    >>> user.check('secret'), user.check('toto')
+    (True, False)
+    >>> user.mail = 'gael@afpy.org'
+    >>> user.save()
+    >>> conn.directory.get('uid=gawel,ou=members,dc=afpy,dc=org')['mail']
+    ['gael@afpy.org']
+
+The directory support base/one/sub scopes, the filters of
+:mod:`~afpy.ldap.filters`, add/modify/modrdn/delete, simple binds against
+``userPassword`` values (plain or hashed, see
+:mod:`~afpy.ldap.passwords`), the server's size limit
+and the Simple Paged Results control. There is no access control and no
+schema checking.
+
+Use ``memory_connection(ldif)`` to load your own entries. A
+:class:`MemoryDirectory` can be shared by many connections.
+"""
+from StringIO import StringIO
+from collections import deque
+from ConfigObject import ConfigObject
+from ldap.controls import SimplePagedResultsControl
+from afpy.ldap.connection import Connection
+from afpy.ldap.aio import AsyncConnection
+from afpy.ldap.connection import ldapconnection_from_config
+from afpy.ldap.passwords import verify
+from afpy.ldap.utils import normalize_dn
+from afpy.ldap.replica import in_scope
+from afpy.ldap import filters
 import afpy.ldap
+import threading
+import time
+import ldap
+
+# returned only when asked for
+OPERATIONAL_ATTRIBUTES = ('createtimestamp', 'modifytimestamp')
+
+SAMPLE_LDIF = """
+dn: dc=afpy,dc=org
+objectClass: top
+objectClass: dcObject
+objectClass: organization
+dc: afpy
+o: AFPy
+
+dn: ou=members,dc=afpy,dc=org
+objectClass: top
+objectClass: organizationalUnit
+ou: members
+
+dn: ou=groups,dc=afpy,dc=org
+objectClass: top
+objectClass: organizationalUnit
+ou: groups
+
+dn: uid=gawel,ou=members,dc=afpy,dc=org
+objectClass: top
+objectClass: person
+objectClass: organizationalPerson
+objectClass: inetOrgPerson
+uid: gawel
+cn: Gael Pasgrimaud
+sn: Pasgrimaud
+mail: gael@gawel.org
+birthDate: 19750410000000Z
+userPassword: {SSHA}4quMECnTMGBp5iXN+oM7elda7HRhZnB5c2FsdA==
+
+dn: cn=bureau,ou=groups,dc=afpy,dc=org
+objectClass: top
+objectClass: groupOfNames
+cn: bureau
+member: uid=gawel,ou=members,dc=afpy,dc=org
+"""
 
 
 class ExtendedNode(object):
@@ -11,3 +95,455 @@ def get_conn():
     ldap = afpy.ldap.Connection()
     return afpy.ldap.Connection(section=ldap.config.tests.section)
 
+def _error(klass, desc, info=''):
+    return klass(dict(desc=desc, info=info))
+
+def _timestamp():
+    return time.strftime('%Y%m%d%H%M%SZ', time.gmtime())
+
+def compare_password(value, password):
+    """compare a plain password with a ``userPassword`` value"""
+    return verify(password, value)
+
+def _values(value):
+    if value is None:
+        return []
+    if isinstance(value, basestring):
+        return [value]
+    return [str(v) for v in value]
+
+
+class MemoryDirectory(object):
+    """a thread safe in memory directory. dn and values use the server's
+    encoding (utf-8). ``root_dn`` can bind with ``root_pwd`` without an
+    entry. Entries other than ``suffix`` need a parent if ``suffix`` is
+    set. ``sizelimit`` is the max number of entries returned by a search"""
+
+    def __init__(self, entries=(), suffix=None, root_dn='cn=admin,dc=afpy,dc=org',
+                 root_pwd='secret', sizelimit=0):
+        self.suffix = suffix and normalize_dn(suffix) or None
+        self.root_dn = root_dn
+        self.root_pwd = root_pwd
+        self.sizelimit = sizelimit
+        # normalized dn -> (dn, {lower name: (name, values)})
+        self._entries = {}
+        self._lock = threading.RLock()
+        for dn, entry in entries:
+            self.add(dn, entry)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, dn):
+        return normalize_dn(dn) in self._entries
+
+    def ldap_object(self, uri='ldap://memory', *args, **kwargs):
+        """factory used as ``c_factory`` by ``LDAPConnection``"""
+        return MemoryLDAPObject(self, uri)
+
+    def _entry(self, key, dn=None):
+        try:
+            return self._entries[key]
+        except KeyError:
+            raise _error(ldap.NO_SUCH_OBJECT, 'No such object', dn or key)
+
+    def _children(self, key):
+        return [k for k in self._entries if in_scope(k, key, ldap.SCOPE_ONELEVEL)]
+
+    def _check_parent(self, key, dn):
+        if self.suffix is None or key == self.suffix:
+            return
+        if ',' not in key or key.split(',', 1)[1] not in self._entries:
+            raise _error(ldap.NO_SUCH_OBJECT, 'No such object', dn)
+
+    def get(self, dn, attrs=None):
+        """return a copy of the entry or None"""
+        with self._lock:
+            item = self._entries.get(normalize_dn(dn))
+            if item is None:
+                return None
+            return self._project(item[1], attrs)
+
+    def add(self, dn, entry):
+        """add an entry. entry is a dict or a list of ``(attr, values)``"""
+        if isinstance(entry, dict):
+            entry = entry.items()
+        key = normalize_dn(dn)
+        data = {}
+        for attr, values in entry:
+            if attr.lower() == 'dn':
+                continue
+            values = _values(values)
+            if values:
+                data.setdefault(attr.lower(), (attr, []))[1].extend(values)
+        rdn_attr, rdn_value = dn.split(',', 1)[0].split('=', 1)
+        rdn_attr, rdn_value = rdn_attr.strip(), rdn_value.strip()
+        name, values = data.setdefault(rdn_attr.lower(), (rdn_attr, []))
+        if rdn_value.lower() not in [v.lower() for v in values]:
+            values.append(rdn_value)
+        now = _timestamp()
+        data['createtimestamp'] = ('createTimestamp', [now])
+        data['modifytimestamp'] = ('modifyTimestamp', [now])
+        with self._lock:
+            if key in self._entries:
+                raise _error(ldap.ALREADY_EXISTS, 'Already exists', dn)
+            self._check_parent(key, dn)
+            self._entries[key] = (dn, data)
+
+    def modify(self, dn, modlist):
+        """apply a python-ldap modlist. The entry is not changed if an
+        operation fails"""
+        key = normalize_dn(dn)
+        with self._lock:
+            dn, current = self._entry(key, dn)
+            data = dict([(k, (n, list(v))) for k, (n, v) in current.items()])
+            for op, attr, values in modlist:
+                values = _values(values)
+                lattr = attr.lower()
+                name, old = data.get(lattr, (attr, []))
+                if op == ldap.MOD_ADD:
+                    for v in values:
+                        if v in old:
+                            raise _error(ldap.TYPE_OR_VALUE_EXISTS,
+                                         'Type or value exists', '%s: %s' % (attr, v))
+                    new = old + values
+                elif op == ldap.MOD_DELETE:
+                    if not old or [v for v in values if v not in old]:
+                        raise _error(ldap.NO_SUCH_ATTRIBUTE, 'No such attribute', attr)
+                    new = values and [v for v in old if v not in values] or []
+                elif op == ldap.MOD_REPLACE:
+                    new = values
+                else:
+                    raise _error(ldap.UNWILLING_TO_PERFORM,
+                                 'Unsupported modify operation', str(op))
+                if new:
+                    data[lattr] = (name, new)
+                else:
+                    data.pop(lattr, None)
+            data['modifytimestamp'] = ('modifyTimestamp', [_timestamp()])
+            self._entries[key] = (dn, data)
+
+    def delete(self, dn):
+        key = normalize_dn(dn)
+        with self._lock:
+            self._entry(key, dn)
+            if self._children(key):
+                raise _error(ldap.NOT_ALLOWED_ON_NONLEAF,
+                             'Operation not allowed on non-leaf', dn)
+            del self._entries[key]
+
+    def rename(self, dn, newrdn, newsuperior=None, delold=1):
+        """modrdn. Only leaf entries can be renamed"""
+        key = normalize_dn(dn)
+        with self._lock:
+            dn, data = self._entry(key, dn)
+            if self._children(key):
+                raise _error(ldap.NOT_ALLOWED_ON_NONLEAF,
+                             'Operation not allowed on non-leaf', dn)
+            if newsuperior is None:
+                newsuperior = dn.split(',', 1)[1]
+            new_dn = '%s,%s' % (newrdn, newsuperior)
+            new_key = normalize_dn(new_dn)
+            if new_key != key and new_key in self._entries:
+                raise _error(ldap.ALREADY_EXISTS, 'Already exists', new_dn)
+            self._check_parent(new_key, new_dn)
+            modlist = []
+            if delold:
+                attr, value = dn.split(',', 1)[0].split('=', 1)
+                modlist.append((ldap.MOD_DELETE, attr.strip(), [value.strip()]))
+            attr, value = newrdn.split('=', 1)
+            modlist.append((ldap.MOD_ADD, attr.strip(), [value.strip()]))
+            del self._entries[key]
+            self._entries[new_key] = (new_dn, data)
+            try:
+                self.modify(new_dn, modlist)
+            except ldap.LDAPError:
+                del self._entries[new_key]
+                self._entries[key] = (dn, data)
+                raise
+
+    def search(self, base, scope=ldap.SCOPE_SUBTREE, filterstr='(objectClass=*)',
+               attrs=None):
+        """return a list of ``(dn, entry)``. Parents come before children"""
+        try:
+            fltr = filters.parse(filterstr or '(objectClass=*)')
+        except ValueError, e:
+            raise _error(ldap.FILTER_ERROR, 'Bad search filter', str(e))
+        base = base or ''
+        base_key = normalize_dn(base)
+        with self._lock:
+            if base_key:
+                self._entry(base_key, base)
+            keys = [k for k in self._entries
+                        if not base_key or in_scope(k, base_key, scope)]
+            keys.sort(key=lambda k: list(reversed(k.split(','))))
+            results = []
+            for k in keys:
+                dn, data = self._entries[k]
+                if fltr.match(dict([(n, [filters.normalize_value(n, v) for v in values])
+                                    for n, (name, values) in data.items()])):
+                    results.append((dn, self._project(data, attrs)))
+        return results
+
+    def _project(self, data, attrs):
+        """return a copy of the entry with only attrs"""
+        if attrs is None:
+            attrs = ['*']
+        attrs = set([a.lower() for a in attrs])
+        entry = {}
+        for lattr, (name, values) in data.items():
+            if lattr in OPERATIONAL_ATTRIBUTES:
+                if '+' not in attrs and lattr not in attrs:
+                    continue
+            elif '*' not in attrs and lattr not in attrs:
+                continue
+            entry[name] = list(values)
+        return entry
+
+    def bind(self, who, cred):
+        """raise ``ldap.INVALID_CREDENTIALS`` if the credentials are wrong"""
+        if not who:
+            return
+        if not cred:
+            # unauthenticated bind
+            raise _error(ldap.UNWILLING_TO_PERFORM,
+                         'Unauthenticated bind (DN with no password) disallowed')
+        if self.root_dn and normalize_dn(who) == normalize_dn(self.root_dn):
+            if cred == self.root_pwd:
+                return
+            raise _error(ldap.INVALID_CREDENTIALS, 'Invalid credentials')
+        with self._lock:
+            item = self._entries.get(normalize_dn(who))
+            values = item and item[1].get('userpassword', (None, []))[1] or []
+        for value in values:
+            if compare_password(value, cred):
+                return
+        raise _error(ldap.INVALID_CREDENTIALS, 'Invalid credentials')
+
+    def load(self, fileobj):
+        """add the entries of a LDIF file"""
+        from afpy.ldap.ldif import read_entries
+        for dn, entry in read_entries(fileobj):
+            self.add(dn, entry)
+
+
+class MemoryLDAPObject(object):
+    """implement the part of python-ldap's ``LDAPObject`` used by
+    dataflake.ldapconnection and afpy.ldap. Requests are done at once.
+    Responses of asynchronous requests are kept until ``result3`` is
+    called"""
+
+    def __init__(self, directory, uri='ldap://memory'):
+        self.directory = directory
+        self._uri = uri
+        self.timeout = -1
+        self.protocol_version = ldap.VERSION3
+        self.who = ''
+        self._last_bind = None
+        self._options = {}
+        self._responses = {}
+        self._msgid = 0
+        self._closed = False
+
+    def _check(self):
+        if self._closed:
+            raise _error(ldap.SERVER_DOWN, "Can't contact LDAP server", self._uri)
+
+    def _send(self, request, *args):
+        """do a request. request return a list of ``(rtype, data, ctrls)``
+        or raise"""
+        self._check()
+        self._msgid += 1
+        try:
+            responses = request(*args)
+        except ldap.LDAPError, e:
+            responses = [e]
+        self._responses[self._msgid] = deque(responses)
+        return self._msgid
+
+    def _request(self, rtype, func, *args):
+        def request():
+            func(*args)
+            return [(rtype, [], [])]
+        return self._send(request)
+
+    def result3(self, msgid=ldap.RES_ANY, all=1, timeout=None):
+        self._check()
+        if msgid == ldap.RES_ANY and self._responses:
+            msgid = min(self._responses)
+        responses = self._responses.get(msgid)
+        if responses is None:
+            if timeout == 0:
+                return (None, None, None, None)
+            raise _error(ldap.TIMEOUT, 'Timed out')
+        data = []
+        while responses:
+            response = responses.popleft()
+            if isinstance(response, ldap.LDAPError):
+                del self._responses[msgid]
+                raise response
+            rtype, rdata, ctrls = response
+            data.extend(rdata)
+            if not all:
+                break
+        if not responses:
+            del self._responses[msgid]
+        return (rtype, data, msgid, ctrls)
+
+    def result2(self, msgid=ldap.RES_ANY, all=1, timeout=None):
+        return self.result3(msgid, all, timeout)[:3]
+
+    def result(self, msgid=ldap.RES_ANY, all=1, timeout=None):
+        return self.result3(msgid, all, timeout)[:2]
+
+    def abandon(self, msgid, serverctrls=None, clientctrls=None):
+        self._responses.pop(msgid, None)
+
+    abandon_ext = abandon
+
+    def fileno(self):
+        # responses are always ready. There is nothing to wait for
+        raise _error(ldap.LDAPError, 'No socket for an in memory directory')
+
+    def set_option(self, option, value):
+        self._options[option] = value
+
+    def get_option(self, option):
+        return self._options.get(option)
+
+    def start_tls_s(self):
+        self._check()
+
+    def _bind(self, who, cred):
+        try:
+            self.directory.bind(who, cred)
+        except ldap.LDAPError:
+            self.who = ''
+            self._last_bind = None
+            raise
+        self.who = who
+        self._last_bind = (self.simple_bind_s, (who, cred), {})
+        return [(ldap.RES_BIND, [], [])]
+
+    def simple_bind(self, who='', cred='', serverctrls=None, clientctrls=None):
+        return self._send(self._bind, who, cred)
+
+    def simple_bind_s(self, who='', cred='', serverctrls=None, clientctrls=None):
+        return self.result(self.simple_bind(who, cred), all=1)
+
+    def whoami_s(self, serverctrls=None, clientctrls=None):
+        self._check()
+        return self.who and 'dn:%s' % self.who or ''
+
+    def unbind_s(self, serverctrls=None, clientctrls=None):
+        self._closed = True
+        self._responses.clear()
+
+    unbind = unbind_ext = unbind_ext_s = unbind_s
+
+    def _search(self, base, scope, filterstr, attrlist, serverctrls, sizelimit):
+        results = self.directory.search(base, scope, filterstr, attrlist)
+        limits = [l for l in (sizelimit, self.directory.sizelimit) if l > 0]
+        ctrls = []
+        paged = [c for c in serverctrls or ()
+                   if c.controlType == SimplePagedResultsControl.controlType]
+        if paged:
+            size, cookie = paged[0].size, paged[0].cookie
+            start = cookie and int(cookie) or 0
+            end = start + size
+            if size and end < len(results):
+                cookie = str(end)
+            else:
+                cookie = ''
+            ctrls.append(SimplePagedResultsControl(True, size=len(results),
+                                                   cookie=cookie))
+            # a page size of 0 abandon the paged search
+            results = size and results[start:end] or []
+        responses = [(ldap.RES_SEARCH_ENTRY, [r], []) for r in results]
+        if limits and len(results) > min(limits):
+            responses = responses[:min(limits)]
+            responses.append(_error(ldap.SIZELIMIT_EXCEEDED, 'Size limit exceeded'))
+        else:
+            responses.append((ldap.RES_SEARCH_RESULT, [], ctrls))
+        return responses
+
+    def search_ext(self, base, scope, filterstr='(objectClass=*)', attrlist=None,
+                   attrsonly=0, serverctrls=None, clientctrls=None, timeout=-1,
+                   sizelimit=0):
+        return self._send(self._search, base, scope, filterstr, attrlist,
+                          serverctrls, sizelimit)
+
+    def search_ext_s(self, base, scope, filterstr='(objectClass=*)', attrlist=None,
+                     attrsonly=0, serverctrls=None, clientctrls=None, timeout=-1,
+                     sizelimit=0):
+        msgid = self.search_ext(base, scope, filterstr, attrlist,
+                                serverctrls=serverctrls, sizelimit=sizelimit)
+        return self.result(msgid, all=1)[1]
+
+    def search_s(self, base, scope, filterstr='(objectClass=*)', attrlist=None,
+                 attrsonly=0):
+        return self.search_ext_s(base, scope, filterstr, attrlist)
+
+    def add_ext(self, dn, modlist, serverctrls=None, clientctrls=None):
+        return self._request(ldap.RES_ADD, self.directory.add, dn, modlist)
+
+    def add_s(self, dn, modlist):
+        return self.result(self.add_ext(dn, modlist), all=1)
+
+    def modify_ext(self, dn, modlist, serverctrls=None, clientctrls=None):
+        return self._request(ldap.RES_MODIFY, self.directory.modify, dn, modlist)
+
+    def modify_s(self, dn, modlist):
+        return self.result(self.modify_ext(dn, modlist), all=1)
+
+    def delete_ext(self, dn, serverctrls=None, clientctrls=None):
+        return self._request(ldap.RES_DELETE, self.directory.delete, dn)
+
+    def delete_s(self, dn):
+        return self.result(self.delete_ext(dn), all=1)
+
+    def rename(self, dn, newrdn, newsuperior=None, delold=1,
+               serverctrls=None, clientctrls=None):
+        return self._request(ldap.RES_MODRDN, self.directory.rename,
+                             dn, newrdn, newsuperior, delold)
+
+    def rename_s(self, dn, newrdn, newsuperior=None, delold=1,
+                 serverctrls=None, clientctrls=None):
+        return self.result(self.rename(dn, newrdn, newsuperior, delold), all=1)
+
+    def modrdn_s(self, dn, newrdn, delold=1):
+        return self.rename_s(dn, newrdn, None, delold)
+
+
+class MemoryConnection(Connection):
+    """a :class:`~afpy.ldap.connection.Connection` to a
+    :class:`MemoryDirectory`. ``options`` are the ``ldap.*`` options of a
+    config section without the prefix"""
+
+    def __init__(self, directory=None, **options):
+        if directory is None:
+            directory = MemoryDirectory()
+        self.directory = directory
+        options.setdefault('bind_dn', directory.root_dn)
+        options.setdefault('bind_pwd', directory.root_pwd)
+        options.setdefault('base_dn', directory.suffix or 'dc=afpy,dc=org')
+        config = ConfigObject()
+        config['memory'] = dict([('ldap.%s' % k, v) for k, v in options.items()])
+        super(MemoryConnection, self).__init__(section='memory', config=config)
+
+    def connection_factory(self, *args, **kwargs):
+        config = dict(self.section.items())
+        return ldapconnection_from_config(config, prefix=self.prefix,
+                                          c_factory=self.directory.ldap_object)
+
+class MemoryAsyncConnection(MemoryConnection, AsyncConnection):
+    """a :class:`~afpy.ldap.aio.AsyncConnection` to a
+    :class:`MemoryDirectory`. Responses are available as soon as a request
+    is sent"""
+
+def memory_connection(ldif=SAMPLE_LDIF, klass=MemoryConnection, **options):
+    """return a :class:`MemoryConnection` (or ``klass``) to a new directory
+    with the entries of ldif (a string)"""
+    directory = MemoryDirectory(suffix='dc=afpy,dc=org')
+    directory.load(StringIO(ldif))
+    return klass(directory, **options)
@@ -4,8 +4,12 @@ import datetime
 import afpy.ldap
 import afpy.ldap.utils
 from afpy.ldap import custom
+from afpy.ldap import testing
+from ldap import SCOPE_BASE, SCOPE_ONELEVEL
+from ldap import NO_SUCH_OBJECT, NOT_ALLOWED_ON_NONLEAF, SIZELIMIT_EXCEEDED
+from ldap import USER_CANCELLED, MOD_REPLACE
 
-ldap = afpy.ldap.Connection(section='afpy')
+ldap = testing.memory_connection()
 ldap.bind(custom.User, custom.Group)
 
 def test_datetime_serializer():
@@ -28,7 +32,7 @@ def test_int_serializer():
     assert afpy.ldap.utils.to_string(value) == '2'
 
 def test_dn():
-    assert ldap.config.tests.base_dn in ldap.base_dn, ldap.base_dn
+    assert 'dc=afpy,dc=org' in ldap.base_dn, ldap.base_dn
 
 def test_search():
     results = ldap.search(filter='(uid=gawel)')
@@ -40,4 +44,562 @@ def test_search():
 def test_credential():
     user = ldap.get_user('gawel')
     assert user.check('toto') is False
+    assert user.check('secret') is True
 
+def test_scopes():
+    results = ldap.search(base_dn='ou=members,dc=afpy,dc=org', scope=SCOPE_BASE)
+    assert len(results) == 1, results
+
+    results = ldap.search(base_dn='dc=afpy,dc=org', scope=SCOPE_ONELEVEL)
+    assert len(results) == 2, results
+
+    results = ldap.search(base_dn='dc=afpy,dc=org')
+    assert len(results) == 5, results
+
+    try:
+        ldap.search(base_dn='ou=missing,dc=afpy,dc=org')
+    except NO_SUCH_OBJECT:
+        pass
+    else:
+        raise AssertionError('NO_SUCH_OBJECT not raised')
+
+def test_filters():
+    results = ldap.search(filter='(&(objectClass=person)(|(cn=*pasgri*)(uid=nobody)))')
+    assert len(results) == 1, results
+
+    results = ldap.search(filter='(&(uid=*)(!(birthDate>=19800101000000Z)))')
+    assert len(results) == 1, results
+
+    results = ldap.search(filter='(birthDate<=19700101000000Z)')
+    assert len(results) == 0, results
+
+def test_paged_search():
+    conn = testing.memory_connection()
+    conn.directory.sizelimit = 2
+    try:
+        conn.search(filter='(objectClass=*)')
+    except SIZELIMIT_EXCEEDED:
+        pass
+    else:
+        raise AssertionError('SIZELIMIT_EXCEEDED not raised')
+
+    results = conn.search(filter='(objectClass=*)', page_size=2)
+    assert len(results) == 5, results
+
+    results = list(conn.iter_search(filter='(objectClass=*)', page_size=2))
+    assert len(results) == 5, results
+
+def test_add_modify_delete():
+    user = custom.User('afpy_test_user', attrs=dict(cn='Test User', sn='Test'), conn=ldap)
+    ldap.add(user)
+    assert 'uid=afpy_test_user,ou=members,dc=afpy,dc=org' in ldap.directory
+
+    user = ldap.get_user('afpy_test_user')
+    user.title = 'tester'
+    user.save()
+    assert ldap.get_user('afpy_test_user').title == 'tester'
+
+    user.change_password('toto')
+    assert user.check('toto') is True
+
+    try:
+        ldap.delete(ldap.get_node('ou=members,dc=afpy,dc=org'))
+    except NOT_ALLOWED_ON_NONLEAF:
+        pass
+    else:
+        raise AssertionError('NOT_ALLOWED_ON_NONLEAF not raised')
+
+    ldap.delete(user)
+    assert 'uid=afpy_test_user,ou=members,dc=afpy,dc=org' not in ldap.directory
+
+def test_groups():
+    groups = ldap.get_groups('uid=gawel,ou=members,dc=afpy,dc=org')
+    assert [g.cn for g in groups] == ['bureau'], groups
+
+def test_batch():
+    conn = testing.memory_connection()
+    with conn.batch() as batch:
+        for uid in ('user1', 'user2'):
+            node = conn.node_class('uid=%s,ou=members,dc=afpy,dc=org' % uid,
+                                   attrs=dict(objectClass=['top', 'person'],
+                                              cn=uid, sn=uid), conn=conn)
+            conn.add(node)
+        node = conn.node_class('uid=orphan,ou=missing,dc=afpy,dc=org',
+                               attrs=dict(objectClass=['top', 'person'],
+                                          cn='orphan', sn='orphan'), conn=conn)
+        conn.add(node)
+    assert len(conn.directory) == 7, len(conn.directory)
+    assert [e[1] for e in batch.errors] == ['uid=orphan,ou=missing,dc=afpy,dc=org'], batch.errors
+    node = conn.node_class('uid=user3,ou=members,dc=afpy,dc=org',
+                           attrs=dict(dn='uid=other,ou=members,dc=afpy,dc=org',
+                                      objectClass=['top', 'person'],
+                                      cn='user3', sn='user3'), conn=conn)
+    with conn.batch():
+        try:
+            conn.add(node)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('ValueError not raised')
+    assert 'uid=other,ou=members,dc=afpy,dc=org' not in conn.directory
+    assert 'uid=user3,ou=members,dc=afpy,dc=org' not in conn.directory
+
+def test_stats():
+    conn = testing.memory_connection(stats='true', slow_threshold='0.000001')
+    conn.search(filter='(uid=gawel)')
+    conn.get_groups('uid=gawel,ou=members,dc=afpy,dc=org',
+                    base_dn='ou=groups,dc=afpy,dc=org')
+    conn.check('uid=gawel,ou=members,dc=afpy,dc=org', 'toto')
+    snapshot = conn.stats.snapshot()
+    operations = snapshot['operations']
+    assert operations['search']['count'] == 2, operations
+    assert operations['search']['size_total'] == 2, operations
+    assert operations['bind']['errors'] == 1, operations
+    callers = [c['caller'] for c in snapshot['callers']]
+    assert [c for c in callers if c.startswith('get_groups <- ')], callers
+    assert len(snapshot['slow']) == 3, snapshot['slow']
+
+def test_stats_app():
+    from afpy.ldap.stats import StatsApp
+    import json
+    conn = testing.memory_connection(stats='true', slow_threshold='0.000001')
+    conn.search(filter='(uid=gawel)')
+    conn.search(filter='(cn=Ga\xebl)')
+    app = StatsApp(conn)
+    status = []
+    def request(method, addr='127.0.0.1', query=''):
+        environ = dict(REQUEST_METHOD=method, REMOTE_ADDR=addr, QUERY_STRING=query)
+        body = app(environ, lambda s, headers: status.append(s))
+        return status[-1].split()[0], ''.join(body)
+    assert request('GET', addr='10.0.0.1')[0] == '403'
+    assert request('DELETE')[0] == '405'
+    code, body = request('GET', query='reset=1')
+    assert code == '200', body
+    filters = [e['filter'] for e in json.loads(body)['slow']]
+    assert u'(cn=Ga\xebl)' in filters, filters
+    assert conn.stats.snapshot()['operations']['search']['count'] == 2
+    assert request('POST')[0] == '200'
+    assert 'search' not in conn.stats.snapshot()['operations']
+
+def test_thaw():
+    conn = testing.memory_connection()
+    dn = 'uid=gawel,ou=members,dc=afpy,dc=org'
+    frozen = conn.search_nodes(filter='(uid=gawel)', attrs=['uid', 'cn'], frozen=True)[0]
+    try:
+        frozen._dn = 'uid=other,ou=members,dc=afpy,dc=org'
+    except TypeError:
+        pass
+    else:
+        raise AssertionError('TypeError not raised')
+    assert frozen.thaw().mail == 'gael@gawel.org'
+    node = frozen.thaw()
+    node.mail = 'new@afpy.org'
+    node.save()
+    assert conn.directory.get(dn)['mail'] == ['new@afpy.org'], conn.directory.get(dn)
+    frozen = afpy.ldap.node.Node.frozen_class().from_entry(dn, {'description': ['']})
+    assert frozen.description == '', frozen.description
+
+def test_identity_map():
+    from afpy.ldap.identity import IdentityMap
+    from afpy.ldap.node import User
+    conn = testing.memory_connection()
+    dn = 'uid=gawel,ou=members,dc=afpy,dc=org'
+    with IdentityMap(conn) as identity_map:
+        user = conn.get_node(dn, node_class=User)
+        assert user is conn.get_nodes([dn], node_class=User)[0]
+        user.mail = 'gael@afpy.org'
+        assert identity_map.dirty() == [user], identity_map.dirty()
+    assert len(identity_map) == 0
+    assert conn.directory.get(dn)['mail'] == ['gael@afpy.org']
+    assert conn.get_node(dn, node_class=User) is not user
+
+def test_identity_map_batch_delete():
+    from afpy.ldap.identity import IdentityMap
+    from afpy.ldap.node import User
+    conn = testing.memory_connection()
+    dn = 'uid=gawel,ou=members,dc=afpy,dc=org'
+    with IdentityMap(conn) as identity_map:
+        user = conn.get_node(dn, node_class=User)
+        with conn.batch(raise_errors=True):
+            conn.delete(user)
+        assert len(identity_map) == 0
+    assert conn.directory.get(dn) is None
+
+def test_passwords():
+    from afpy.ldap import passwords
+    conn = testing.memory_connection()
+    for i in range(3):
+        conn.directory.add('uid=plain%s,ou=members,dc=afpy,dc=org' % i,
+                           dict(objectClass=['top', 'person'], userPassword=['pass%s' % i]))
+    report = passwords.audit(conn, page_size=2)
+    assert report.count == 4, report.count
+    assert report.schemes == {'plain': 3, 'ssha': 1}, report.schemes
+    assert len(report.weak) == 3, report.weak
+    assert passwords.migrate(conn, scheme='ssha256', batch_size=2, processes=1) == 3
+    assert passwords.audit(conn).schemes == {'ssha256': 3, 'ssha': 1}
+    assert conn.check('uid=plain1,ou=members,dc=afpy,dc=org', 'pass1') is True
+    dn = 'uid=gawel,ou=members,dc=afpy,dc=org'
+    assert passwords.rehash(conn, dn, 'toto', 'pbkdf2-sha256', rounds=10) is False
+    assert passwords.rehash(conn, dn, 'secret', 'pbkdf2-sha256', rounds=10) is True
+    assert passwords.classify(conn.directory.get(dn)['userPassword'][0]) == 'pbkdf2-sha256'
+    assert conn.check(dn, 'secret') is True
+
+def test_save_unloaded_attributes():
+    from afpy.ldap import node, schema
+    class Login(node.Node):
+        _rdn = 'uid'
+        uid = schema.StringProperty('uid')
+    conn = testing.memory_connection()
+    dn = 'uid=gawel,ou=members,dc=afpy,dc=org'
+    user = conn.search_nodes(node_class=Login, filter='(uid=gawel)')[0]
+    user.mail = 'gael@afpy.org'
+    conn.save(user)
+    assert conn.directory.get(dn)['mail'] == ['gael@afpy.org'], conn.directory.get(dn)
+
+    user = conn.search_nodes(node_class=Login, filter='(uid=gawel)')[0]
+    del user.birthDate
+    with conn.batch(raise_errors=True):
+        conn.save(user)
+    assert 'birthDate' not in conn.directory.get(dn), conn.directory.get(dn)
+
+def test_save_split_values():
+    conn = testing.memory_connection()
+    dn = 'uid=gawel,ou=members,dc=afpy,dc=org'
+    user = conn.search_nodes(filter='(uid=gawel)', attrs=['mail'])[0]
+    user.mail = 'a@afpy.org;b@afpy.org'
+    conn.save(user)
+    assert conn.directory.get(dn)['mail'] == ['a@afpy.org', 'b@afpy.org'], conn.directory.get(dn)
+
+def test_batch_rename():
+    from afpy.ldap import node
+    class Member(node.Node):
+        _rdn = 'uid'
+    conn = testing.memory_connection()
+    user = Member(dn='uid=gawel,ou=members,dc=afpy,dc=org', conn=conn)
+    user.uid = 'gael'
+    with conn.batch(raise_errors=True) as batch:
+        conn.save(user)
+    assert 'uid=gael,ou=members,dc=afpy,dc=org' in conn.directory
+    assert 'uid=gawel,ou=members,dc=afpy,dc=org' not in conn.directory
+
+def test_async_poll():
+    conn = testing.memory_connection(klass=testing.MemoryAsyncConnection)
+    ops = [conn.search(filter='(uid=gawel)'),
+           conn.get_dn('uid=gawel,ou=members,dc=afpy,dc=org'),
+           conn.get_dn('uid=nobody,ou=members,dc=afpy,dc=org'),
+           conn.check('uid=gawel,ou=members,dc=afpy,dc=org', 'secret'),
+           conn.check('uid=gawel,ou=members,dc=afpy,dc=org', 'toto')]
+    assert len(conn.poll()) == 5
+    assert [e['dn'] for e in ops[0].result()] == ['uid=gawel,ou=members,dc=afpy,dc=org']
+    assert ops[1].result()['size'] == 1
+    assert isinstance(ops[2].exception(), ValueError), ops[2].exception()
+    assert ops[3].result() is True
+    assert ops[4].result() is False
+    assert conn.poll() == []
+
+def test_async_callbacks():
+    conn = testing.memory_connection(klass=testing.MemoryAsyncConnection)
+    done = []
+    op = conn.search_nodes(filter='(uid=gawel)')
+    op.add_done_callback(done.append)
+    assert done == []
+    assert conn.wait([op], timeout=1) == [op]
+    assert done == [op]
+    assert op.result()[0].dn == 'uid=gawel,ou=members,dc=afpy,dc=org'
+    # called at once when the operation is complete
+    op.add_done_callback(done.append)
+    assert done == [op, op]
+
+def test_async_cancel():
+    conn = testing.memory_connection(klass=testing.MemoryAsyncConnection)
+    op = conn.search(filter='(objectClass=*)')
+    op.cancel()
+    assert op.done
+    assert conn.poll() == []
+    try:
+        op.result()
+    except USER_CANCELLED:
+        pass
+    else:
+        raise AssertionError('USER_CANCELLED not raised')
+
+def test_async_save():
+    from afpy.ldap import node
+    class Member(node.Node):
+        _rdn = 'uid'
+    conn = testing.memory_connection(klass=testing.MemoryAsyncConnection)
+    user = Member(dn='uid=gawel,ou=members,dc=afpy,dc=org', conn=conn)
+    conn.load(user).result()
+    user.uid = 'gael'
+    user.mail = 'gael@afpy.org'
+    assert conn.save(user).result(timeout=1) is True
+    entry = conn.directory.get('uid=gael,ou=members,dc=afpy,dc=org')
+    assert entry['mail'] == ['gael@afpy.org'], entry
+    assert 'uid=gawel,ou=members,dc=afpy,dc=org' not in conn.directory
+    user._data = {'dn': 'uid=other,ou=members,dc=afpy,dc=org', 'mail': 'x'}
+    try:
+        conn.save(user)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('ValueError not raised')
+
+def test_replica():
+    from afpy.ldap.replica import Replica
+    conn = testing.memory_connection()
+    replica = Replica(conn, bases=['ou=members,dc=afpy,dc=org'], mode='poll',
+                      full_scan_interval=3600)
+    dn = 'uid=gawel,ou=members,dc=afpy,dc=org'
+    new_dn = 'uid=new,ou=members,dc=afpy,dc=org'
+    # initial load
+    assert replica.lookup(dn) is None
+    assert replica.sync() == 2
+    assert replica.lookup(dn)['results'][0]['mail'] == ['gael@gawel.org']
+    assert replica.lookup('cn=bureau,ou=groups,dc=afpy,dc=org') is None
+
+    # incremental poll
+    conn.directory.add(new_dn, dict(objectClass=['top', 'person'], cn='new', sn='new'))
+    conn.directory.modify(dn, [(MOD_REPLACE, 'mail', ['gael@afpy.org'])])
+    replica.sync()
+    assert replica.lookup(dn)['results'][0]['mail'] == ['gael@afpy.org']
+    assert [e['dn'] for e in replica.search(new_dn, SCOPE_BASE)] == [new_dn]
+
+    # deleted entries are found by the full scan
+    conn.directory.delete(new_dn)
+    replica.sync()
+    assert replica.lookup(new_dn)['size'] == 1
+    replica.sync(full_scan=True)
+    try:
+        replica.lookup(new_dn)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('ValueError not raised')
+
+    # entries written by the process are read from the server until synced
+    conn.replica = replica
+    conn.invalidation_hooks.append(replica.invalidate)
+    user = conn.get_node(dn)
+    user.mail = 'gawel@afpy.org'
+    conn.save(user)
+    assert replica.lookup(dn) is None
+    assert conn.get_dn(dn)['results'][0]['mail'] == ['gawel@afpy.org']
+    replica.sync()
+    assert replica.lookup(dn)['results'][0]['mail'] == ['gawel@afpy.org']
+    node = conn.node_class(new_dn, attrs=dict(objectClass=['top', 'person'],
+                                              cn='new', sn='new'), conn=conn)
+    conn.add(node)
+    replica.sync()
+    assert replica.lookup(new_dn)['size'] == 1
+    conn.delete(node)
+    replica.sync()
+    try:
+        replica.lookup(new_dn)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('ValueError not raised')
+
+def test_invalidate_after_write():
+    conn = testing.memory_connection(cache_size='10')
+    dn = 'uid=gawel,ou=members,dc=afpy,dc=org'
+    # a get_dn() done while the entry is written
+    conn.invalidation_hooks.append(lambda dn: dn and conn.get_dn(dn))
+    user = conn.get_node(dn)
+    user.mail = 'gael@afpy.org'
+    conn.save(user)
+    assert conn.get_dn(dn)['results'][0]['mail'] == ['gael@afpy.org']
+    user.mail = 'gawel@afpy.org'
+    with conn.batch(raise_errors=True):
+        conn.save(user)
+    assert conn.get_dn(dn)['results'][0]['mail'] == ['gawel@afpy.org']
+
+IMPORT_LDIF = """
+dn: ou=people,dc=afpy,dc=org
+objectClass: organizationalUnit
+ou: people
+
+dn: uid=a,ou=people,dc=afpy,dc=org
+objectClass: person
+cn: a
+sn: a
+
+dn: uid=gawel,ou=members,dc=afpy,dc=org
+objectClass: person
+cn: Gael Pasgrimaud
+sn: Pasgrimaud
+
+dn: uid=c,ou=people,dc=afpy,dc=org
+objectClass: person
+cn: c
+sn: c
+
+dn: uid=b,ou=later,dc=afpy,dc=org
+objectClass: person
+cn: b
+sn: b
+
+dn: ou=later,dc=afpy,dc=org
+objectClass: organizationalUnit
+ou: later
+
+dn: uid=d,ou=people,dc=afpy,dc=org
+objectClass: person
+cn: d
+sn: d
+"""
+
+def _interrupted(text):
+    for line in text.splitlines(True):
+        yield line
+    raise IOError('interrupted')
+
+def test_import():
+    import os, tempfile
+    from StringIO import StringIO
+    from afpy.ldap import ldif
+    conn = testing.memory_connection()
+    importer = ldif.Importer(conn, window=4).run(StringIO(IMPORT_LDIF))
+    assert (importer.added, importer.skipped, importer.errors) == (6, 1, [])
+    assert 'uid=b,ou=later,dc=afpy,dc=org' in conn.directory
+
+    # an orphan is added again when an interrupted import is resumed
+    conn = testing.memory_connection()
+    fd, checkpoint = tempfile.mkstemp()
+    os.close(fd)
+    os.remove(checkpoint)
+    try:
+        try:
+            ldif.Importer(conn, window=1, checkpoint=checkpoint).run(_interrupted(IMPORT_LDIF))
+        except IOError:
+            pass
+        else:
+            raise AssertionError('IOError not raised')
+        assert ldif.read_checkpoint(checkpoint) == 4, open(checkpoint).read()
+        assert 'uid=b,ou=later,dc=afpy,dc=org' not in conn.directory
+        importer = ldif.Importer(conn, window=1, checkpoint=checkpoint)
+        importer.run(StringIO(IMPORT_LDIF))
+        # ou=later was sent before the interruption
+        assert (importer.added, importer.skipped, importer.errors) == (2, 1, []), \
+                (importer.added, importer.skipped, importer.errors)
+        assert 'uid=b,ou=later,dc=afpy,dc=org' in conn.directory
+        assert ldif.read_checkpoint(checkpoint) == 7
+    finally:
+        os.remove(checkpoint)
+
+def test_export_and_diff():
+    from StringIO import StringIO
+    from afpy.ldap import ldif
+    conn = testing.memory_connection()
+    out = StringIO()
+    assert ldif.export(conn, out, base_dn='ou=members,dc=afpy,dc=org') == 2
+    out.seek(0)
+    entries = list(ldif.read_entries(out))
+    assert [dn for dn, e in entries] == ['ou=members,dc=afpy,dc=org',
+                                         'uid=gawel,ou=members,dc=afpy,dc=org'], entries
+    dn, entry = entries[1]
+    assert entry['mail'] == ['gael@gawel.org'], entry
+    entry['mail'] = ['gael@afpy.org']
+    out = StringIO()
+    added, differ = ldif.diff_entries(conn, entries + [
+                        ('uid=new,ou=members,dc=afpy,dc=org', {'cn': ['new']})], out=out)
+    assert (added, differ) == (1, 1), out.getvalue()
+    lines = out.getvalue().splitlines()
+    assert 'exists: uid=gawel,ou=members,dc=afpy,dc=org' in lines, lines
+    assert '  - mail: gael@gawel.org' in lines, lines
+    assert '  + mail: gael@afpy.org' in lines, lines
+    assert 'add: uid=new,ou=members,dc=afpy,dc=org (Node)' in lines, lines
+
+def test_groups_cache_use_search():
+    from afpy.ldap import auth
+    from afpy.ldap.utils import normalize_dn
+    conn = testing.memory_connection()
+    conn.bind(custom.User, custom.Group)
+    try:
+        adapter = auth.GroupAdapter(conn, groups_cache_ttl=60)
+        adapter.use_search = True
+        key = normalize_dn('uid=gawel,ou=members,dc=afpy,dc=org')
+        hint = {'repoze.what.userid': 'gawel'}
+        assert adapter._find_sections(hint) == ['bureau']
+        assert adapter.cache.peek(key) == ['bureau'], adapter.cache
+        assert adapter._find_sections(hint) == ['bureau']
+        conn.invalidate('uid=gawel,ou=members,dc=afpy,dc=org')
+        assert adapter.cache.peek(key) is None, adapter.cache
+    finally:
+        ldap.bind(custom.User, custom.Group)
+
+def test_group_tokens():
+    from afpy.ldap import auth
+    tokens = auth.groups_to_tokens(['bureau', 'svn'], now=1000)
+    assert tokens == ('groups@1000', 'group:bureau', 'group:svn'), tokens
+    assert auth.groups_from_tokens(tokens + ('other',)) == ['bureau', 'svn']
+    assert auth.groups_from_tokens(tokens, max_age=60, now=1030) == ['bureau', 'svn']
+    assert auth.groups_from_tokens(tokens, max_age=60, now=1070) is None
+    assert auth.groups_from_tokens(('group:bureau',)) is None
+    assert auth.groups_to_tokens(['a,b']) == ()
+
+def test_rehash():
+    from afpy.ldap import auth, testing, passwords
+    from afpy.ldap.node import User
+    conn = testing.memory_connection(stats='true')
+    authenticator = auth.Authenticator(conn, rehash_scheme='ssha512')
+    dn = 'uid=gawel,ou=members,dc=afpy,dc=org'
+    def searches():
+        return conn.stats.snapshot()['operations'].get('search', {}).get('count', 0)
+    user = conn.get_node(dn, node_class=User)
+    assert authenticator.check(user, 'secret') is True
+    assert passwords.classify(conn.directory.get(dn)['userPassword'][0]) == 'ssha512'
+    count = searches()
+    user = conn.get_node(dn, node_class=User)
+    assert authenticator.check(user, 'secret') is True
+    assert searches() == count
+
+def test_membership():
+    conn = testing.memory_connection()
+    conn.bind(custom.User, custom.Group)
+    try:
+        custom._reports.set((365, None), custom.MembershipReport())
+        user = conn.get_user('gawel')
+        custom.add_payment(user, '01/01/2010')
+        assert custom._reports.get((365, None)) is None
+
+        report = custom.MembershipReport(now=datetime.datetime(2010, 6, 1)).compute(conn)
+        assert report.adherents == set(['gawel']), report.adherents
+        assert report.expired == set(), report.expired
+        report = custom.MembershipReport(now=datetime.datetime(2012, 6, 1)).compute(conn)
+        assert report.expired == set(['gawel']), report.expired
+
+        # expire 400 days after the last payment
+        user = conn.get_user('gawel')
+        assert user.membershipExpirationDate == datetime.date(2011, 2, 5), \
+               user.membershipExpirationDate
+        members = custom.getMembersByExpirationDate(after=datetime.date(2011, 1, 1), conn=conn)
+        assert members == set(['gawel']), members
+        members = custom.getMembersByExpirationDate(before=datetime.date(2011, 1, 1), conn=conn)
+        assert members == set(), members
+
+        assert custom.getExpiringMembers(conn=conn) == set()
+        date = datetime.date.today() - datetime.timedelta(380)
+        custom.add_payment(user, date.strftime('%d/%m/%Y'))
+        assert custom.getExpiringMembers(conn=conn) == set(['gawel'])
+        assert custom.getExpiringMembers(days=10, conn=conn) == set()
+    finally:
+        ldap.bind(custom.User, custom.Group)
+
+def test_search_none_base():
+    conn = testing.memory_connection()
+    assert len(conn.directory.search(None)) == len(conn.directory.search(''))
+    results = conn.search(base_dn=None, filter='(uid=gawel)')
+    assert len(results) == 1, results
+
+def test_filter_dn_values():
+    from afpy.ldap import filters
+    entry = {'dn': 'cn=bureau,ou=groups,dc=afpy,dc=org', 'cn': ['bureau'],
+             'member': ['uid=gawel, ou=members,dc=afpy,dc=org']}
+    assert filters.match('(member=UID=Gawel,ou=members, dc=afpy,dc=org)',
+                         filters.normalize(entry))
+    assert not filters.match('(member=uid=bob,ou=members,dc=afpy,dc=org)',
+                             filters.normalize(entry))
+    conn = testing.memory_connection()
+    results = conn.search(filter='(member=uid=gawel, ou=Members,dc=afpy,dc=org)')
+    assert len(results) == 1, results
@@ -121,10 +121,63 @@ The HMAC SHA-256 hash must be packed raw to fit into the first 32 bytes.
   >>> data is not None
   True
 
+
+Validating many tickets
+-----------------------
+
+A ``TicketValidator`` compute the keyed hash state once for its secret and
+keep recently validated tickets in a LRU cache. Use one per secret:
+
+  >>> validator = TicketValidator(SECRET, timeout=TIMEOUT)
+  >>> validator.validate(tkt, now=NOW) == data
+  True
+  >>> validator.validate(tkt, now=NOW) == data
+  True
+  >>> validator.cache.stats()['hits']
+  1
+
+The timeout is still checked for cached tickets:
+
+  >>> validator.validate(tkt, now=LATER) is None
+  True
+  >>> validator.validate(tkt[:-1] + 'x', now=NOW) is None
+  True
+
+``validate_cookie`` take the base64 encoded cookie value. Cached cookies are
+not decoded again:
+
+  >>> value = binascii.b2a_base64(tkt).strip()
+  >>> validator.validate_cookie(value, now=NOW) == data
+  True
+  >>> validator.validate_cookie('not base64!', now=NOW) is None
+  True
+
+
+Rotating the secret
+-------------------
+
+Tickets signed with a previous secret are still valid. ``lookup`` return the
+index of the secret used so the ticket can be issued again with the current
+one:
+
+  >>> NEW_SECRET = 'new secret shared between servers'
+  >>> validator = TicketValidator(NEW_SECRET, timeout=TIMEOUT,
+  ...                             previous_secrets=[SECRET])
+  >>> data, key = validator.lookup(tkt, now=NOW)
+  >>> data[1], key
+  ('jbloggs', 1)
+  >>> new_tkt = validator.createTicket(userid, timestamp=data[4])
+  >>> validator.lookup(new_tkt, now=NOW)[1]
+  0
+  >>> validateTicket([NEW_SECRET, SECRET], tkt, timeout=TIMEOUT, now=NOW) == data
+  True
+
 """
 
 from socket import inet_aton
 from struct import pack
+from cache import LRUCache
+import binascii
 import hashlib
 import hmac
 import time
@@ -141,6 +194,9 @@ def is_equal(val1, val2):
         result |= ord(x) ^ ord(y)
     return result == 0
 
+# use the C implementation when available (python>=2.7.7)
+compare_digest = getattr(hmac, 'compare_digest', is_equal)
+
 
 def mod_auth_tkt_digest(secret, data1, data2):
     digest0 = hashlib.md5(data1 + secret + data2).hexdigest()
@@ -168,8 +224,7 @@ def createTicket(secret, userid, tokens=(), user_data='', ip='0.0.0.0', timestam
     # Unfortunately, some older versions of Python assume that longs are always
     # 32 bits, so we need to trucate the result in case we are on a 64-bit
     # naive system.
-    data1 = inet_aton(ip)[:4] + pack("!I", timestamp)
-    data2 = '\0'.join((userid, token_list, user_data))
+    data1, data2 = _ticket_data(userid, token_list, user_data, ip, timestamp)
     if mod_auth_tkt:
         digest = mod_auth_tkt_digest(secret, data1, data2)
     else:
@@ -185,6 +240,11 @@ def createTicket(secret, userid, tokens=(), user_data='', ip='0.0.0.0', timestam
     return ticket
 
 
+def _ticket_data(userid, token_list, user_data, ip, timestamp):
+    return (inet_aton(ip)[:4] + pack("!I", timestamp),
+            '\0'.join((userid, token_list, user_data)))
+
+
 def splitTicket(ticket, encoding=None):
     digest = ticket[:32]
     val = ticket[32:40]
@@ -211,23 +271,120 @@ def splitTicket(ticket, encoding=None):
 
 def validateTicket(secret, ticket, ip='0.0.0.0', timeout=0, now=None,
                    encoding=None, mod_auth_tkt=False):
+    """secret can be a list of secrets. The current one first"""
     try:
         (digest, userid, tokens, user_data, timestamp) = data = \
             splitTicket(ticket)
     except ValueError:
         return None
-    new_ticket = createTicket(secret, userid, tokens,
-        user_data, ip, timestamp, encoding, mod_auth_tkt)
-    if is_equal(new_ticket[:32], digest):
-        if not timeout:
-            return data
-        if now is None:
-            now = time.time()
-        if timestamp + timeout > now:
-            return data
+    if isinstance(secret, basestring):
+        secret = [secret]
+    for s in secret:
+        new_ticket = createTicket(s, userid, tokens,
+            user_data, ip, timestamp, encoding, mod_auth_tkt)
+        if compare_digest(new_ticket[:32], digest):
+            break
+    else:
+        return None
+    if not timeout:
+        return data
+    if now is None:
+        now = time.time()
+    if timestamp + timeout > now:
+        return data
     return None
 
 
+class TicketValidator(object):
+    """validate tickets signed with ``secret`` or one of
+    ``previous_secrets``. Valid tickets are kept in a LRU cache of
+    ``cache_size`` items. Use ``cache_size=0`` to disable it"""
+
+    def __init__(self, secret, timeout=0, mod_auth_tkt=False, encoding=None,
+                 cache_size=1000, previous_secrets=()):
+        self.secret = secret
+        self.secrets = [secret] + [s for s in previous_secrets if s != secret]
+        self.timeout = timeout
+        self.mod_auth_tkt = mod_auth_tkt
+        self.encoding = encoding
+        self._hmacs = [hmac.new(s, digestmod=hashlib.sha256) for s in self.secrets]
+        self.cache = None
+        if cache_size:
+            self.cache = LRUCache(size=cache_size, ttl=0)
+
+    def digest(self, data1, data2, key=0):
+        """return the digest for the ``key`` secret. 0 is the current one"""
+        if self.mod_auth_tkt:
+            return mod_auth_tkt_digest(self.secrets[key], data1, data2)
+        h = self._hmacs[key].copy()
+        h.update(data1 + data2)
+        return h.digest()
+
+    def check(self, ticket, ip='0.0.0.0'):
+        """return ``(data, key)`` if the signature is valid where key is the
+        index of the secret in ``secrets``. ``(None, None)`` if not. The
+        timeout is not checked"""
+        try:
+            (digest, userid, tokens, user_data, timestamp) = data = \
+                splitTicket(ticket)
+        except ValueError:
+            return None, None
+        encoding = self.encoding
+        if encoding is not None:
+            userid = userid.encode(encoding)
+            tokens = [t.encode(encoding) for t in tokens]
+            user_data = user_data.encode(encoding)
+        try:
+            data1, data2 = _ticket_data(userid, ','.join(tokens), user_data,
+                                        ip, timestamp)
+        except Exception:
+            return None, None
+        for key in range(len(self.secrets)):
+            if compare_digest(self.digest(data1, data2, key), digest):
+                return data, key
+        return None, None
+
+    def validate(self, ticket, ip='0.0.0.0', now=None):
+        """return the ticket data or None"""
+        return self.lookup(ticket, ip, now)[0]
+
+    def validate_cookie(self, value, ip='0.0.0.0', now=None):
+        """like validate but take a base64 encoded ticket"""
+        return self.lookup(value, ip, now, decode=True)[0]
+
+    def lookup(self, value, ip='0.0.0.0', now=None, decode=False):
+        """return ``(data, key)`` like :meth:`check` for a not expired
+        ticket. A key other than 0 means that the ticket should be issued
+        again with the current secret"""
+        cache = self.cache
+        cache_key = (decode, value, ip)
+        result = cache is not None and cache.get(cache_key) or None
+        if result is None:
+            ticket = value
+            if decode:
+                try:
+                    ticket = binascii.a2b_base64(value)
+                except binascii.Error:
+                    return None, None
+            result = self.check(ticket, ip)
+            if result[0] is None:
+                return None, None
+            if cache is not None:
+                cache.set(cache_key, result)
+        if self.timeout:
+            if now is None:
+                now = time.time()
+            if result[0][4] + self.timeout <= now:
+                return None, None
+        return result
+
+    def createTicket(self, userid, tokens=(), user_data='', ip='0.0.0.0',
+                     timestamp=None):
+        """create a ticket signed with the current secret"""
+        return createTicket(self.secret, userid, tokens, user_data, ip,
+                            timestamp, self.encoding, self.mod_auth_tkt)
+
+
 # doctest runner
 def _test():
     import doctest
@@ -1,10 +1,22 @@
 # -*- coding: utf-8 -*-
+from optparse import OptionParser
 import datetime
+import binascii
+import hashlib
+import hmac
 import sys
+import os
+from dataflake.ldapconnection.utils import BINARY_ATTRIBUTES
 
 DEFAULT_ENCODING = getattr(sys.stdout, 'encoding', 'utf-8')
 
 _serializers = []
+# klass -> serializer used by to_python
+_registry = {}
+# type -> serializer resolved by to_string
+_resolved = {}
+# incremented each time a serializer is registered
+generation = 0
 
 def resolve_class(entry_point):
     """Resolve a dotted name:
@@ -19,13 +31,112 @@ def resolve_class(entry_point):
     mod = __import__(mode_name, globals(), locals(), [class_name], -1)
     return getattr(mod, class_name)
 
+def to_list(value):
+    """return value as a list of ldap values"""
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple, set)):
+        return list(value)
+    return [value]
+
+def to_values(value, attr=None):
+    """like :func:`to_list` but split a string on ``;`` like
+    ``LDAPConnection.modify()`` do. Values of binary attributes are not
+    split:
+
+    .. sourcecode:: py
+
+        >>> to_values('a@afpy.org; b@afpy.org')
+        ['a@afpy.org', 'b@afpy.org']
+
+    """
+    if isinstance(value, basestring):
+        if attr is None or attr.lower() not in BINARY_ATTRIBUTES:
+            return [v.strip() for v in value.split(';')]
+    return to_list(value)
+
+def normalize_dn(dn):
+    """normalize a dn to use it as a key:
+
+    .. sourcecode:: py
+
+        >>> normalize_dn('uid=Gawel, ou=members,dc=afpy,dc=org')
+        'uid=gawel,ou=members,dc=afpy,dc=org'
+
+    """
+    return ','.join([p.strip() for p in dn.lower().split(',')])
+
+def pbkdf2_sha256(password, salt, rounds=1000):
+    """return the PBKDF2-HMAC-SHA256 digest of password:
+
+    .. sourcecode:: py
+
+        >>> binascii.hexlify(pbkdf2_sha256('password', 'salt', 2))
+        'ae4d0c95af6b46d32d0adff928f06dd02a303f8ef3c251dfd6e2d85a95474c43'
+
+    """
+    if isinstance(password, unicode):
+        password = password.encode('utf-8')
+    if hasattr(hashlib, 'pbkdf2_hmac'):
+        return hashlib.pbkdf2_hmac('sha256', password, salt, rounds)
+    mac = hmac.new(password, digestmod=hashlib.sha256)
+    def prf(data):
+        h = mac.copy()
+        h.update(data)
+        return h.digest()
+    u = prf(salt + '\x00\x00\x00\x01')
+    result = int(binascii.hexlify(u), 16)
+    for i in xrange(rounds - 1):
+        u = prf(u)
+        result ^= int(binascii.hexlify(u), 16)
+    return binascii.unhexlify('%064x' % result)
+
+def compare_digest(a, b):
+    """constant time comparison"""
+    if len(a) != len(b):
+        return False
+    if hasattr(hmac, 'compare_digest'):
+        return hmac.compare_digest(a, b)
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+def option_parser(usage):
+    """return an OptionParser with the ``--section`` and ``--config``
+    options used by the scripts"""
+    parser = OptionParser(usage=usage)
+    parser.add_option('-s', '--section', dest='section', default='ldap',
+                      help='A config section to get ldap info from')
+    parser.add_option('-c', '--config', dest='config',
+                      default=os.path.expanduser('~/.ldap.cfg'),
+                      help='Config file. Default to ~/.ldap.cfg')
+    return parser
+
 def register_serializer(klass):
     """add a new serializer to the list
     """
     for attr in ('to_python', 'to_string', 'klass'):
         if not hasattr(klass, attr):
             raise AttributeError('%s as not attribute %s' % (klass, attr))
+    global generation
     _serializers.insert(0, klass)
+    _registry[klass.klass] = klass
+    _resolved.clear()
+    generation += 1
+
+def get_serializer(value_type):
+    """return the serializer used for instances of ``value_type`` or None"""
+    try:
+        return _resolved[value_type]
+    except KeyError:
+        for serializer in _serializers:
+            if issubclass(value_type, serializer.klass):
+                break
+        else:
+            serializer = None
+        _resolved[value_type] = serializer
+        return serializer
 
 class BaseSerializer(object):
     klass = str
@@ -122,18 +233,39 @@ def to_string(value):
     """serialize a python object to string"""
     if value is None:
         return None
-    if not isinstance(value, basestring):
-        for serializer in _serializers:
-            if isinstance(value, serializer.klass):
-                return serializer.to_string(value)
-    if not isinstance(value, basestring):
+    if isinstance(value, basestring):
+        return value
+    serializer = get_serializer(type(value))
+    if serializer is None:
         raise TypeError('%r is not serializable' % value)
-    return value
+    return serializer.to_string(value)
 
 def to_python(value, klass):
     """convert a string to python"""
     if value:
-        for serializer in _serializers:
-            if klass is serializer.klass:
-                return serializer.to_python(value)
+        serializer = _registry.get(klass)
+        if serializer is not None:
+            return serializer.to_python(value)
     return value
+
+def python_converter(klass):
+    """return a function converting strings to ``klass`` like
+    :func:`to_python` do:
+
+    .. sourcecode:: py
+
+        >>> python_converter(int)('2')
+        2
+        >>> python_converter(int)('')
+        ''
+
+    """
+    serializer = _registry.get(klass)
+    if serializer is None:
+        return lambda value: value
+    convert = serializer.to_python
+    def converter(value):
+        if value:
+            return convert(value)
+        return value
+    return converter
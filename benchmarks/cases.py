@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""Benchmark cases. A case take a connection (or None for cases which don't
+depend on the directory size) and return the callable to time. Raise
+``Skip`` if a dependency is missing"""
+import datetime
+import ldap
+from afpy.ldap import utils
+from afpy.ldap import tktauth
+from afpy.ldap import passwords
+import fixtures
+
+CASES = []
+
+
+class Skip(Exception):
+    """the case can't run here"""
+
+
+def case(name, sized=True):
+    """register a case. Sized cases run once per directory size"""
+    def wrapper(func):
+        CASES.append((name, sized, func))
+        return func
+    return wrapper
+
+def _entries(conn):
+    return conn.search(base_dn=fixtures.MEMBERS, scope=ldap.SCOPE_ONELEVEL,
+                       filter='(objectClass=person)',
+                       attrs=fixtures.User.attributes())
+
+def _nodes(conn):
+    attrs = fixtures.User.attributes()
+    return [conn._node(fixtures.User, e, attrs) for e in _entries(conn)]
+
+
+@case('search_nodes')
+def search_nodes(conn):
+    def run():
+        conn.search_nodes(node_class=fixtures.User, base_dn=fixtures.MEMBERS,
+                          scope=ldap.SCOPE_ONELEVEL, filter='(objectClass=person)')
+    return run
+
+@case('node_construction')
+def node_construction(conn):
+    entries = _entries(conn)
+    attrs = fixtures.User.attributes()
+    def run():
+        for e in entries:
+            conn._node(fixtures.User, e, attrs)
+    return run
+
+@case('frozen_node_construction')
+def frozen_node_construction(conn):
+    entries = _entries(conn)
+    attrs = fixtures.User.attributes()
+    def run():
+        for e in entries:
+            conn._node(fixtures.User, e, attrs, frozen=True)
+    return run
+
+@case('attribute_access')
+def attribute_access(conn):
+    nodes = _nodes(conn)
+    def run():
+        for n in nodes:
+            n.uid
+            n.cn
+            n.birthDate
+            n.objectClass
+    return run
+
+@case('member_nodes')
+def member_nodes(conn):
+    dn = 'cn=big,%s' % fixtures.GROUPS
+    def run():
+        group = fixtures.Group(dn=dn, conn=conn)
+        len(group.member_nodes)
+    return run
+
+def _group_adapter(conn, **kwargs):
+    try:
+        from afpy.ldap.auth import GroupAdapter
+    except ImportError, e:
+        raise Skip(str(e))
+    adapter = GroupAdapter(conn, **kwargs)
+    users = _nodes(conn)[:100]
+    def run():
+        for user in users:
+            adapter._find_sections({'user': user})
+    return run
+
+@case('find_sections')
+def find_sections(conn):
+    return _group_adapter(conn)
+
+@case('find_sections_cached')
+def find_sections_cached(conn):
+    return _group_adapter(conn, groups_cache_ttl=3600)
+
+@case('to_python', sized=False)
+def to_python(conn):
+    def run():
+        utils.to_python('20100504122300Z', klass=datetime.datetime)
+        utils.to_python('20100504122300Z', klass=datetime.date)
+        utils.to_python('2', klass=int)
+        utils.to_python(['a', 'b'], klass=list)
+    return run
+
+@case('to_string', sized=False)
+def to_string(conn):
+    date = datetime.date(2010, 5, 4)
+    now = datetime.datetime(2010, 5, 4, 12, 23)
+    def run():
+        utils.to_string(date)
+        utils.to_string(now)
+        utils.to_string(2)
+        utils.to_string('value')
+        utils.to_string(['a', 'b'])
+    return run
+
+@case('validate_ticket', sized=False)
+def validate_ticket(conn):
+    ticket = tktauth.createTicket('secret', 'gawel', tokens=('bureau', 'members'),
+                                  user_data='data')
+    def run():
+        tktauth.validateTicket('secret', ticket)
+    return run
+
+@case('validate_ticket_cached', sized=False)
+def validate_ticket_cached(conn):
+    ticket = tktauth.createTicket('secret', 'gawel', tokens=('bureau', 'members'),
+                                  user_data='data')
+    validator = tktauth.TicketValidator('secret', timeout=3600)
+    def run():
+        validator.validate(ticket)
+    return run
+
+@case('password_hash', sized=False)
+def password_hash(conn):
+    def run():
+        passwords.encode('secret', passwords.DEFAULT_SCHEME)
+    return run
+
+@case('password_hash_pbkdf2', sized=False)
+def password_hash_pbkdf2(conn):
+    def run():
+        passwords.encode('secret', 'pbkdf2-sha256')
+    return run
+
+@case('password_compare', sized=False)
+def password_compare(conn):
+    value = passwords.encode('secret', passwords.DEFAULT_SCHEME)
+    def run():
+        passwords.verify('secret', value)
+    return run
+
+@case('password_compare_pbkdf2', sized=False)
+def password_compare_pbkdf2(conn):
+    value = passwords.encode('secret', 'pbkdf2-sha256')
+    def run():
+        passwords.verify('secret', value)
+    return run
+
+@case('password_compare_ssha', sized=False)
+def password_compare_ssha(conn):
+    # legacy values not migrated yet
+    value = passwords.encode('secret', 'ssha')
+    def run():
+        passwords.verify('secret', value)
+    return run
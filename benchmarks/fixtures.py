@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""Synthetic directories served by :class:`afpy.ldap.testing.MemoryDirectory`
+"""
+from afpy.ldap import node
+from afpy.ldap import schema
+from afpy.ldap.testing import MemoryDirectory
+from afpy.ldap.testing import MemoryConnection
+
+SUFFIX = 'dc=afpy,dc=org'
+MEMBERS = 'ou=members,dc=afpy,dc=org'
+GROUPS = 'ou=groups,dc=afpy,dc=org'
+
+# members of each small group
+GROUP_SIZE = 100
+# max members of the big group used by the member_nodes benchmark
+BIG_GROUP_SIZE = 1000
+
+
+class User(node.User):
+    _rdn = 'uid'
+    _base_dn = MEMBERS
+    _defaults = dict(objectClass=['top', 'person', 'organizationalPerson',
+                                  'inetOrgPerson'])
+
+    uid = schema.StringProperty('uid', title='Login', required=True)
+    cn = schema.UnicodeProperty('cn', title='Name', required=True)
+    sn = schema.UnicodeProperty('sn', title='Last name', required=True)
+    mail = schema.StringProperty('mail', title='E-mail')
+    birthDate = schema.DateProperty('birthDate', title='Birth date')
+
+
+class Group(node.GroupOfNames):
+    _rdn = 'cn'
+    _base_dn = GROUPS
+
+    cn = schema.StringProperty('cn', title='cn', required=True)
+    member_nodes = schema.SetOfNodesProperty('member', title='Members',
+                                             node_class=User)
+
+
+def uid(i):
+    return 'user%06d' % i
+
+def user_dn(i):
+    return 'uid=%s,%s' % (uid(i), MEMBERS)
+
+def make_directory(size):
+    """return a directory with size users. Users are members of a group of
+    GROUP_SIZE users. The first BIG_GROUP_SIZE users are members of
+    ``cn=big``"""
+    directory = MemoryDirectory(suffix=SUFFIX)
+    directory.add(SUFFIX, dict(objectClass=['top', 'dcObject', 'organization'],
+                               o=['AFPy']))
+    for dn in (MEMBERS, GROUPS):
+        directory.add(dn, dict(objectClass=['top', 'organizationalUnit']))
+    for i in range(size):
+        directory.add(user_dn(i), dict(
+            objectClass=['top', 'person', 'organizationalPerson', 'inetOrgPerson'],
+            cn=['User %s' % i], sn=['User'], mail=['%s@afpy.org' % uid(i)],
+            birthDate=['19%02d0410000000Z' % (i % 100)],
+            userPassword=['{SSHA}4quMECnTMGBp5iXN+oM7elda7HRhZnB5c2FsdA==']))
+    for start in range(0, size, GROUP_SIZE):
+        members = [user_dn(i) for i in range(start, min(start + GROUP_SIZE, size))]
+        directory.add('cn=group%06d,%s' % (start / GROUP_SIZE, GROUPS),
+                      dict(objectClass=['top', 'groupOfNames'], member=members))
+    members = [user_dn(i) for i in range(min(size, BIG_GROUP_SIZE))]
+    directory.add('cn=big,%s' % GROUPS,
+                  dict(objectClass=['top', 'groupOfNames'], member=members))
+    return directory
+
+def make_connection(size):
+    """return a connection bound to User and Group"""
+    conn = MemoryConnection(make_directory(size), base_dn=SUFFIX)
+    conn.bind(User, Group)
+    return conn
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""Run the benchmarks and compare the results with a baseline::
+
+    $ python benchmarks/run.py -o results.json
+    $ python benchmarks/run.py --sizes 1000 -k member --compare results.json
+
+See benchmarks/README.txt
+"""
+from optparse import OptionParser
+from timeit import default_timer
+import platform
+import logging
+import time
+import os
+import json
+import gc
+import sys
+import cases
+import fixtures
+
+# a timed run must last at least this many seconds
+MIN_RUN_TIME = .2
+
+
+def measure(func, repeat=5, min_time=MIN_RUN_TIME):
+    """time func. Return a dict with the number of loops per run and the
+    min/median/max time of a loop in seconds"""
+    loops = 1
+    while True:
+        elapsed = _time(func, loops)
+        if elapsed >= min_time or loops >= 1000000:
+            break
+        loops *= 10
+    times = [elapsed / loops] + [_time(func, loops) / loops for i in range(repeat - 1)]
+    times.sort()
+    return dict(loops=loops, repeat=repeat, min=times[0],
+                median=times[len(times) / 2], max=times[-1])
+
+def _time(func, loops):
+    gc.collect()
+    gc.disable()
+    try:
+        start = default_timer()
+        for i in xrange(loops):
+            func()
+        return default_timer() - start
+    finally:
+        gc.enable()
+
+def run(sizes, names=None, repeat=5, out=sys.stdout):
+    """run the cases matching names. Return a dict of results by case name.
+    The name of a sized case contains the size: ``search_nodes[1000]``"""
+    results = {}
+    selected = [c for c in cases.CASES
+                  if not names or [n for n in names if n in c[0]]]
+    def bench(key, func, conn):
+        try:
+            results[key] = measure(func(conn), repeat=repeat)
+        except cases.Skip, e:
+            print >> out, '%-36s skipped: %s' % (key, e)
+        else:
+            print >> out, '%-36s %s' % (key, _format(results[key]['min']))
+
+    for name, sized, func in selected:
+        if not sized:
+            bench(name, func, None)
+    for size in sizes:
+        if not [c for c in selected if c[1]]:
+            break
+        start = time.time()
+        conn = fixtures.make_connection(size)
+        print >> out, '# %s entries directory built in %.1fs' % (
+                        size, time.time() - start)
+        for name, sized, func in selected:
+            if sized:
+                bench('%s[%s]' % (name, size), func, conn)
+    return results
+
+def _format(seconds):
+    for unit, factor in (('s', 1), ('ms', 1e3), ('us', 1e6)):
+        if seconds * factor >= 1:
+            return '%8.2f %s' % (seconds * factor, unit)
+    return '%8.2f ns' % (seconds * 1e9)
+
+def compare(results, baseline, threshold=.1, out=sys.stdout):
+    """print the ratio of each result to the baseline. Return the list of
+    cases slower than the baseline by more than threshold"""
+    regressions = []
+    print >> out, '%-36s %11s %11s %7s' % ('case', 'baseline', 'current', 'ratio')
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        old, new = baseline[key]['min'], results[key]['min']
+        ratio = old and new / old or 0
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = ' slower'
+            regressions.append(key)
+        elif ratio and ratio < 1 - threshold:
+            flag = ' faster'
+        print >> out, '%-36s %s %s %6.2fx%s' % (key, _format(old), _format(new),
+                                                 ratio, flag)
+    return regressions
+
+def metadata(sizes):
+    try:
+        import pkg_resources
+        version = pkg_resources.get_distribution('afpy.ldap').version
+    except Exception:
+        version = None
+    return dict(date=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                python=platform.python_version(),
+                implementation=platform.python_implementation(),
+                platform=platform.platform(),
+                afpy_ldap=version,
+                sizes=sizes)
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-s', '--sizes', dest='sizes', default='1000,10000,100000',
+                      help='Comma separated directory sizes. Default to 1000,10000,100000')
+    parser.add_option('-k', dest='names', action='append', default=[],
+                      help='Only run cases containing this string. Can be repeated')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int', default=5,
+                      help='Number of timed runs per case')
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help='Write results to this JSON file')
+    parser.add_option('-c', '--compare', dest='compare', default=None,
+                      help='Compare with a JSON file written by -o')
+    parser.add_option('-t', '--threshold', dest='threshold', type='float', default=.1,
+                      help='Relative slow down reported as a regression. Default to 0.1')
+    options, args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    sizes = [int(s) for s in options.sizes.split(',') if s.strip()]
+
+    results = run(sizes, names=options.names, repeat=options.repeat)
+
+    if options.output:
+        dirname = os.path.dirname(options.output)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        fd = open(options.output, 'w')
+        try:
+            json.dump(dict(metadata=metadata(sizes), results=results), fd,
+                      indent=2, sort_keys=True)
+        finally:
+            fd.close()
+    if options.compare:
+        baseline = json.load(open(options.compare))
+        print ''
+        regressions = compare(results, baseline['results'],
+                              threshold=options.threshold)
+        if regressions:
+            print >> sys.stderr, '%s regressions: %s' % (len(regressions),
+                                                         ', '.join(regressions))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
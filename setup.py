@@ -53,6 +53,9 @@ afpy.ldap
       # -*- Entry points: -*-
       [console_scripts]
       ldapsh = afpy.ldap.scripts:main
+      ldap-export = afpy.ldap.ldif:export_main
+      ldap-import = afpy.ldap.ldif:import_main
+      ldap-passwords = afpy.ldap.passwords:main
 
       [paste.app_factory]
       test = afpy.ldap.test_auth:make_test_app